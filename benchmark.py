@@ -0,0 +1,258 @@
+import time
+import json
+import random
+import argparse
+import asyncio
+import threading
+import tracemalloc
+import resource
+import statistics
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import email_check
+
+#--MOCK PROVIDERS--
+class mock_provider_handler(BaseHTTPRequestHandler):
+    """
+    Serves the MXToolbox and EasyDMARC responses that email_check parses:
+    -/api/v1/user - {"TempAuthKey": ...}
+    -/api/v1/lookup - an MXToolbox lookup result, selectors starting with "bad" fail
+    -/tools/dkim-lookup/status - the EasyDMARC selector HTML, with server.selector_count selectors
+    The server's settings (latency, error rates...) are read on every request, see mock_provider_server.
+    """
+    protocol_version = "HTTP/1.1" #keep-alive, like the real providers
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status:int, body:str, content_type:str="application/json", headers:dict=None):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        server.count(url.path)
+
+        #--SIMULATED LATENCY AND FAILURES--
+        if server.latency:
+            time.sleep(max(0.0, random.gauss(server.latency, server.latency * server.jitter)))
+        roll = random.random()
+        if roll < server.rate_limit_rate:
+            server.count("429")
+            return self.send(429, "{}", headers={"Retry-After": str(server.retry_after)})
+        if roll < server.rate_limit_rate + server.error_rate:
+            server.count("5xx")
+            return self.send(503, "{}")
+
+        #--RESPONSES--
+        if url.path == "/api/v1/user":
+            return self.send(200, json.dumps({"TempAuthKey": "benchmark-key"}))
+        if url.path == "/api/v1/lookup":
+            argument = parse_qs(url.query).get("argument", [""])[0]
+            failed = [{"Name": "DKIM Public Key", "Info": "Invalid key", "Url": ""}] if argument.startswith("bad") else []
+            return self.send(200, json.dumps({
+                "Failed": failed,
+                "Warnings": [],
+                "Passed": [{"Name": "Record Published", "Info": "Record found", "Url": ""}],
+                "Information": [{"Tag": "v", "Description": f"v=DKIM1; p=benchmark {argument}"}],
+                "Errors": [],
+                "Timeouts": []
+            }))
+        if url.path == "/tools/dkim-lookup/status":
+            if server.selector_count == 0:
+                return self.send(200, '<div class="mb-4 no-data-title">no selectors detected</div>', "text/html")
+            selectors = "".join(f'<div class="title " style="font-size: 18px;">selector{i}</div>' for i in range(server.selector_count))
+            return self.send(200, selectors, "text/html")
+        self.send(404, "{}")
+
+class mock_provider_server(ThreadingHTTPServer):
+    """
+    Local stand-in for MXToolbox and EasyDMARC, see mock_provider_handler.
+    -latency is the mean response time in seconds, jitter is its standard deviation as a fraction of latency
+    -error_rate and rate_limit_rate are the fractions of requests answered with 503 and with 429 (+ Retry-After)
+    -selector_count is the number of DKIM selectors EasyDMARC returns for each domain
+    -counts() returns the number of requests per path, and of 429 and 5xx responses
+    """
+    daemon_threads = True
+
+    def __init__(self, port:int=0, latency:float=0.02, jitter:float=0.2, error_rate:float=0.0, rate_limit_rate:float=0.0, retry_after:float=0.2, selector_count:int=3):
+        super().__init__(("127.0.0.1", port), mock_provider_handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.selector_count = selector_count
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, key:str):
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def counts(self) -> dict:
+        with self._lock:
+            return dict(self._counts)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+#--BENCHMARKS--
+def timed_do_all_checks(latencies:list):
+    """
+    Returns a do_all_checks() replacement that records how long each domain took.
+    """
+    do_all_checks = email_check.do_all_checks
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return do_all_checks(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return timed
+
+def run_mode(mode:str, domains:list, selector, workers:int) -> tuple:
+    """
+    Checks the domains in one mode and returns (per-domain latencies, number of results with an error).
+    -sequential/parallel - do_all_checks() one domain after another, with parallel=False/True
+    -bulk - bulk_scan() with workers domains at the same time
+    -async - async_do_all_checks() for workers domains at the same time on one event loop
+    """
+    latencies = []
+    results = []
+    if mode in ("sequential", "parallel"):
+        for domain in domains:
+            start = time.perf_counter()
+            try:
+                results.append(email_check.do_all_checks(domain, selector, parallel=mode == "parallel"))
+            except Exception as err:
+                results.append({"domain": domain, "dkim": err})
+            latencies.append(time.perf_counter() - start)
+    elif mode == "bulk":
+        #bulk_scan() calls do_all_checks() itself, so it is swapped for a timed version for the run
+        original = email_check.do_all_checks
+        email_check.do_all_checks = timed_do_all_checks(latencies)
+        try:
+            results = list(email_check.bulk_scan(domains, selector, workers=workers))
+        finally:
+            email_check.do_all_checks = original
+    elif mode == "async":
+        async def check_all():
+            limit = asyncio.Semaphore(workers)
+            async def check(domain:str):
+                async with limit:
+                    start = time.perf_counter()
+                    result = await email_check.async_do_all_checks(domain, selector)
+                    latencies.append(time.perf_counter() - start)
+                    return result
+            checked = await asyncio.gather(*[check(domain) for domain in domains])
+            await email_check.ASYNC_HTTP_CLIENT.close()
+            return checked
+        results = asyncio.run(check_all())
+    else:
+        raise Exception(f"Unknown mode {mode}")
+
+    errors = sum(1 for result in results if any(isinstance(result.get(check), Exception) for check in ("dkim", "spf", "dmarc")))
+    return latencies, errors
+
+def percentile(values:list, percent:float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+def benchmark(server:mock_provider_server, mode:str, domain_count:int, selector=None, workers:int=10, trace_memory:bool=True) -> dict:
+    """
+    Runs one mode against the mock server and returns its numbers.
+    Every run uses new domain names, so nothing is served from another run's in-flight lookups.
+    """
+    domains = [f"{mode}-{i}-{random.randrange(1 << 30)}.example" for i in range(domain_count)]
+    before = server.counts()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    latencies, errors = run_mode(mode, domains, selector, workers)
+    elapsed = time.perf_counter() - start
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    after = server.counts()
+    requests = sum(count for path, count in after.items() if path.startswith("/")) - sum(count for path, count in before.items() if path.startswith("/"))
+
+    return {
+        "mode": mode,
+        "domains": domain_count,
+        "elapsed": elapsed,
+        "domains_per_sec": domain_count / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "requests_per_domain": requests / domain_count if domain_count else 0.0,
+        "responses_429": after.get("429", 0) - before.get("429", 0),
+        "responses_5xx": after.get("5xx", 0) - before.get("5xx", 0),
+        "errors": errors,
+        "peak_memory": peak_memory, #bytes allocated by Python, see tracemalloc
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 #bytes, peak of the whole process so far
+    }
+
+def print_report(report:dict):
+    peak_memory = f"{report['peak_memory'] / 1048576:.1f}MiB" if report["peak_memory"] is not None else "-"
+    print(
+        f"{report['mode']:<11}{report['domains']:>8}{report['domains_per_sec']:>12.2f}"
+        f"{report['p50'] * 1000:>10.1f}{report['p99'] * 1000:>10.1f}{report['requests_per_domain']:>10.2f}"
+        f"{report['responses_429']:>7}{report['responses_5xx']:>7}{report['errors']:>8}"
+        f"{peak_memory:>11}{report['max_rss'] / 1048576:>10.1f}MiB"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks email_check against a local mock of MXToolbox and EasyDMARC.')
+    parser.add_argument('-m', '--mode', dest='modes', help='Mode to benchmark, can be used multiple times: sequential, parallel, bulk, async. (default: all)', action='append', choices=["sequential", "parallel", "bulk", "async"], default=None, required=False)
+    parser.add_argument('-n', '--domains', dest='domains', help='Number of domains checked in each mode. (default: 200)', type=int, default=200, required=False)
+    parser.add_argument('-w', '--workers', dest='workers', help='Domains checked at the same time in bulk and async mode. (default: 20)', type=int, default=20, required=False)
+    parser.add_argument('-s', '--selector', dest='selector', help='DKIM selector to check, instead of finding the selectors with the mock EasyDMARC.', default=None, required=False)
+    parser.add_argument('--selectors', dest='selector_count', help='Number of DKIM selectors the mock EasyDMARC returns per domain. (default: 3)', type=int, default=3, required=False)
+    parser.add_argument('--latency', dest='latency', help='Mean response time of the mock in seconds. (default: 0.02)', type=float, default=0.02, required=False)
+    parser.add_argument('--jitter', dest='jitter', help='Standard deviation of the response time, as a fraction of --latency. (default: 0.2)', type=float, default=0.2, required=False)
+    parser.add_argument('--error-rate', dest='error_rate', help='Fraction of requests answered with 503. (default: 0)', type=float, default=0.0, required=False)
+    parser.add_argument('--rate-limit-rate', dest='rate_limit_rate', help='Fraction of requests answered with 429 and a Retry-After header. (default: 0)', type=float, default=0.0, required=False)
+    parser.add_argument('--retry-after', dest='retry_after', help='Retry-After seconds sent with 429 responses. (default: 0.2)', type=float, default=0.2, required=False)
+    parser.add_argument('--pool-size', dest='pool_size', help='Maximum number of pooled connections per provider host. (default: 10)', type=int, default=10, required=False)
+    parser.add_argument('--no-tracemalloc', dest='no_tracemalloc', help='Do not trace Python memory allocations, tracing slows the checks down.', action='store_true', required=False)
+    parser.add_argument('-j', '--json', dest='json', help='Print the results in JSON format, one line per mode.', action='store_true', required=False)
+    args = parser.parse_args()
+
+    server = mock_provider_server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                                  rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after, selector_count=args.selector_count)
+    server.start()
+    #every check talks to the mock, the result cache is off by default when email_check is imported
+    email_check.MXTOOLBOX_URL = server.url
+    email_check.EASYDMARC_URL = server.url
+    email_check.HTTP_CLIENT.pool_size = args.pool_size
+    email_check.ASYNC_HTTP_CLIENT.pool_size = args.pool_size
+
+    if not args.json:
+        print(f"[*] Mock latency {args.latency * 1000:.0f}ms, {args.error_rate:.0%} 503s, {args.rate_limit_rate:.0%} 429s, {args.selector_count} selectors per domain")
+        print(f"{'mode':<11}{'domains':>8}{'domains/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'req/dom':>10}{'429s':>7}{'5xx':>7}{'errors':>8}{'peak mem':>11}{'max rss':>13}")
+    for mode in args.modes or ["sequential", "parallel", "bulk", "async"]:
+        report = benchmark(server, mode, args.domains, selector=args.selector, workers=args.workers, trace_memory=not args.no_tracemalloc)
+        if args.json:
+            print(json.dumps(report))
+        else:
+            print_report(report)
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,3616 @@
 import time
 import re
 import json
+import os
+import base64
+import hashlib
+import zlib
+import random
+import socket
+import struct
+import sqlite3
 import argparse
-from curl_cffi import requests
+import sys
+import threading
+import weakref
+import queue
+import itertools
+import functools
+import collections.abc
+import importlib
+import inspect
+import contextvars
+import contextlib
+import atexit
+import tempfile
+import email.utils
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError, TimeoutError, wait, FIRST_COMPLETED
 
-class dkim_check:
-    def __init__(self, domain:str, selector:str|list=None):
+#--LAZY IMPORTS--
+class lazy_import:
+    """
+    Stands in for a module that is only imported on first use, so importing this module, --help or
+    offline use (e.g the dns backend or merge) don't pay for curl_cffi or asyncio.
+    """
+    def __init__(self, name:str):
+        self._name = name
+
+    def __getattr__(self, attribute:str):
+        value = getattr(importlib.import_module(self._name), attribute)
+        setattr(self, attribute, value) #later lookups don't go through __getattr__
+        return value
+
+curl_cffi = lazy_import("curl_cffi")
+requests = lazy_import("curl_cffi.requests")
+asyncio = lazy_import("asyncio")
+multiprocessing = lazy_import("multiprocessing")
+
+MXTOOLBOX_URL = "https://mxtoolbox.com"
+EASYDMARC_URL = "https://easydmarc.com"
+MXTOOLBOX_USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
+
+class unauthorized_error(Exception):
+    """
+    Raised by query() when a provider returns 401.
+    """
+    pass
+
+class circuit_open_error(Exception):
+    """
+    Raised by query() when the provider host's circuit breaker is open.
+    """
+    pass
+
+class deadline_exceeded_error(Exception):
+    """
+    Raised by query() when the per-domain deadline runs out, see domain_deadline().
+    """
+    pass
+
+class lookup_cancelled_error(BaseException):
+    """
+    Raised inside a lookup that lost a hedged race (see hedged_backend) before it starts another request or retry.
+    Like asyncio.CancelledError it isn't an Exception, so single_flight makes the waiting callers run the call again
+    instead of failing them.
+    """
+    pass
+
+#--DEADLINES--
+DOMAIN_DEADLINE = contextvars.ContextVar("domain_deadline", default=None) #time.monotonic() by which the current domain must be finished
+
+@contextlib.contextmanager
+def domain_deadline(seconds:float=None):
+    """
+    Sets a deadline for every request made inside the with block, None means no deadline.
+    -the deadline follows the work into asyncio tasks and into threads started with context_submit()
+    -a nested deadline can only shorten the outer one
+    """
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    outer_deadline = DOMAIN_DEADLINE.get()
+    if outer_deadline is not None:
+        deadline = min(deadline, outer_deadline)
+    token = DOMAIN_DEADLINE.set(deadline)
+    try:
+        yield
+    finally:
+        DOMAIN_DEADLINE.reset(token)
+
+def remaining_time() -> float|None:
+    """
+    Returns the seconds left before the current domain's deadline, or None if there is no deadline.
+    """
+    deadline = DOMAIN_DEADLINE.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def fit_timeout(timeout:float=None) -> float:
+    """
+    Shortens a request timeout to the time left before the domain's deadline.
+    """
+    remaining = remaining_time()
+    if remaining is None:
+        return timeout
+    remaining = max(remaining, 0.001) #a timeout of 0 means no timeout to curl
+    return remaining if timeout is None else min(timeout, remaining)
+
+LOOKUP_CANCEL = contextvars.ContextVar("lookup_cancel", default=None) #threading.Event set once the current lookup has lost a hedged race
+
+def check_cancelled():
+    """
+    Raises lookup_cancelled_error if the current lookup has been cancelled, see hedged_backend.
+    """
+    cancel = LOOKUP_CANCEL.get()
+    if cancel is not None and cancel.is_set():
+        raise lookup_cancelled_error()
+
+def cancellable_sleep(seconds:float):
+    """
+    time.sleep() that raises lookup_cancelled_error as soon as the current lookup is cancelled.
+    """
+    cancel = LOOKUP_CANCEL.get()
+    if cancel is None:
+        time.sleep(seconds)
+    elif cancel.wait(seconds):
+        raise lookup_cancelled_error()
+
+def context_submit(executor:ThreadPoolExecutor, fn, *args, **kwargs) -> Future:
+    """
+    executor.submit() that runs fn in a copy of the current context, so the domain's deadline is kept in the worker thread.
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+class retry_policy:
+    """
+    Retry policy shared by http_client and async_http_client.
+    -429, 5xx responses, timeouts and connection errors are retried up to attempts times in total,
+    other errors (e.g 404) are not retried
+    -retries wait with exponential backoff and full jitter (a random delay between 0 and base_delay * 2^retry),
+    so workers that failed at the same time don't all retry at the same time
+    -a Retry-After header on a 429 or 503 response is used instead of the backoff
+    -every wait is capped at max_delay
+    -timeout is the per-request timeout in seconds, it is shortened to fit in the domain's deadline
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, attempts:int=5, base_delay:float=0.5, max_delay:float=30.0, timeout:float=15.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+
+    @staticmethod
+    def retry_after(response) -> float|None:
+        """
+        Returns the seconds to wait from a response's Retry-After header (seconds or an HTTP date), or None if there isn't one.
+        """
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def backoff(self, retry:int, response=None) -> float:
+        """
+        Returns the seconds to wait before a retry, retry is 0 for the first retry.
+        """
+        delay = None
+        if response is not None and response.status_code in (429, 503):
+            delay = self.retry_after(response)
+        if delay is None:
+            delay = random.uniform(0, self.base_delay * 2 ** retry)
+        return min(delay, self.max_delay)
+
+    def request_timeout(self, endpoint:str) -> float:
+        """
+        Returns the timeout for the next request, raises deadline_exceeded_error if the domain's deadline has run out.
+        """
+        remaining = remaining_time()
+        if remaining is None:
+            return self.timeout
+        if remaining <= 0:
+            raise deadline_exceeded_error(f"Deadline exceeded before querying {endpoint}.")
+        return min(self.timeout, remaining)
+
+    def retry_delay(self, endpoint:str, retry:int, response=None) -> float:
+        """
+        Returns the seconds to wait before a retry, raises deadline_exceeded_error if the retry
+        could not be made before the domain's deadline.
+        """
+        delay = self.backoff(retry, response)
+        remaining = remaining_time()
+        if remaining is not None and delay >= remaining:
+            raise deadline_exceeded_error(f"Deadline exceeded while retrying {endpoint}.")
+        return delay
+
+RETRY_POLICY = retry_policy()
+
+class circuit_breaker:
+    """
+    Per host circuit breaker shared by http_client and async_http_client.
+    -after failure_threshold failed requests in a row (429, 5xx, timeouts and connection errors), the host's
+    circuit opens and every request to it fails straight away with circuit_open_error, instead of
+    piling more requests and retries on a provider that is down
+    -after reset_timeout seconds a single trial request is let through (half-open), the circuit closes if it
+    succeeds and stays open for another reset_timeout seconds if it fails or never finishes
+    """
+    def __init__(self, failure_threshold:int=5, reset_timeout:float=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._hosts = {} #host -> {"failures": failed requests in a row, "opened_at": time.monotonic() or None}
+        self._lock = threading.Lock()
+
+    def state(self, host:str) -> str:
+        """
+        Returns "closed", "open" or "half-open".
+        """
+        with self._lock:
+            host_state = self._hosts.get(host)
+            if host_state is None or host_state["opened_at"] is None:
+                return "closed"
+            if time.monotonic() - host_state["opened_at"] < self.reset_timeout:
+                return "open"
+            return "half-open"
+
+    def before_request(self, host:str):
+        """
+        Raises circuit_open_error if a request to the host should not be made.
+        """
+        with self._lock:
+            host_state = self._hosts.get(host)
+            if host_state is None or host_state["opened_at"] is None:
+                return
+            if time.monotonic() - host_state["opened_at"] < self.reset_timeout:
+                METRICS.count("circuit_open_total", host=host)
+                raise circuit_open_error(f"{host} is unavailable - circuit breaker opened after {host_state['failures']} failed requests in a row.")
+            #this request is the half-open trial, the circuit is re-opened so every other request still fails fast
+            host_state["opened_at"] = time.monotonic()
+
+    def record_success(self, host:str):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def record_failure(self, host:str):
+        with self._lock:
+            host_state = self._hosts.setdefault(host, {"failures": 0, "opened_at": None})
+            host_state["failures"] += 1
+            if host_state["failures"] >= self.failure_threshold:
+                host_state["opened_at"] = time.monotonic()
+
+CIRCUIT_BREAKER = circuit_breaker()
+
+class provider_scheduler:
+    """
+    Per host request scheduler shared by http_client and async_http_client, so the requests of every
+    check class, thread and event loop are coordinated for each provider.
+    -token bucket: if a rate (requests per second) is set for a host, each request waits for a token,
+    bursts of up to burst requests are allowed (default: one second of requests)
+    -AIMD concurrency: the number of requests in flight per host is limited. While requests succeed and the
+    limit is in use, the limit grows by about one request per round trip. It is halved (backoff) on 429, 401
+    (MXToolbox answers throttled requests with 401), 5xx, timeouts and connection errors, and cut by 10% when the
+    average latency climbs above latency_tolerance times the host's best latency. It is cut at most once per round trip
+    -a Retry-After from the provider pauses the host for every worker, see pause()
+    """
+    WAKEUP_INTERVAL = 0.1 #seconds between checks for a free slot, in case a wake up was missed
+
+    def __init__(self, rates:dict=None, max_limits:dict=None, initial_limit:float=4, min_limit:float=1, max_limit:float=32, backoff:float=0.5, latency_tolerance:float=2.0):
+        self.rates = dict(rates) if rates else {} #host -> requests per second
+        self.max_limits = dict(max_limits) if max_limits else {} #host -> maximum concurrency, overrides max_limit
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _get_host(self, host:str) -> dict:
+        #must be called with the lock held
+        state = self._hosts.get(host)
+        if state is None:
+            state = {
+                "limit": float(self.initial_limit), "in_flight": 0,
+                "tokens": 0.0, "refilled_at": time.monotonic(), "paused_until": 0.0,
+                "latency": None, "best_latency": None, "decreased_at": 0.0,
+                "condition": threading.Condition(self._lock), "waiters": [] #(event loop, future) of waiting tasks
+            }
+            state["tokens"] = self._burst(host)
+            self._hosts[host] = state
+        return state
+
+    def _burst(self, host:str) -> float:
+        rate = self.rates.get(host)
+        return max(1.0, rate) if rate else 0.0
+
+    def set_rate(self, host:str, rate:float):
+        """
+        Sets the maximum number of requests per second for a host, None removes the limit.
+        """
+        with self._lock:
+            if rate:
+                self.rates[host] = rate
+            else:
+                self.rates.pop(host, None)
+            if host in self._hosts:
+                self._hosts[host]["tokens"] = min(self._hosts[host]["tokens"], self._burst(host))
+
+    def set_max_limit(self, host:str, limit:int):
+        """
+        Sets the maximum concurrency the AIMD limit can grow to for a host.
+        """
+        with self._lock:
+            self.max_limits[host] = limit
+            if host in self._hosts:
+                self._hosts[host]["limit"] = min(self._hosts[host]["limit"], limit)
+
+    def pause(self, host:str, seconds:float=None):
+        """
+        Stops every worker from starting a request to the host for the next seconds, e.g for a Retry-After header.
+        """
+        if not seconds:
+            return
+        with self._lock:
+            state = self._get_host(host)
+            state["paused_until"] = max(state["paused_until"], time.monotonic() + seconds)
+
+    def stats(self) -> dict:
+        """
+        Returns the current limit, requests in flight and average latency of each host.
+        """
+        with self._lock:
+            return {host: {"limit": state["limit"], "in_flight": state["in_flight"], "rate": self.rates.get(host), "latency": state["latency"]}
+                    for host, state in self._hosts.items()}
+
+    def _try_acquire(self, host:str) -> float:
+        """
+        Takes a slot (and a token) for the host and returns 0 if both are free,
+        otherwise returns the seconds to wait before trying again. Must be called with the lock held.
+        """
+        state = self._get_host(host)
+        now = time.monotonic()
+        if now < state["paused_until"]:
+            return state["paused_until"] - now
+        if state["in_flight"] >= int(state["limit"]):
+            return self.WAKEUP_INTERVAL #woken up by release()
+        rate = self.rates.get(host)
+        if rate:
+            state["tokens"] = min(self._burst(host), state["tokens"] + (now - state["refilled_at"]) * rate)
+            state["refilled_at"] = now
+            if state["tokens"] < 1:
+                return (1 - state["tokens"]) / rate
+            state["tokens"] -= 1
+        state["in_flight"] += 1
+        return 0.0
+
+    def acquire(self, host:str, timeout:float=None) -> bool:
+        """
+        Waits for a slot to send a request to the host, returns False if none was free within timeout seconds.
+        Every acquire() must be followed by a release().
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            condition = self._get_host(host)["condition"]
+            while True:
+                wait = self._try_acquire(host)
+                if wait == 0:
+                    return True
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining)
+                condition.wait(wait)
+
+    async def acquire_async(self, host:str, timeout:float=None) -> bool:
+        """
+        asyncio version of acquire(), the event loop keeps running while the task waits.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                wait = self._try_acquire(host)
+                if wait == 0:
+                    return True
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining)
+                waiter = (loop, loop.create_future())
+                waiters = self._get_host(host)["waiters"]
+                waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter[1], wait)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._lock:
+                    if waiter in waiters:
+                        waiters.remove(waiter)
+
+    def release(self, host:str, started:float=None, status:int=None):
+        """
+        Frees the host's slot and adjusts its concurrency limit from the request's outcome.
+        started is the time.monotonic() the request was sent at, status is the HTTP status code or None if
+        the request failed without a response (timeout, connection error).
+        If started is None, the slot is freed without adjusting the limit.
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._get_host(host)
+            state["in_flight"] -= 1
+            if started is not None:
+                self._adjust(host, state, now - started, status, now)
+            state["condition"].notify()
+            #wake up one waiting task, whichever event loop it is on
+            while state["waiters"]:
+                loop, future = state["waiters"].pop(0)
+                if not future.done() and not loop.is_closed():
+                    loop.call_soon_threadsafe(self._wake, future)
+                    break
+
+    @staticmethod
+    def _wake(future:"asyncio.Future"):
+        if not future.done():
+            future.set_result(None)
+
+    def _adjust(self, host:str, state:dict, latency:float, status:int, now:float):
+        #must be called with the lock held
+        congested = status is None or status in (401, 429) or status >= 500
+        if status is not None:
+            state["latency"] = latency if state["latency"] is None else state["latency"] * 0.8 + latency * 0.2
+        if not congested:
+            #the best latency slowly follows the current latency, so a provider that is permanently slower isn't throttled forever
+            best = state["best_latency"]
+            state["best_latency"] = latency if best is None or latency < best else best * 0.99 + latency * 0.01
+        
+        round_trip = state["latency"] or 0.0
+        if congested or state["latency"] > self.latency_tolerance * state["best_latency"]:
+            #--MULTIPLICATIVE DECREASE--
+            #requests that were already in flight report the same congestion, so the limit is cut at most once per round trip
+            if now - state["decreased_at"] >= round_trip:
+                factor = self.backoff if congested else 0.9
+                state["limit"] = max(self.min_limit, state["limit"] * factor)
+                state["decreased_at"] = now
+        elif state["in_flight"] + 1 >= int(state["limit"]):
+            #--ADDITIVE INCREASE--
+            #only grow while the limit is actually in use, otherwise it would grow forever while idle
+            max_limit = self.max_limits.get(host, self.max_limit)
+            state["limit"] = min(max_limit, state["limit"] + 1 / state["limit"])
+
+SCHEDULER = provider_scheduler()
+
+class single_flight:
+    """
+    Coalesces identical calls that are in flight at the same time: the first caller (the leader) runs the call,
+    every other caller with the same key waits for it and gets the same result or exception.
+    -works across threads and event loops, do() and do_async() callers with the same key share one call
+    -nothing is kept once the call finishes, so it never returns stale results, see result_cache for that
+    -results are shared between callers and must not be modified
+    """
+    def __init__(self):
+        self._calls = {} #key -> concurrent.futures.Future of the leader's call
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "shared": 0}
+
+    def stats(self) -> dict:
+        """
+        Returns a copy of the counters, shared is the number of calls that were served by another caller's call.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _join(self, key) -> tuple:
+        #returns (future, is_leader)
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self._stats["shared"] += 1
+                METRICS.count("coalesced_total")
+                return future, False
+            future = self._calls[key] = Future()
+            self._stats["calls"] += 1
+            return future, True
+
+    def _finish(self, key, future:Future, result=None, error:BaseException=None):
+        with self._lock:
+            del self._calls[key]
+        if error is None:
+            future.set_result(result)
+        elif isinstance(error, Exception):
+            future.set_exception(error)
+        else:
+            #the leader was cancelled (or interrupted), the waiting callers make the call again themselves
+            future.cancel()
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Returns fn(*args, **kwargs), or the result of the identical call already in flight.
+        Waiting callers give up with deadline_exceeded_error when the domain's deadline runs out.
+        """
+        while True:
+            future, is_leader = self._join(key)
+            if is_leader:
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as err:
+                    self._finish(key, future, error=err)
+                    raise
+                self._finish(key, future, result)
+                return result
+            try:
+                return future.result(timeout=remaining_time())
+            except CancelledError:
+                continue
+            except TimeoutError:
+                raise deadline_exceeded_error(f"Deadline exceeded while waiting for {key}.")
+
+    async def do_async(self, key, fn, *args, **kwargs):
+        """
+        asyncio version of do(), fn must be a coroutine function.
+        """
+        while True:
+            future, is_leader = self._join(key)
+            if is_leader:
+                try:
+                    result = await fn(*args, **kwargs)
+                except BaseException as err:
+                    self._finish(key, future, error=err)
+                    raise
+                self._finish(key, future, result)
+                return result
+            try:
+                #shield() stops a waiting task that is cancelled from cancelling the leader's call
+                return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), remaining_time())
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise #this task was cancelled, not the leader
+                continue
+            except asyncio.TimeoutError:
+                raise deadline_exceeded_error(f"Deadline exceeded while waiting for {key}.")
+
+SINGLE_FLIGHT = single_flight() #shared by the HTTP clients and the lookup backends
+
+def query_key(endpoint:str, headers:dict=None, impersonate:str=None) -> tuple:
+    """
+    Returns the single_flight key of an HTTP query, queries with the same URL, headers and impersonation share one request.
+    """
+    return ("query", endpoint, tuple(sorted(headers.items())) if headers else (), impersonate)
+
+#--INSTRUMENTATION--
+CURRENT_SPAN = contextvars.ContextVar("current_span", default=None) #the span the running code is inside of
+
+class span:
+    """
+    A timed stage of a check, e.g "query", "find_selectors" or "check_dkim", see instrumentation.span().
+    Span hooks get the finished span, in the style of an OpenTelemetry span:
+    -span_id, and parent_id of the span that was running when it started (e.g the check_dkim span of a query), or None
+    -start (time.time()), duration in seconds, attributes e.g {"host": "mxtoolbox.com", "retries": 1}
+    -error is the exception that ended the span, or None
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, name:str, attributes:dict=None, parent:"span"=None):
+        self.name = name
+        self.attributes = attributes if attributes is not None else {}
+        self.span_id = next(span._ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+        self._started = time.perf_counter()
+
+    def set_attribute(self, key:str, value):
+        self.attributes[key] = value
+
+class instrumentation:
+    """
+    Collects timings and counters from the hot paths of every check, thread and event loop.
+    -stage timings: count, total, maximum and a latency histogram per stage, labelled by host for HTTP stages
+    -counters: requests by host and status, retries, bytes received, new connections, cache hits and misses...
+    -sinks: prometheus_text() returns everything in the Prometheus text format, add_span_hook() registers a
+    function that is called with every finished span, and report() returns the --profile breakdown
+    -SPAN_LABELS are the span attributes that are also used as metric labels, the others only go to span hooks
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    SPAN_LABELS = ("host",)
+
+    def __init__(self):
+        self._stages = {} #(stage, labels) -> {"count", "total", "max", "buckets"}
+        self._counters = {} #(name, labels) -> value
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(labels:dict) -> tuple:
+        return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+    def add_span_hook(self, hook):
+        """
+        Registers hook(span), called in the thread that finished the span. Exceptions raised by a hook are ignored.
+        """
+        with self._lock:
+            self._hooks.append(hook)
+
+    def remove_span_hook(self, hook):
+        with self._lock:
+            self._hooks.remove(hook)
+
+    @contextlib.contextmanager
+    def span(self, name:str, **attributes):
+        """
+        Times the with block as the stage name, e.g `with METRICS.span("check_spf", domain=domain):`
+        Works in threads and in asyncio code, nested spans get the enclosing span as their parent.
+        """
+        current = span(name, attributes, CURRENT_SPAN.get())
+        token = CURRENT_SPAN.set(current)
+        try:
+            yield current
+        except BaseException as err:
+            current.error = err
+            raise
+        finally:
+            CURRENT_SPAN.reset(token)
+            current.duration = time.perf_counter() - current._started
+            self.observe(name, current.duration, **{key: current.attributes.get(key) for key in self.SPAN_LABELS})
+            if current.error is not None:
+                self.count("errors_total", stage=name, error=type(current.error).__name__)
+            for hook in self._hooks:
+                try:
+                    hook(current)
+                except Exception:
+                    pass
+
+    def timed(self, name:str):
+        """
+        Decorator that runs every call of a function or coroutine function in a span, e.g @METRICS.timed("check_spf")
+        """
+        def decorator(fn):
+            if inspect.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def timed_async(*args, **kwargs):
+                    with self.span(name):
+                        return await fn(*args, **kwargs)
+                return timed_async
+            @functools.wraps(fn)
+            def timed(*args, **kwargs):
+                with self.span(name):
+                    return fn(*args, **kwargs)
+            return timed
+        return decorator
+
+    def observe(self, stage:str, seconds:float, **labels):
+        """
+        Records one timing of a stage.
+        """
+        key = (stage, self._labels(labels))
+        with self._lock:
+            timing = self._stages.get(key)
+            if timing is None:
+                timing = self._stages[key] = {"count": 0, "total": 0.0, "max": 0.0, "buckets": [0] * len(self.BUCKETS)}
+            timing["count"] += 1
+            timing["total"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+            for index, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    timing["buckets"][index] += 1
+                    break
+
+    def count(self, name:str, value:float=1, **labels):
+        """
+        Adds value to a counter, e.g count("bytes_received_total", 512, host="mxtoolbox.com")
+        """
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def stats(self) -> dict:
+        """
+        Returns a copy of everything collected: {"stages": {(stage, labels): timing}, "counters": {(name, labels): value}}
+        """
+        with self._lock:
+            return {
+                "stages": {key: dict(timing, buckets=list(timing["buckets"])) for key, timing in self._stages.items()},
+                "counters": dict(self._counters)
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+
+    @staticmethod
+    def _format_labels(labels:tuple, extra:tuple=()) -> str:
+        labels = labels + extra
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+    def prometheus_text(self, prefix:str="email_check") -> str:
+        """
+        Returns the timings (as histograms) and counters in the Prometheus text exposition format.
+        """
+        stats = self.stats()
+        lines = [f"# TYPE {prefix}_stage_seconds histogram"]
+        for (stage, labels), timing in sorted(stats["stages"].items()):
+            labels = (("stage", stage),) + labels
+            cumulative = 0
+            for bound, bucket in zip(self.BUCKETS, timing["buckets"]):
+                cumulative += bucket
+                lines.append(f"{prefix}_stage_seconds_bucket{self._format_labels(labels, (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{prefix}_stage_seconds_bucket{self._format_labels(labels, (('le', '+Inf'),))} {timing['count']}")
+            lines.append(f"{prefix}_stage_seconds_sum{self._format_labels(labels)} {timing['total']}")
+            lines.append(f"{prefix}_stage_seconds_count{self._format_labels(labels)} {timing['count']}")
+        typed = set()
+        for (name, labels), value in sorted(stats["counters"].items()):
+            if name not in typed:
+                lines.append(f"# TYPE {prefix}_{name} counter")
+                typed.add(name)
+            lines.append(f"{prefix}_{name}{self._format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def report(self) -> str:
+        """
+        Returns the aggregated breakdown printed by --profile.
+        Stages are nested (e.g a query runs inside check_dkim), so their totals overlap.
+        """
+        stats = self.stats()
+        lines = [f"{'stage':<32}{'count':>8}{'total s':>10}{'avg ms':>10}{'max ms':>10}"]
+        for (stage, labels), timing in sorted(stats["stages"].items(), key=lambda item: -item[1]["total"]):
+            label = stage + "".join(f" {value}" for _, value in labels)
+            lines.append(f"{label:<32}{timing['count']:>8}{timing['total']:>10.2f}{timing['total'] / timing['count'] * 1000:>10.1f}{timing['max'] * 1000:>10.1f}")
+        lines.append("")
+        for (name, labels), value in sorted(stats["counters"].items()):
+            label = name + "".join(f" {key}={value_}" for key, value_ in labels)
+            lines.append(f"{label:<56}{value:>12g}")
+        return "\n".join(lines)
+
+METRICS = instrumentation() #shared by every check, see --profile
+
+def curl_timing_infos() -> list:
+    """
+    Returns the connection timings collected by the pooled sessions.
+    """
+    return [curl_cffi.CurlInfo.CONNECT_TIME, curl_cffi.CurlInfo.APPCONNECT_TIME]
+
+def record_http_metrics(host:str, response, seconds:float):
+    """
+    Records a single HTTP request in METRICS, response is None if the request failed without a response.
+    Connection and TLS handshake times are only recorded for requests that opened a new connection.
+    """
+    METRICS.observe("request", seconds, host=host)
+    if response is None:
+        METRICS.count("requests_total", host=host, status="error")
+        return
+    METRICS.count("requests_total", host=host, status=response.status_code)
+    METRICS.count("bytes_received_total", len(response.content), host=host)
+    connect_time = response.infos.get(curl_cffi.CurlInfo.CONNECT_TIME) or 0.0
+    handshake_time = response.infos.get(curl_cffi.CurlInfo.APPCONNECT_TIME) or 0.0
+    if connect_time > 0:
+        METRICS.count("connections_opened_total", host=host)
+        METRICS.observe("connect", connect_time, host=host)
+    if handshake_time > connect_time:
+        METRICS.observe("tls_handshake", handshake_time - connect_time, host=host)
+
+class base_http_client:
+    """
+    Retry, circuit breaker and metrics handling shared by http_client and async_http_client,
+    each attempt of a query is classified here so both clients retry and fail the same way.
+    """
+    def __init__(self, pool_size:int=10, host_pool_sizes:dict=None, impersonate:str="chrome110", retry:retry_policy=None, breaker:circuit_breaker=None, scheduler:provider_scheduler=None, flights:single_flight=None):
+        self.pool_size = pool_size
+        self.host_pool_sizes = host_pool_sizes if host_pool_sizes is not None else {}
+        self.impersonate = impersonate
+        self.retry = retry if retry is not None else RETRY_POLICY
+        self.breaker = breaker if breaker is not None else CIRCUIT_BREAKER
+        self.scheduler = scheduler if scheduler is not None else SCHEDULER
+        self.flights = flights if flights is not None else SINGLE_FLIGHT
+
+    def _start_attempt(self, endpoint:str, host:str) -> float:
+        """
+        Runs before every attempt of a query, returns the attempt's timeout.
+        Raises lookup_cancelled_error if the lookup was cancelled, or circuit_open_error while the host's circuit is open.
+        """
+        check_cancelled()
+        timeout = self.retry.request_timeout(endpoint)
+        self.breaker.before_request(host)
+        return timeout
+
+    def _attempt_succeeded(self, host:str, response):
+        self.breaker.record_success(host)
+        return response
+
+    def _attempt_failed(self, endpoint:str, host:str, response, err:Exception) -> str:
+        """
+        Classifies a failed attempt of a query.
+        Raises the error if the attempt shouldn't be retried, otherwise returns the error's description.
+        """
+        if isinstance(err, requests.exceptions.HTTPError):
+            if response.status_code not in self.retry.RETRY_STATUSES:
+                self.breaker.record_success(host) #the provider is up, the request itself is wrong
+                if response.status_code == 401: #no need to retry if the error is 401
+                    raise unauthorized_error(f"Unauthorized access to {endpoint}. Please check your credentials. - {response.status_code} - {response.reason} - {response.text}")
+                raise Exception(f"Failed to query {endpoint}. HTTP status code: {response.status_code} - {response.reason} - {response.text}")
+            if response.status_code in (429, 503):
+                self.scheduler.pause(host, self.retry.retry_after(response)) #every worker waits, not just this one
+            return f"HTTP status code: {response.status_code} - {response.reason} - {response.text}"
+        if isinstance(err, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+            return str(err)
+        #generic and unknown errors that don't fall under HTTPError
+        self.breaker.record_failure(host)
+        raise Exception(f"Failed to query {endpoint} with error: {err}")
+
+    def _retry_delay(self, endpoint:str, host:str, retry:int, response, last_error:str, query_span:span) -> float:
+        """
+        Records a retryable failure, returns how long to wait before the next attempt.
+        Raises once the retry policy's attempts are used up.
+        """
+        self.breaker.record_failure(host)
+        query_span.set_attribute("retries", retry)
+        METRICS.count("retries_total", host=host)
+        if retry >= self.retry.attempts:
+            raise Exception(f"Failed to query {endpoint} after {self.retry.attempts} tries. Last error: {last_error}")
+        return self.retry.retry_delay(endpoint, retry - 1, response)
+
+class http_client(base_http_client):
+    """
+    Shared HTTP client used by every check class.
+    -keeps a pool of long-lived curl_cffi sessions per host, so keep-alive connections (and their
+    TLS handshakes) are reused between queries instead of creating a new requests.Session() each time
+    -pool_size is the maximum number of sessions (and so concurrent requests) per host, host_pool_sizes
+    can override it for specific hosts e.g {"easydmarc.com": 2}
+    -counts created and reused sessions, see stats()
+    -retries and failing hosts are handled by retry_policy and circuit_breaker (default: RETRY_POLICY and CIRCUIT_BREAKER)
+    -request rates and concurrency per host are coordinated by provider_scheduler (default: SCHEDULER)
+    -identical queries that are in flight at the same time share one request (default: SINGLE_FLIGHT)
+    """
+    def __init__(self, pool_size:int=10, host_pool_sizes:dict=None, impersonate:str="chrome110", retry:retry_policy=None, breaker:circuit_breaker=None, scheduler:provider_scheduler=None, flights:single_flight=None):
+        super().__init__(pool_size, host_pool_sizes, impersonate, retry, breaker, scheduler, flights)
+        self._pools = {} #host -> {"idle": LifoQueue of sessions, "slots": BoundedSemaphore}
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "sessions_created": 0, "sessions_reused": 0}
+
+    def _get_pool(self, host:str) -> dict:
+        with self._lock:
+            pool = self._pools.get(host)
+            if pool is None:
+                size = self.host_pool_sizes.get(host, self.pool_size)
+                pool = {"idle": queue.LifoQueue(), "slots": threading.BoundedSemaphore(size)}
+                self._pools[host] = pool
+            return pool
+
+    def set_host_limit(self, host:str, size:int):
+        """
+        Sets the maximum number of pooled sessions (concurrent requests) for a single host.
+        Requests that are already running finish on the old limit.
+        """
+        with self._lock:
+            self.host_pool_sizes[host] = size
+            if host in self._pools:
+                self._pools[host]["slots"] = threading.BoundedSemaphore(size)
+
+    def _count(self, key:str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self) -> dict:
+        """
+        Returns a copy of the connection counters.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def close(self):
+        """
+        Closes every idle session in every pool.
+        """
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools = {}
+        for pool in pools:
+            while True:
+                try:
+                    pool["idle"].get_nowait().close()
+                except queue.Empty:
+                    break
+
+    def get(self, endpoint:str, headers:dict=None, impersonate:str=None, timeout:float=None, fresh:bool=False):
+        """
+        Runs a single GET request on a pooled session for the endpoint's host.
+        Blocks while all of the host's sessions are in use, or until the scheduler lets the request through.
+        If fresh is True the request uses a new session (and so a new connection) that is closed afterwards.
+        """
+        host = urlsplit(endpoint).hostname
+        waiting = time.perf_counter()
+        pool = self._get_pool(host)
+        slots = pool["slots"] #set_host_limit() may replace the semaphore while the request runs
+        #the session slot is taken before the scheduler slot, and the domain's deadline covers the wait for both
+        if not slots.acquire(timeout=remaining_time()):
+            raise deadline_exceeded_error(f"Deadline exceeded while waiting for a connection to query {endpoint}.")
+        try:
+            if not self.scheduler.acquire(host, remaining_time()):
+                raise deadline_exceeded_error(f"Deadline exceeded while waiting to query {endpoint}.")
+            started = None
+            response = None
+            session = None
+            try:
+                METRICS.observe("queue_wait", time.perf_counter() - waiting, host=host)
+                timeout = fit_timeout(timeout)
+                #the most recently used session is taken first, as it is the most likely to still be connected
+                try:
+                    if fresh:
+                        raise queue.Empty
+                    session = pool["idle"].get_nowait()
+                    self._count("sessions_reused")
+                except queue.Empty:
+                    #each pooled session keeps its own curl handle, rather than one per thread, so its connections are reused
+                    #no matter which worker thread picks it up next
+                    session = requests.Session(use_thread_local_curl=False, curl_infos=curl_timing_infos())
+                    self._count("sessions_created")
+                self._count("requests")
+                started = time.monotonic()
+                response = session.get(endpoint, headers=headers, impersonate=impersonate or self.impersonate, timeout=timeout)
+                return response
+            finally:
+                #started is None if the request was never sent, its slot is freed without adjusting the limit
+                self.scheduler.release(host, started, response.status_code if response is not None else None)
+                if started is not None:
+                    record_http_metrics(host, response, time.monotonic() - started)
+                if session is not None:
+                    if fresh:
+                        session.close()
+                    else:
+                        pool["idle"].put(session)
+        finally:
+            slots.release()
+
+    def query(self, endpoint:str, headers:dict=None, impersonate:str=None, fresh:bool=False):
+        """
+        -runs a GET request against the provided endpoint and returns the raw GET response
+        -retries 429, 5xx responses, timeouts and connection errors with backoff, see retry_policy
+        -fails straight away with circuit_open_error while the host's circuit breaker is open
+        -raises deadline_exceeded_error when the domain's deadline runs out, see domain_deadline()
+        -impersontates chrome110 by default - this gets around TLS fingerprinting, as
+        mxtoolbox will block any traffic (returns 401) using the requests library TLS fingerprint. 
+        -concurrent queries for the same endpoint and headers share one request and response, see single_flight
+        -responses are recorded in, or replayed from, the shared CASSETTE if there is one
+        -if fresh is True the query doesn't join an identical query in flight and uses a new connection,
+        e.g for the duplicate of a slow lookup, see hedged_backend
+        
+        """
+        if CASSETTE is not None and CASSETTE.replaying:
+            return CASSETTE.replay_http(endpoint)
+        if fresh:
+            response = self._query(endpoint, headers, impersonate, fresh=True)
+        else:
+            response = self.flights.do(query_key(endpoint, headers, impersonate), self._query, endpoint, headers, impersonate)
+        if CASSETTE is not None:
+            CASSETTE.record_http(endpoint, response)
+        return response
+
+    def _query(self, endpoint:str, headers:dict=None, impersonate:str=None, fresh:bool=False):
+        host = urlsplit(endpoint).hostname
+        with METRICS.span("query", host=host) as query_span:
+            retry = 0
+            while True:
+                timeout = self._start_attempt(endpoint, host)
+                response = None
+                try:
+                    response = self.get(endpoint, headers=headers, impersonate=impersonate, timeout=timeout, fresh=fresh)
+                    response.raise_for_status() #check if the status isn't successful
+                    return self._attempt_succeeded(host, response)
+                except Exception as err:
+                    last_error = self._attempt_failed(endpoint, host, response, err)
+                retry += 1
+                cancellable_sleep(self._retry_delay(endpoint, host, retry, response, last_error, query_span))
+
+HTTP_CLIENT = http_client()
+
+class async_http_client(base_http_client):
+    """
+    asyncio version of http_client, built on curl_cffi's AsyncSession.
+    -each event loop gets one long-lived AsyncSession, so thousands of lookups can share one loop
+    and its pooled connections instead of tying up a thread each
+    -pool_size/host_pool_sizes limit the number of concurrent requests per host, like http_client
+    -shares RETRY_POLICY, CIRCUIT_BREAKER, SCHEDULER and SINGLE_FLIGHT with http_client by default, so a host that is down
+    fails fast for both, the request rate of both counts towards the same per host limits, and a sync and an async
+    query for the same URL share one request
+    """
+    def __init__(self, pool_size:int=10, host_pool_sizes:dict=None, impersonate:str="chrome110", retry:retry_policy=None, breaker:circuit_breaker=None, scheduler:provider_scheduler=None, flights:single_flight=None):
+        super().__init__(pool_size, host_pool_sizes, impersonate, retry, breaker, scheduler, flights)
+        self._loops = weakref.WeakKeyDictionary() #event loop -> {"session": AsyncSession, "slots": {host: Semaphore}}
+        self._stats = {"requests": 0, "sessions_created": 0}
+
+    def _get_loop_state(self) -> dict:
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            state = {"session": requests.AsyncSession(max_clients=self.pool_size, curl_infos=curl_timing_infos()), "slots": {}}
+            self._loops[loop] = state
+            self._stats["sessions_created"] += 1
+        return state
+
+    def stats(self) -> dict:
+        """
+        Returns a copy of the request counters.
+        """
+        return dict(self._stats)
+
+    async def close(self):
+        """
+        Closes the running event loop's AsyncSession.
+        """
+        state = self._loops.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state["session"].close()
+
+    async def get(self, endpoint:str, headers:dict=None, impersonate:str=None, timeout:float=None, fresh:bool=False):
+        """
+        Runs a single GET request on the running event loop's AsyncSession.
+        Waits while the endpoint's host already has its maximum number of requests running.
+        If fresh is True the request uses a new AsyncSession (and so a new connection) that is closed afterwards.
+        """
+        state = self._get_loop_state()
+        host = urlsplit(endpoint).hostname
+        waiting = time.perf_counter()
+        slots = state["slots"].get(host)
+        if slots is None:
+            slots = asyncio.Semaphore(self.host_pool_sizes.get(host, self.pool_size))
+            state["slots"][host] = slots
+        #the scheduler slot is taken inside the pool slot, so a task cancelled while it waits for either holds neither
+        async with slots:
+            if not await self.scheduler.acquire_async(host, remaining_time()):
+                raise deadline_exceeded_error(f"Deadline exceeded while waiting to query {endpoint}.")
+            started = None
+            response = None
+            session = None
+            cancelled = False
+            try:
+                METRICS.observe("queue_wait", time.perf_counter() - waiting, host=host)
+                timeout = fit_timeout(timeout)
+                self._stats["requests"] += 1
+                session = requests.AsyncSession(max_clients=1, curl_infos=curl_timing_infos()) if fresh else state["session"]
+                started = time.monotonic()
+                response = await session.get(endpoint, headers=headers, impersonate=impersonate or self.impersonate, timeout=timeout)
+                return response
+            except asyncio.CancelledError:
+                cancelled = True #e.g a hedged lookup that lost, not a sign that the host is congested
+                raise
+            finally:
+                self.scheduler.release(host, None if cancelled else started, response.status_code if response is not None else None)
+                if started is not None:
+                    record_http_metrics(host, response, time.monotonic() - started)
+                if fresh and session is not None:
+                    await session.close()
+
+    async def query(self, endpoint:str, headers:dict=None, impersonate:str=None, fresh:bool=False):
+        """
+        asyncio version of http_client.query(), same retries, errors, fresh option and CASSETTE.
+        """
+        if CASSETTE is not None and CASSETTE.replaying:
+            return CASSETTE.replay_http(endpoint)
+        if fresh:
+            response = await self._query(endpoint, headers, impersonate, fresh=True)
+        else:
+            response = await self.flights.do_async(query_key(endpoint, headers, impersonate), self._query, endpoint, headers, impersonate)
+        if CASSETTE is not None:
+            CASSETTE.record_http(endpoint, response)
+        return response
+
+    async def _query(self, endpoint:str, headers:dict=None, impersonate:str=None, fresh:bool=False):
+        host = urlsplit(endpoint).hostname
+        with METRICS.span("query", host=host) as query_span:
+            retry = 0
+            while True:
+                timeout = self._start_attempt(endpoint, host)
+                response = None
+                try:
+                    response = await self.get(endpoint, headers=headers, impersonate=impersonate, timeout=timeout, fresh=fresh)
+                    response.raise_for_status() #check if the status isn't successful
+                    return self._attempt_succeeded(host, response)
+                except Exception as err:
+                    last_error = self._attempt_failed(endpoint, host, response, err)
+                retry += 1
+                await asyncio.sleep(self._retry_delay(endpoint, host, retry, response, last_error, query_span))
+
+ASYNC_HTTP_CLIENT = async_http_client()
+
+class mxtoolbox_auth:
+    """
+    Thread-safe provider for the MXToolbox TempAuthKey.
+    -the key is fetched once and shared across every selector, check and domain
+    -the key is only refreshed once it is older than max_age seconds, or after a lookup returned 401
+    """
+    def __init__(self, max_age:float=600):
+        self.max_age = max_age
+        self._key = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._async_locks = weakref.WeakKeyDictionary() #event loop -> asyncio.Lock
+
+    def _is_expired(self) -> bool:
+        return self._key is None or time.monotonic() - self._fetched_at >= self.max_age
+
+    def _store_key(self, temp_auth) -> str:
+        self._key = temp_auth.json()["TempAuthKey"]
+        self._fetched_at = time.monotonic()
+        return self._key
+
+    def get_key(self, query) -> str:
+        """
+        Returns the current TempAuthKey, fetching a new one with the provided query function if needed.
+        """
+        with self._lock:
+            if self._is_expired():
+                #mxtoolbox requires authentication to query their tools
+                #they do provide a free API, but you'll need an API key
+                #using this method is more user friendly as it automatically generates a temporary authentication key
+                with METRICS.span("auth_key"):
+                    temp_auth = query(f"{MXTOOLBOX_URL}/api/v1/user")
+                self._store_key(temp_auth)
+            return self._key
+
+    async def get_key_async(self, query) -> str:
+        """
+        asyncio version of get_key(), query must be a coroutine function.
+        Only one task per event loop fetches a new key, the others wait for it.
+        """
+        loop = asyncio.get_running_loop()
+        lock = self._async_locks.get(loop)
+        if lock is None:
+            lock = self._async_locks[loop] = asyncio.Lock()
+        async with lock:
+            with self._lock:
+                if not self._is_expired():
+                    return self._key
+            with METRICS.span("auth_key"):
+                temp_auth = await query(f"{MXTOOLBOX_URL}/api/v1/user")
+            with self._lock:
+                return self._store_key(temp_auth)
+
+    def invalidate(self, key:str=None):
+        """
+        Drops the current key so the next get_key() fetches a new one.
+        If a key is provided, it is only dropped if it is still the current key - this stops
+        several threads that all got a 401 with the same key from refreshing it several times.
+        """
+        with self._lock:
+            if key is None or key == self._key:
+                self._key = None
+
+MXTOOLBOX_AUTH = mxtoolbox_auth()
+
+DKIM_MAX_WORKERS = 8 #default maximum number of DKIM selectors looked up concurrently per domain
+
+class result_cache:
+    """
+    Persistent SQLite cache for provider lookups, keyed by provider, command and argument
+    e.g ("mxtoolbox", "spf", "twitch.tv") or ("easydmarc", "selectors", "twitch.tv").
+    -each command (record type) has its own TTL in seconds, see DEFAULT_TTLS
+    -the cache is size bounded, the least recently used entries are evicted once it holds more than max_entries
+    -if refresh is True cached entries are never read, but fresh results are still stored
+    -safe to share between threads
+    """
+    DEFAULT_TTLS = {"dkim": 3600, "spf": 3600, "dmarc": 3600, "selectors": 86400}
+
+    def __init__(self, path:str, ttls:dict=None, max_entries:int=100000, refresh:bool=False):
+        self.path = path
+        self.ttls = dict(self.DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS lookups ("
+            "provider TEXT, command TEXT, argument TEXT, value TEXT, stored_at REAL, accessed_at REAL, "
+            "PRIMARY KEY (provider, command, argument))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS lookups_accessed_at ON lookups (accessed_at)")
+
+    def get(self, provider:str, command:str, argument:str):
+        """
+        Returns the cached value, or None if there is no entry or it is older than the command's TTL.
+        """
+        if self.refresh:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, stored_at FROM lookups WHERE provider=? AND command=? AND argument=?",
+                (provider, command, argument.lower())
+            ).fetchone()
+            if row is None or now - row[1] >= self.ttls.get(command, 0):
+                self.misses += 1
+                METRICS.count("cache_lookups_total", cache="result", outcome="miss")
+                return None
+            self.hits += 1
+            METRICS.count("cache_lookups_total", cache="result", outcome="hit")
+            self._db.execute(
+                "UPDATE lookups SET accessed_at=? WHERE provider=? AND command=? AND argument=?",
+                (now, provider, command, argument.lower())
+            )
+        return json.loads(row[0])
+
+    def set(self, provider:str, command:str, argument:str, value):
+        """
+        Stores a JSON serialisable value.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?, ?)",
+                (provider, command, argument.lower(), json.dumps(value, separators=(",", ":")), now, now)
+            )
+            self._writes += 1
+            #counting the rows on every write is slow on big caches, so the size is only checked every 100 writes
+            if self._writes % 100 == 0:
+                self._evict()
+
+    def _evict(self):
+        count = self._db.execute("SELECT COUNT(*) FROM lookups").fetchone()[0]
+        if count > self.max_entries:
+            self._db.execute(
+                "DELETE FROM lookups WHERE rowid IN (SELECT rowid FROM lookups ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def clear(self):
+        """
+        Removes every cached entry.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM lookups")
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self._db.close()
+
+RESULT_CACHE = None #shared result_cache used by every check, None disables caching
+
+#--CASSETTE--
+class cassette_miss_error(Exception):
+    """
+    Raised in replay mode when a query isn't in the cassette.
+    """
+    pass
+
+class cassette_response:
+    """
+    Provider response replayed from a cassette, with the parts of a curl_cffi response that the checks use.
+    """
+    __slots__ = ("url", "status_code", "content", "headers")
+    reason = "OK"
+    ok = True
+
+    def __init__(self, url:str, status_code:int, content:bytes, headers:dict=None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers if headers is not None else {}
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass #only successful responses are recorded
+
+class cassette:
+    """
+    Archive of raw provider responses and DNS answers, so a scan can be recorded once and then replayed
+    offline, e.g to re-score yesterday's scan after changing a check, or to run benchmarks without the network.
+    -the archive is a JSON lines file that is only ever appended to, one line per URL (or DNS name and type) with
+    the response's metadata and its zlib compressed, base64 encoded body. The index is built when the file is opened
+    -in "record" mode every successful response is added, the first response for a URL wins and entries that are
+    already in the file are kept. Each line goes to the file in a single write as soon as it is recorded, so a
+    recording that is killed (even with SIGKILL) keeps every entry but the one being written, and that partial
+    line is dropped the next time the file is opened
+    -in "replay" mode every query is answered from the archive only, without retries, rate limits or the network.
+    A query that isn't in the archive raises cassette_miss_error
+    """
+    def __init__(self, path:str, mode:str="replay"):
+        if mode not in ("record", "replay"):
+            raise Exception(f"Cassette mode must be record or replay. - {mode}")
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        if mode == "replay" and not os.path.exists(path):
+            raise Exception(f"Cassette {path} does not exist.")
+        self._file = open(path, "rb" if self.replaying else "a+b")
+        self._lines = self._index() #entry -> (offset, length) of its line
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def _index(self) -> dict:
+        """
+        Reads the entry names and line positions of the archive.
+        A last line without a newline was cut off while it was being written, it is ignored (and removed when recording).
+        """
+        lines = {}
+        self._file.seek(0)
+        offset = 0
+        for line in self._file:
+            if not line.endswith(b"\n"):
+                if not self.replaying:
+                    self._file.truncate(offset)
+                break
+            lines.setdefault(json.loads(line)["entry"], (offset, len(line)))
+            offset += len(line)
+        return lines
+
+    @staticmethod
+    def http_entry(endpoint:str) -> str:
+        return "http/" + hashlib.sha1(endpoint.encode()).hexdigest()
+
+    @staticmethod
+    def dns_entry(name:str, rtype:str) -> str:
+        return f"dns/{rtype.upper()}/{name.rstrip('.').lower()}"
+
+    def _write(self, entry:str, metadata:dict, body:bytes):
+        line = json.dumps({"entry": entry, "metadata": metadata, "body": base64.b64encode(zlib.compress(body)).decode()}, separators=(",", ":")).encode() + b"\n"
+        with self._lock:
+            if entry in self._lines or self._file is None:
+                return
+            self._lines[entry] = None #only replayed from a cassette that is opened for replay
+            #one unbuffered write per line, processes that share the file (e.g --processes) append whole lines
+            os.write(self._file.fileno(), line)
+
+    def _read(self, entry:str, description:str) -> tuple:
+        position = self._lines.get(entry)
+        if position is None or self._file is None:
+            raise cassette_miss_error(f"{description} is not in the cassette {self.path}")
+        #pread doesn't move the shared file offset, so threads and forked processes can read at the same time
+        line = json.loads(os.pread(self._file.fileno(), position[1], position[0]))
+        METRICS.count("cassette_replays_total", kind=entry.split("/", 1)[0])
+        return line["metadata"], zlib.decompress(base64.b64decode(line["body"]))
+
+    def record_http(self, endpoint:str, response):
+        self._write(self.http_entry(endpoint), {"url": endpoint, "status": response.status_code, "content_type": response.headers.get("Content-Type")}, response.content)
+
+    def replay_http(self, endpoint:str) -> cassette_response:
+        metadata, body = self._read(self.http_entry(endpoint), endpoint)
+        return cassette_response(metadata["url"], metadata["status"], body, {"Content-Type": metadata["content_type"]} if metadata["content_type"] else None)
+
+    def record_dns(self, answer:"dns_answer"):
+        #MX tuples become lists and raw rdata bytes are stored as base64
+        records = [{"base64": base64.b64encode(record).decode()} if isinstance(record, bytes) else record for record in answer.records]
+        self._write(self.dns_entry(answer.name, answer.rtype), {"rcode": answer.rcode, "ttl": answer.ttl}, json.dumps(records).encode())
+
+    def replay_dns(self, name:str, rtype:str) -> "dns_answer":
+        metadata, body = self._read(self.dns_entry(name, rtype), f"{rtype.upper()} {name}")
+        records = []
+        for record in json.loads(body):
+            if isinstance(record, dict):
+                record = base64.b64decode(record["base64"])
+            elif isinstance(record, list):
+                record = tuple(record)
+            records.append(record)
+        return dns_answer(name.rstrip(".").lower(), rtype.upper(), metadata["rcode"], records, metadata["ttl"])
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+CASSETTE = None #shared cassette used by the HTTP clients and DNS_RESOLVER, None queries the network as usual
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "email_check", "cache.sqlite3")
+
+class dns_timeout_error(Exception):
+    """
+    Raised by dns_resolver when a DNS server does not answer a query in time.
+    """
+    pass
+
+class dns_answer:
+    """
+    The answer to a single DNS query.
+    -rcode is the DNS response code, 0 is NOERROR, 2 is SERVFAIL and 3 is NXDOMAIN
+    -records is a list of the answers of the queried type:
+        TXT - the record text (multiple strings are joined), MX - (preference, host) tuples,
+        A/AAAA - address strings, CNAME/PTR/NS - host names
+    -ttl is the lowest TTL of the answers, or the negative caching TTL from the SOA record if there are no answers
+    """
+    def __init__(self, name:str, rtype:str, rcode:int, records:list, ttl:int):
+        self.name = name
+        self.rtype = rtype
+        self.rcode = rcode
+        self.records = records
+        self.ttl = ttl
+
+    def __repr__(self):
+        return f"dns_answer({self.name!r}, {self.rtype!r}, rcode={self.rcode}, records={self.records!r}, ttl={self.ttl})"
+
+class dns_resolver:
+    """
+    Minimal stub DNS resolver that queries a recursive DNS server directly over UDP, with TCP fallback
+    for truncated answers.
+    -every query shares one UDP socket, answers are matched to their query by the DNS message ID,
+    so thousands of queries can be in flight at the same time without a thread each
+    -submit() returns a concurrent.futures.Future, resolve() waits for it and resolve_async() awaits it
+    -at most MAX_PENDING queries are in flight, submit() waits for a free message ID beyond that
+    -server defaults to the first nameserver in /etc/resolv.conf, a port can be given as "127.0.0.1:5353"
+    """
+    TYPES = {"A": 1, "NS": 2, "CNAME": 5, "SOA": 6, "PTR": 12, "MX": 15, "TXT": 16, "AAAA": 28}
+    TYPE_NAMES = {number: name for name, number in TYPES.items()}
+    MAX_PENDING = 32768 #half of the 16 bit message IDs, so a free random ID is found in a couple of tries
+
+    def __init__(self, server:str=None, timeout:float=2.0, retries:int=2):
+        if server is None:
+            server = self.system_nameserver()
+        self.server = self.parse_server(server)
+        self.timeout = timeout #seconds to wait for each try
+        self.retries = retries #number of times a query is re-sent after a timeout
+        self._socket = None
+        self._receiver = None
+        self._pending = {} #message id -> query state
+        self._lock = threading.Lock()
+        self._freed = threading.Condition(self._lock) #notified whenever a query stops being pending
+
+    @staticmethod
+    def system_nameserver() -> str:
+        """
+        Returns the first nameserver in /etc/resolv.conf, or a public resolver if there is none.
+        """
+        try:
+            with open("/etc/resolv.conf", "r") as resolv_conf:
+                for line in resolv_conf:
+                    parts = line.split()
+                    if len(parts) >= 2 and parts[0] == "nameserver":
+                        return parts[1]
+        except OSError:
+            pass
+        return "1.1.1.1"
+
+    @staticmethod
+    def parse_server(server:str) -> tuple:
+        """
+        Converts "1.1.1.1", "1.1.1.1:53", "::1" or "[::1]:53" into a (host, port) tuple.
+        """
+        if server.startswith("["):
+            host, _, port = server[1:].partition("]")
+            return host, int(port.lstrip(":") or 53)
+        if server.count(":") == 1:
+            host, port = server.split(":")
+            return host, int(port)
+        return server, 53
+
+    #--WIRE FORMAT--
+
+    def build_query(self, message_id:int, name:str, rtype:str) -> bytes:
+        header = struct.pack("!HHHHHH", message_id, 0x0100, 1, 0, 0, 1) #recursion desired, 1 question, 1 EDNS record
+        question = b""
+        for label in name.rstrip(".").split("."):
+            encoded_label = label.encode("idna") if label else b""
+            question += bytes([len(encoded_label)]) + encoded_label
+        question += b"\x00" + struct.pack("!HH", self.TYPES[rtype], 1)
+        #EDNS0 OPT record, lets the server send answers up to 1232 bytes over UDP before truncating
+        edns = b"\x00" + struct.pack("!HHIH", 41, 1232, 0, 0)
+        return header + question + edns
+
+    @staticmethod
+    def read_name(message:bytes, offset:int) -> tuple:
+        """
+        Reads a (possibly compressed) domain name, returns the name and the offset after it.
+        """
+        labels = []
+        end_offset = None
+        jumps = 0
+        while True:
+            length = message[offset]
+            if length & 0xC0 == 0xC0: #compression pointer
+                if end_offset is None:
+                    end_offset = offset + 2
+                offset = ((length & 0x3F) << 8) | message[offset + 1]
+                jumps += 1
+                if jumps > 64:
+                    raise Exception("DNS name compression loop.")
+                continue
+            offset += 1
+            if length == 0:
+                break
+            labels.append(message[offset:offset + length].decode("ascii", errors="replace"))
+            offset += length
+        return ".".join(labels), (end_offset if end_offset is not None else offset)
+
+    def parse_answer(self, message:bytes, name:str, rtype:str) -> dns_answer:
+        message_id, flags, qdcount, ancount, nscount, arcount = struct.unpack("!HHHHHH", message[:12])
+        rcode = flags & 0x000F
+        offset = 12
+        for _ in range(qdcount):
+            _, offset = self.read_name(message, offset)
+            offset += 4
+        records = []
+        ttls = []
+        negative_ttl = None
+        wanted_type = self.TYPES[rtype]
+        for section, count in (("answer", ancount), ("authority", nscount)):
+            for _ in range(count):
+                _, offset = self.read_name(message, offset)
+                record_type, record_class, ttl, rdlength = struct.unpack("!HHIH", message[offset:offset + 10])
+                offset += 10
+                rdata_offset = offset
+                offset += rdlength
+                if section == "authority":
+                    if record_type == self.TYPES["SOA"]:
+                        #negative caching TTL is the lower of the SOA TTL and its minimum field (RFC 2308)
+                        _, soa_offset = self.read_name(message, rdata_offset)
+                        _, soa_offset = self.read_name(message, soa_offset)
+                        minimum = struct.unpack("!I", message[soa_offset + 16:soa_offset + 20])[0]
+                        negative_ttl = min(ttl, minimum)
+                    continue
+                if record_type != wanted_type:
+                    continue #e.g CNAME records that lead to the answer
+                ttls.append(ttl)
+                rdata = message[rdata_offset:offset]
+                if rtype == "TXT":
+                    strings = []
+                    position = 0
+                    while position < len(rdata):
+                        length = rdata[position]
+                        strings.append(rdata[position + 1:position + 1 + length])
+                        position += 1 + length
+                    records.append(b"".join(strings).decode("utf-8", errors="replace"))
+                elif rtype == "MX":
+                    preference = struct.unpack("!H", rdata[:2])[0]
+                    records.append((preference, self.read_name(message, rdata_offset + 2)[0]))
+                elif rtype == "A":
+                    records.append(socket.inet_ntop(socket.AF_INET, rdata))
+                elif rtype == "AAAA":
+                    records.append(socket.inet_ntop(socket.AF_INET6, rdata))
+                elif rtype in ("CNAME", "PTR", "NS"):
+                    records.append(self.read_name(message, rdata_offset)[0])
+                else:
+                    records.append(rdata)
+        if ttls:
+            ttl = min(ttls)
+        else:
+            ttl = negative_ttl if negative_ttl is not None else 0
+        return dns_answer(name, rtype, rcode, records, ttl)
+
+    #--TRANSPORT--
+
+    def _ensure_socket(self):
+        #called with self._lock held
+        if self._socket is None:
+            family = socket.AF_INET6 if ":" in self.server[0] else socket.AF_INET
+            self._socket = socket.socket(family, socket.SOCK_DGRAM)
+            #bursts of answers (e.g selector discovery) can overflow the default receive buffer
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            self._socket.connect(self.server)
+            self._socket.settimeout(0.05)
+            self._receiver = threading.Thread(target=self._receive_loop, args=(self._socket,), name="dns_resolver", daemon=True)
+            self._receiver.start()
+
+    def submit(self, name:str, rtype:str="TXT") -> Future:
+        """
+        Sends a query and returns a Future that resolves to a dns_answer.
+        Answers are recorded in, or replayed from, the shared CASSETTE if there is one.
+        """
+        rtype = rtype.upper()
+        future = Future()
+        if CASSETTE is not None and CASSETTE.replaying:
+            try:
+                future.set_result(CASSETTE.replay_dns(name, rtype))
+            except cassette_miss_error as err:
+                future.set_exception(err)
+            return future
+        if CASSETTE is not None:
+            future.add_done_callback(self._record_answer)
+        error = None
+        with self._lock:
+            self._ensure_socket()
+            #every pending query is answered or has timed out within timeout * (retries + 1) seconds
+            if not self._freed.wait_for(lambda: len(self._pending) < self.MAX_PENDING, self.timeout * (self.retries + 1)):
+                error = dns_timeout_error(f"DNS query for {name} {rtype} timed out waiting for one of {self.MAX_PENDING} queries in flight.")
+            else:
+                message_id = random.getrandbits(16)
+                while message_id in self._pending:
+                    message_id = random.getrandbits(16)
+                packet = self.build_query(message_id, name, rtype)
+                METRICS.count("dns_queries_total", type=rtype)
+                self._pending[message_id] = {
+                    "future": future, "packet": packet, "name": name.rstrip(".").lower(), "rtype": rtype,
+                    "deadline": time.monotonic() + self.timeout, "tries": 1
+                }
+                try:
+                    self._socket.send(packet)
+                except OSError as err:
+                    #e.g ENOBUFS during a burst, the query is lost like a dropped packet and can be retried later
+                    del self._pending[message_id]
+                    self._freed.notify()
+                    error = dns_timeout_error(f"DNS query for {name} {rtype} could not be sent. - {err}")
+        #set outside the lock, the future's callbacks may submit more queries
+        if error is not None:
+            future.set_exception(error)
+        return future
+
+    @staticmethod
+    def _record_answer(future:Future):
+        if CASSETTE is not None and not future.cancelled() and future.exception() is None:
+            CASSETTE.record_dns(future.result())
+
+    def resolve(self, name:str, rtype:str="TXT") -> dns_answer:
+        """
+        Resolves a single name and waits for the answer.
+        """
+        return self.submit(name, rtype).result()
+
+    async def resolve_async(self, name:str, rtype:str="TXT") -> dns_answer:
+        """
+        asyncio version of resolve(), the answer is still received on the shared socket.
+        """
+        return await asyncio.wrap_future(self.submit(name, rtype))
+
+    def _receive_loop(self, dns_socket):
+        while self._socket is dns_socket: #stops once the resolver is closed
+            try:
+                message = dns_socket.recv(65535)
+            except socket.timeout:
+                message = None
+            except OSError:
+                message = None
+            if message is not None and len(message) >= 12:
+                self._handle_message(message)
+            self._check_timeouts(dns_socket)
+
+    def _handle_message(self, message:bytes):
+        message_id, flags = struct.unpack("!HH", message[:4])
+        with self._lock:
+            query = self._pending.get(message_id)
+            if query is None:
+                return
+            try:
+                question_name = self.read_name(message, 12)[0].lower()
+            except Exception:
+                return
+            if question_name != query["name"]:
+                return #not the answer to this query, keep waiting
+            del self._pending[message_id]
+            self._freed.notify()
+        if flags & 0x0200: #truncated, ask again over TCP
+            threading.Thread(target=self._resolve_tcp, args=(query,), daemon=True).start()
+            return
+        try:
+            query["future"].set_result(self.parse_answer(message, query["name"], query["rtype"]))
+        except Exception as err:
+            query["future"].set_exception(Exception(f"Failed to parse DNS answer for {query['name']} with error: {err}"))
+
+    def _check_timeouts(self, dns_socket):
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for message_id, query in list(self._pending.items()):
+                if query["deadline"] > now:
+                    continue
+                if query["tries"] <= self.retries:
+                    query["tries"] += 1
+                    query["deadline"] = now + self.timeout
+                    try:
+                        dns_socket.send(query["packet"])
+                    except OSError:
+                        pass
+                else:
+                    expired.append(self._pending.pop(message_id))
+                    self._freed.notify()
+        for query in expired:
+            query["future"].set_exception(dns_timeout_error(f"DNS query for {query['name']} {query['rtype']} timed out."))
+
+    def _resolve_tcp(self, query:dict):
+        try:
+            family = socket.AF_INET6 if ":" in self.server[0] else socket.AF_INET
+            with socket.socket(family, socket.SOCK_STREAM) as tcp_socket:
+                tcp_socket.settimeout(self.timeout)
+                tcp_socket.connect(self.server)
+                tcp_socket.sendall(struct.pack("!H", len(query["packet"])) + query["packet"])
+                length = struct.unpack("!H", self._recv_exactly(tcp_socket, 2))[0]
+                message = self._recv_exactly(tcp_socket, length)
+            query["future"].set_result(self.parse_answer(message, query["name"], query["rtype"]))
+        except socket.timeout:
+            query["future"].set_exception(dns_timeout_error(f"DNS query for {query['name']} {query['rtype']} timed out over TCP."))
+        except Exception as err:
+            query["future"].set_exception(Exception(f"DNS query for {query['name']} failed over TCP with error: {err}"))
+
+    @staticmethod
+    def _recv_exactly(tcp_socket, length:int) -> bytes:
+        data = b""
+        while len(data) < length:
+            chunk = tcp_socket.recv(length - len(data))
+            if not chunk:
+                raise Exception("DNS server closed the TCP connection.")
+            data += chunk
+        return data
+
+    def close(self):
+        """
+        Closes the shared socket, queries that are still in flight fail.
+        """
+        with self._lock:
+            dns_socket, self._socket = self._socket, None
+            pending, self._pending = self._pending, {}
+            self._freed.notify_all()
+        if dns_socket is not None:
+            dns_socket.close()
+        for query in pending.values():
+            query["future"].set_exception(Exception("DNS resolver was closed."))
+
+DNS_RESOLVER = dns_resolver() #shared resolver, the socket is only opened on the first query
+
+def mxtoolbox_lookup(query, command:str, argument:str, auth:mxtoolbox_auth=None) -> dict:
+    """
+    Runs an MXToolbox lookup (dkim, spf, dmarc...) and returns the JSON response.
+    -uses the shared TempAuthKey provider, so no auth request is made if the key is still valid
+    -if MXToolbox returns 401 the key is refreshed and the lookup is retried once
+    """
+    if auth is None:
+        auth = MXTOOLBOX_AUTH
+    lookup_url = f"{MXTOOLBOX_URL}/api/v1/lookup?command={command}&argument={argument}&resultIndex=1&disableRhsbl=true&format=0"
+    for attempt in range(2):
+        temp_auth_key = auth.get_key(query)
+        mxtoolbox_headers = {
+            "Tempauthorization": temp_auth_key,
+            "User-Agent": MXTOOLBOX_USER_AGENT
+        }
+        try:
+            response = query(lookup_url, headers=mxtoolbox_headers)
+        except unauthorized_error:
+            auth.invalidate(temp_auth_key)
+            if attempt == 1:
+                raise
+            continue
+        return response.json()
+
+async def mxtoolbox_lookup_async(query, command:str, argument:str, auth:mxtoolbox_auth=None) -> dict:
+    """
+    asyncio version of mxtoolbox_lookup(), query must be a coroutine function.
+    """
+    if auth is None:
+        auth = MXTOOLBOX_AUTH
+    lookup_url = f"{MXTOOLBOX_URL}/api/v1/lookup?command={command}&argument={argument}&resultIndex=1&disableRhsbl=true&format=0"
+    for attempt in range(2):
+        temp_auth_key = await auth.get_key_async(query)
+        mxtoolbox_headers = {
+            "Tempauthorization": temp_auth_key,
+            "User-Agent": MXTOOLBOX_USER_AGENT
+        }
+        try:
+            response = await query(lookup_url, headers=mxtoolbox_headers)
+        except unauthorized_error:
+            auth.invalidate(temp_auth_key)
+            if attempt == 1:
+                raise
+            continue
+        return response.json()
+
+class spf_node:
+    """
+    A single SPF record in an expanded include tree, see spf_resolver.
+    -lookups and void_lookups include every child of the record
+    -errors contains the problems found in the record and all of its children
+    -failed_lookups contains the (description, exception) of every lookup in the tree that timed out or failed,
+    these leave the result unknown instead of failing it
+    """
+    def __init__(self, domain:str):
+        self.domain = domain
+        self.answer = None #dns_answer of the domain's TXT lookup
+        self.exception = None #set if the TXT lookup itself failed, e.g a dns_timeout_error
+        self.record = None #the v=spf1 record, None if the domain doesn't publish one
+        self.lookups = 0 #DNS lookups counted against the RFC 7208 limit of 10
+        self.void_lookups = 0 #lookups that returned no answers, counted against the limit of 2
+        self.children = [] #spf_node of every include: and redirect=
+        self.errors = []
+        self.failed_lookups = []
+        self.loop = False #True if the record or one of its children includes itself
+        self.complete = True #False if any lookup in the tree failed, incomplete trees are not memoized
+        self.expires = 0.0 #time.monotonic() after which the tree has to be expanded again
+
+    def __repr__(self):
+        return f"spf_node({self.domain!r}, lookups={self.lookups}, void_lookups={self.void_lookups}, children={len(self.children)})"
+
+class spf_resolver:
+    """
+    Expands SPF records locally, following include:, redirect=, a, mx, ptr and exists terms and counting
+    the DNS lookups against the RFC 7208 limits (10 lookups, 2 void lookups), and flags include loops.
+
+    -every expanded subtree is memoized and shared between domains, so popular includes like
+    _spf.google.com or amazonses.com are only resolved once per TTL no matter how many domains include them
+    -the tree is fetched level by level and every query of a level is sent at the same time on the shared resolver
+    -DNS answers are kept for their TTL, limited to between min_ttl and max_ttl seconds
+    -at most max_entries DNS answers and max_entries trees are kept, the least recently used are dropped first
+    and expired ones are dropped when they are next looked up, so long running serve/monitor processes don't grow forever
+    """
+    LOOKUP_LIMIT = 10
+    VOID_LOOKUP_LIMIT = 2
+    MX_LIMIT = 10
+    LOOKUP_TERMS = ("include", "a", "mx", "ptr", "exists", "redirect")
+
+    def __init__(self, resolver:dns_resolver=None, min_ttl:float=60, max_ttl:float=3600, max_entries:int=100000):
+        self._resolver = resolver
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.max_entries = max_entries
+        self._answers = collections.OrderedDict() #(name, type) -> (Future, expires), least recently used first
+        self._nodes = collections.OrderedDict() #domain -> memoized spf_node, least recently used first
+        self._lock = threading.Lock()
+        self.stats = {"queries": 0, "nodes_built": 0, "memo_hits": 0}
+
+    @property
+    def resolver(self) -> dns_resolver:
+        return self._resolver if self._resolver is not None else DNS_RESOLVER
+
+    @staticmethod
+    def parse_terms(record:str) -> list:
+        """
+        Splits an SPF record into (qualifier, name, value, is_modifier, term) tuples, e.g
+        "-all" -> ("-", "all", "", False, "-all")
+        "include:_spf.google.com" -> ("+", "include", "_spf.google.com", False, "include:_spf.google.com")
+        "redirect=_spf.example.com" -> ("+", "redirect", "_spf.example.com", True, "redirect=_spf.example.com")
+        """
+        terms = []
+        for term in record.split()[1:]:
+            qualifier = term[0] if term[0] in "+-~?" else "+"
+            term_body = term.lstrip("+-~?")
+            modifier = re.fullmatch(r"([A-Za-z][A-Za-z0-9_.-]*)=(.*)", term_body)
+            if modifier:
+                terms.append((qualifier, modifier.group(1).lower(), modifier.group(2), True, term))
+                continue
+            name, _, value = term_body.partition(":")
+            #a/24 and mx:example.com/24 have a CIDR length that isn't part of the name
+            terms.append((qualifier, name.split("/")[0].lower(), value.split("/")[0], False, term))
+        return terms
+
+    @staticmethod
+    def spf_records(answer:dns_answer) -> list:
+        return [record for record in answer.records if record.lower().startswith("v=spf1")]
+
+    #--DNS ANSWERS--
+
+    def _answer_future(self, name:str, rtype:str) -> Future:
+        key = (name.lower(), rtype)
+        with self._lock:
+            cached = self._answers.get(key)
+            if cached is not None and (not cached[0].done() or cached[1] > time.monotonic()):
+                self._answers.move_to_end(key)
+                return cached[0]
+            future = self.resolver.submit(name, rtype)
+            self.stats["queries"] += 1
+            #the expiry is only known once the answer arrives, until then the future is shared with everyone
+            self._answers.pop(key, None)
+            self._answers[key] = (future, float("inf"))
+            self._trim(self._answers)
+        future.add_done_callback(lambda done: self._set_expiry(key, done))
+        return future
+
+    def _set_expiry(self, key:tuple, future:Future):
+        if future.exception() is None:
+            ttl = min(max(future.result().ttl, self.min_ttl), self.max_ttl)
+        else:
+            ttl = 0 #failed lookups are retried straight away
+        with self._lock:
+            if key in self._answers and self._answers[key][0] is future:
+                self._answers[key] = (future, time.monotonic() + ttl)
+
+    def _answer(self, name:str, rtype:str):
+        """
+        Returns the dns_answer for a name, or the exception the lookup failed with.
+        """
+        try:
+            return self._answer_future(name, rtype).result()
+        except Exception as err:
+            return err
+
+    def _answer_expiry(self, name:str, rtype:str) -> float:
+        key = (name.lower(), rtype)
+        with self._lock:
+            cached = self._answers.get(key)
+        if cached is None:
+            return 0.0
+        if cached[1] == float("inf") and cached[0].done():
+            #the answer arrived but its done callback hasn't run yet
+            self._set_expiry(key, cached[0])
+            with self._lock:
+                cached = self._answers.get(key, cached)
+        return cached[1]
+
+    #--PREFETCHING--
+
+    def _memoized(self, domain:str, count:bool=False) -> spf_node:
+        with self._lock:
+            node = self._nodes.get(domain)
+            if node is None:
+                return None
+            if node.expires <= time.monotonic():
+                del self._nodes[domain]
+                return None
+            self._nodes.move_to_end(domain)
+            if count:
+                self.stats["memo_hits"] += 1
+            return node
+
+    def _follow_ups(self, requests_:list, seen:set) -> list:
+        """
+        Returns the DNS queries needed for the next level of the tree, from the answers of this level.
+        """
+        follow_ups = []
+        for name, rtype in requests_:
+            if rtype != "TXT":
+                continue
+            answer = self._answer(name, rtype)
+            if isinstance(answer, Exception):
+                continue
+            records = self.spf_records(answer)
+            if not records:
+                continue
+            for qualifier, term_name, value, is_modifier, term in self.parse_terms(records[0]):
+                target = (value or name).lower()
+                if "%" in target:
+                    continue #macros can only be expanded for a specific sender
+                if term_name in ("include", "redirect") and (is_modifier or term_name == "include"):
+                    if self._memoized(target) is not None:
+                        continue #the whole subtree is already known
+                    request = (target, "TXT")
+                elif term_name == "a" and not is_modifier:
+                    request = (target, "A")
+                elif term_name == "mx" and not is_modifier:
+                    request = (target, "MX")
+                else:
+                    continue
+                if request not in seen:
+                    seen.add(request)
+                    follow_ups.append(request)
+        return follow_ups
+
+    @METRICS.timed("spf_expand")
+    def expand(self, domain:str) -> spf_node:
+        """
+        Returns the expanded SPF tree of a domain.
+        """
+        domain = domain.lower().rstrip(".")
+        node = self._memoized(domain, count=True)
+        if node is not None:
+            return node
+        requests_ = [(domain, "TXT")]
+        seen = set(requests_)
+        while requests_:
+            wait([self._answer_future(name, rtype) for name, rtype in requests_])
+            requests_ = self._follow_ups(requests_, seen)
+        return self._build(domain, ())
+
+    @METRICS.timed("spf_expand")
+    async def expand_async(self, domain:str) -> spf_node:
+        """
+        asyncio version of expand().
+        """
+        domain = domain.lower().rstrip(".")
+        node = self._memoized(domain, count=True)
+        if node is not None:
+            return node
+        requests_ = [(domain, "TXT")]
+        seen = set(requests_)
+        while requests_:
+            futures = [asyncio.wrap_future(self._answer_future(name, rtype)) for name, rtype in requests_]
+            await asyncio.gather(*futures, return_exceptions=True)
+            requests_ = self._follow_ups(requests_, seen)
+        return self._build(domain, ())
+
+    #--TREE--
+
+    def _build(self, domain:str, stack:tuple) -> spf_node:
+        node = self._memoized(domain, count=True)
+        if node is not None:
+            return node
+        node = spf_node(domain)
+        answer = self._answer(domain, "TXT")
+        if isinstance(answer, Exception):
+            node.exception = answer
+            node.complete = False
+            node.failed_lookups.append((f"Lookup of {domain} failed: {answer}", answer))
+            return node
+        node.answer = answer
+        expires = self._answer_expiry(domain, "TXT")
+        records = self.spf_records(answer)
+        if not records:
+            node.expires = expires
+            self._memoize(node)
+            return node
+        node.record = records[0]
+        with self._lock:
+            self.stats["nodes_built"] += 1
+
+        for qualifier, term_name, value, is_modifier, term in self.parse_terms(node.record):
+            if term_name not in self.LOOKUP_TERMS or (is_modifier and term_name != "redirect"):
+                continue
+            node.lookups += 1
+            target = (value or domain).lower()
+            if "%" in target:
+                continue
+            if term_name in ("include", "redirect"):
+                if target in stack or target == domain:
+                    node.loop = True
+                    node.errors.append(f"Include loop: {' -> '.join(stack + (domain, target))}")
+                    continue
+                child = self._build(target, stack + (domain,))
+                node.children.append(child)
+                if child.record is None and child.answer is not None:
+                    if child.answer.rcode == 3 or not child.answer.records:
+                        node.void_lookups += 1
+                    node.errors.append(f"{term_name} {target} does not have an SPF record")
+                node.lookups += child.lookups
+                node.void_lookups += child.void_lookups
+                node.loop = node.loop or child.loop
+                node.complete = node.complete and child.complete
+                node.errors.extend(child.errors)
+                node.failed_lookups.extend(child.failed_lookups)
+                expires = min(expires, child.expires)
+            elif term_name in ("a", "mx"):
+                rtype = "A" if term_name == "a" else "MX"
+                term_answer = self._answer(target, rtype)
+                if isinstance(term_answer, Exception):
+                    node.complete = False
+                    node.failed_lookups.append((f"Lookup of {target} {rtype} failed: {term_answer}", term_answer))
+                    continue
+                expires = min(expires, self._answer_expiry(target, rtype))
+                if not term_answer.records:
+                    node.void_lookups += 1
+                elif term_name == "mx" and len(term_answer.records) > self.MX_LIMIT:
+                    node.errors.append(f"mx {target} has more than {self.MX_LIMIT} MX records")
+            #ptr and exists depend on the sending IP, so they are only counted
+
+        node.expires = expires
+        #trees with loops depend on where the expansion started, so only complete, loop free trees are shared
+        if node.complete and not node.loop:
+            self._memoize(node)
+        return node
+
+    def _memoize(self, node:spf_node):
+        with self._lock:
+            self._nodes.pop(node.domain, None)
+            self._nodes[node.domain] = node
+            self._trim(self._nodes)
+
+    def _trim(self, entries:collections.OrderedDict):
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Forgets every memoized tree and DNS answer.
+        """
+        with self._lock:
+            self._answers = collections.OrderedDict()
+            self._nodes = collections.OrderedDict()
+
+SPF_RESOLVER = spf_resolver() #shared between every domain, uses DNS_RESOLVER
+
+COMMON_DKIM_SELECTORS = (
+    #generic
+    "default", "dkim", "dkim1", "dkim2", "dk", "mail", "mail1", "mail2", "email", "smtp", "mx", "key1", "key2",
+    "selector", "selector1", "selector2", "selector3", "sel1", "sel2", "s", "s1", "s2", "s3", "s1024", "s2048",
+    "k1", "k2", "k3", "m1", "m2", "x", "main", "primary", "secondary", "test", "mta", "mailer", "outbound",
+    "news", "newsletter", "marketing", "bulk", "transactional", "notify", "alerts", "info", "a1", "a2",
+    #google workspace and microsoft 365
+    "google", "google2048", "20161025", "20210112", "20221208", "20230601",
+    #email service providers
+    "mandrill", "mte1", "mte2", "mailjet", "mailchimp", "sendgrid", "smtpapi", "em", "mxvault", "mailgun",
+    "krs", "pic", "mailo", "pm", "pm2", "postmark", "sparkpost", "scph0316", "scph1016", "amazonses", "ses",
+    "sib", "brevo1", "brevo2", "mlsend", "mlsend2", "kl", "kl2", "ctct1", "ctct2", "cm", "createsend",
+    "everlytickey1", "everlytickey2", "eversrv", "hs1", "hs2", "hubspot", "mcsv", "sailthru", "sm", "smtpcom",
+    "turbo-smtp", "elastic", "api", "resend", "cf2024-1", "qualtrics", "spop1024", "neolane", "fishbowl",
+    "exacttarget", "et", "iterable", "braze", "customerio", "cio", "intercom", "helpscout", "freshdesk", "fd", "fd2",
+    #helpdesks, mailbox providers and hosting
+    "zendesk1", "zendesk2", "zoho", "zmail", "protonmail", "protonmail2", "protonmail3", "fm1", "fm2", "fm3",
+    "mesmtp", "yandex", "mail-in", "dkim-mail", "ovh", "gandi", "titan", "titan1", "mailbox", "rackspace",
+    "proofpoint", "mimecast", "mimecast20190104", "ppe", "pp", "bfi", "dyn", "mail-dkim", "mailsec", "securemail",
+    "beta", "gamma", "alpha", "v1", "v2", "2020", "2021", "2022", "2023", "2024", "2025",
+)
+
+class selector_discovery:
+    """
+    Finds the DKIM selectors of a domain by probing a wordlist of common selectors over DNS,
+    instead of scraping EasyDMARC.
+    -every probe is sent at the same time on the shared resolver socket, and the discovery is finished
+    as soon as every selector in the wordlist has been answered
+    -selectors that don't exist are remembered in a negative cache for negative_ttl seconds
+    (or the domain's negative caching TTL if it is shorter), so repeat scans only probe new names
+    -at most max_entries missing selectors are remembered, the least recently used are dropped first
+    -wordlist defaults to COMMON_DKIM_SELECTORS, extra selectors can be added per discovery
+    """
+    def __init__(self, resolver:dns_resolver=None, wordlist:list=None, negative_ttl:float=3600, max_entries:int=100000):
+        self._resolver = resolver
+        self.wordlist = list(wordlist) if wordlist is not None else list(COMMON_DKIM_SELECTORS)
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._negative = collections.OrderedDict() #(domain, selector) -> expires, least recently used first
+        self._lock = threading.Lock()
+
+    @property
+    def resolver(self) -> dns_resolver:
+        return self._resolver if self._resolver is not None else DNS_RESOLVER
+
+    def candidates(self, domain:str, extra_selectors:list=None) -> list:
+        """
+        Returns the selectors that still have to be probed for a domain, without duplicates
+        and without the selectors that are in the negative cache.
+        """
+        now = time.monotonic()
+        candidates = []
+        seen = set()
+        with self._lock:
+            for selector in self.wordlist + list(extra_selectors or []):
+                selector = selector.strip().lower()
+                if not selector or selector in seen:
+                    continue
+                seen.add(selector)
+                expires = self._negative.get((domain, selector))
+                if expires is not None:
+                    if expires > now:
+                        self._negative.move_to_end((domain, selector))
+                        continue
+                    del self._negative[(domain, selector)]
+                candidates.append(selector)
+        return candidates
+
+    def record_answer(self, domain:str, selector:str, future:Future) -> bool:
+        """
+        Returns True if a probe found a DKIM record, and stores missing selectors in the negative cache.
+        Failed probes (e.g timeouts) are not cached.
+        """
+        try:
+            answer = future.result()
+        except Exception:
+            return False
+        if any("p=" in record or record.lower().startswith("v=dkim1") for record in answer.records):
+            return True
+        if answer.rcode in (0, 3):
+            ttl = min(self.negative_ttl, answer.ttl) if answer.ttl else self.negative_ttl
+            with self._lock:
+                self._negative.pop((domain, selector), None)
+                self._negative[(domain, selector)] = time.monotonic() + ttl
+                while len(self._negative) > self.max_entries:
+                    self._negative.popitem(last=False)
+        return False
+
+    @METRICS.timed("dns_discovery")
+    def discover(self, domain:str, extra_selectors:list=None) -> list:
+        """
+        Returns the names of the selectors that have a DKIM record, in wordlist order.
+        """
+        probes = [(selector, self.resolver.submit(f"{selector}._domainkey.{domain}", "TXT")) for selector in self.candidates(domain, extra_selectors)]
+        wait([future for selector, future in probes])
+        return [selector for selector, future in probes if self.record_answer(domain, selector, future)]
+
+    @METRICS.timed("dns_discovery")
+    async def discover_async(self, domain:str, extra_selectors:list=None) -> list:
+        """
+        asyncio version of discover().
+        """
+        probes = [(selector, self.resolver.submit(f"{selector}._domainkey.{domain}", "TXT")) for selector in self.candidates(domain, extra_selectors)]
+        await asyncio.gather(*[asyncio.wrap_future(future) for selector, future in probes], return_exceptions=True)
+        return [selector for selector, future in probes if self.record_answer(domain, selector, future)]
+
+    def clear(self):
+        """
+        Forgets every cached missing selector.
+        """
+        with self._lock:
+            self._negative = collections.OrderedDict()
+
+SELECTOR_DISCOVERY = selector_discovery()
+DISCOVERY = "easydmarc" #how selectors are found when none are given: "easydmarc", "dns" or "both"
+
+class mx_host_checker:
+    """
+    Checks the mail hosts that MX records point to, see mx_check.
+    -the A and AAAA records of a host are resolved at the same time, on the shared resolver's socket
+    -if starttls is True, the host is also probed on port 25: its SMTP banner is read and EHLO is sent to see if
+    STARTTLS is offered, every step with a strict timeout. Probes are skipped while a CASSETTE is replayed
+    -results are cached per host for the TTL of its address records (between min_ttl and max_ttl seconds), as
+    thousands of domains share the same mail hosts (e.g Google or Microsoft), and identical hosts checked at the
+    same time share one check (SINGLE_FLIGHT)
+    -each result is a dictionary {"host", "addresses", "ipv6", "starttls", "banner", "error"} where starttls is
+    None if the host wasn't probed, results are shared between domains and must not be modified
+    -check_hosts() only needs threads for the STARTTLS probes, they run on at most max_workers threads shared by
+    every domain. Without probes, the lookups of every host are sent at once on the resolver socket
+    """
+    def __init__(self, resolver:dns_resolver=None, timeout:float=5.0, port:int=25, helo_name:str=None, min_ttl:float=60, max_ttl:float=3600, max_entries:int=10000, max_workers:int=32):
+        self._resolver = resolver
+        self.timeout = timeout
+        self.port = port
+        self._helo_name = helo_name
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.max_entries = max_entries
+        self.max_workers = max_workers
+        self._cache = collections.OrderedDict() #(host, starttls) -> (expires, result), oldest first
+        self._executor = None #shared by the sync STARTTLS probes, created on the first one
+        self._lock = threading.Lock()
+
+    @property
+    def resolver(self) -> dns_resolver:
+        return self._resolver if self._resolver is not None else DNS_RESOLVER
+
+    @property
+    def helo_name(self) -> str:
+        #looked up on the first probe, getfqdn() can be a slow reverse DNS lookup
+        if self._helo_name is None:
+            self._helo_name = socket.getfqdn() or "localhost"
+        return self._helo_name
+
+    def _get_cached(self, host:str, starttls:bool) -> dict|None:
+        with self._lock:
+            cached = self._cache.get((host, starttls))
+            if cached is None:
+                cached = self._cache.get((host, True)) if not starttls else None #a probed host also has its addresses
+            if cached is None or cached[0] <= time.monotonic():
+                METRICS.count("cache_lookups_total", cache="mx_hosts", outcome="miss")
+                return None
+        METRICS.count("cache_lookups_total", cache="mx_hosts", outcome="hit")
+        return cached[1]
+
+    def _set_cached(self, host:str, starttls:bool, result:dict, ttl:float):
+        with self._lock:
+            self._cache.pop((host, starttls), None)
+            self._cache[(host, starttls)] = (time.monotonic() + min(max(ttl, self.min_ttl), self.max_ttl), result)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                #threads are only started as needed, up to max_workers
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="mx_probe")
+                atexit.register(self.close)
+            return self._executor
+
+    def close(self):
+        """
+        Stops the STARTTLS probe threads, probes that haven't started yet are cancelled.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def check(self, host:str, starttls:bool=False) -> dict:
+        """
+        Returns the result of one mail host, from the cache if it is still valid.
+        """
+        host = host.rstrip(".").lower()
+        cached = self._get_cached(host, starttls)
+        if cached is not None:
+            return cached
+        return SINGLE_FLIGHT.do(("mx_host", host, starttls), self._check, host, starttls)
+
+    async def check_async(self, host:str, starttls:bool=False) -> dict:
+        """
+        asyncio version of check().
+        """
+        host = host.rstrip(".").lower()
+        cached = self._get_cached(host, starttls)
+        if cached is not None:
+            return cached
+        return await SINGLE_FLIGHT.do_async(("mx_host", host, starttls), self._check_async, host, starttls)
+
+    def check_hosts(self, hosts:list, starttls:bool=False) -> dict:
+        """
+        Checks several mail hosts at the same time, returns {host: result}.
+        """
+        results = {}
+        missing = []
+        for host in hosts:
+            cached = self._get_cached(host.rstrip(".").lower(), starttls)
+            if cached is not None:
+                results[host] = cached
+            else:
+                missing.append(host)
+        if len(missing) == 1:
+            results[missing[0]] = self.check(missing[0], starttls)
+        elif missing and not starttls:
+            #the queries of every host are in flight at the same time, without a thread each
+            lookups = {host: self._submit_lookups(host.rstrip(".").lower()) for host in missing}
+            for host, futures in lookups.items():
+                results[host] = self._finish_check(host.rstrip(".").lower(), False, futures)
+        elif missing:
+            #the probes block on their sockets, they run on the shared threads
+            executor = self._get_executor()
+            futures = {host: context_submit(executor, self.check, host, starttls) for host in missing}
+            for host, future in futures.items():
+                results[host] = future.result()
+        return results
+
+    async def check_hosts_async(self, hosts:list, starttls:bool=False) -> dict:
+        """
+        asyncio version of check_hosts().
+        """
+        return dict(zip(hosts, await asyncio.gather(*[self.check_async(host, starttls) for host in hosts])))
+
+    def _new_result(self, host:str, answers:dict) -> tuple:
+        #returns (result, ttl) from the A and AAAA answers (or exceptions)
+        result = {"host": host, "addresses": [], "ipv6": [], "starttls": None, "banner": None, "error": None, "timed_out": False}
+        ttls = []
+        for rtype, key in (("A", "addresses"), ("AAAA", "ipv6")):
+            answer = answers[rtype]
+            if isinstance(answer, Exception):
+                result["error"] = str(answer)
+                result["timed_out"] = isinstance(answer, dns_timeout_error)
+                continue
+            if answer.rcode not in (0, 3):
+                result["error"] = f"DNS server returned response code {answer.rcode} for {rtype} {host}"
+                continue
+            result[key] = answer.records
+            ttls.append(answer.ttl)
+        #a lookup error is only kept for a short time, the addresses for their TTL
+        return result, (min(ttls) if ttls and result["error"] is None else 0)
+
+    def _check(self, host:str, starttls:bool) -> dict:
+        return self._finish_check(host, starttls, self._submit_lookups(host))
+
+    def _submit_lookups(self, host:str) -> dict:
+        return {rtype: self.resolver.submit(host, rtype) for rtype in ("A", "AAAA")}
+
+    def _finish_check(self, host:str, starttls:bool, futures:dict) -> dict:
+        #waits for the A and AAAA answers, probes the host if needed and caches the result
+        answers = {}
+        for rtype, future in futures.items():
+            try:
+                answers[rtype] = future.result()
+            except dns_timeout_error as err:
+                answers[rtype] = err
+        result, ttl = self._new_result(host, answers)
+        if starttls and (result["addresses"] or result["ipv6"]) and not (CASSETTE is not None and CASSETTE.replaying):
+            address = (result["addresses"] or result["ipv6"])[0]
+            with METRICS.span("starttls_probe"):
+                try:
+                    result["starttls"], result["banner"] = self.probe_starttls(address)
+                except (OSError, ValueError) as err:
+                    result["error"] = f"STARTTLS probe of {address} failed - {err or type(err).__name__}"
+        self._set_cached(host, starttls, result, ttl)
+        return result
+
+    async def _check_async(self, host:str, starttls:bool) -> dict:
+        answers = {}
+        for rtype, answer in zip(("A", "AAAA"), await asyncio.gather(self.resolver.resolve_async(host, "A"), self.resolver.resolve_async(host, "AAAA"), return_exceptions=True)):
+            if isinstance(answer, Exception) and not isinstance(answer, dns_timeout_error):
+                raise answer
+            answers[rtype] = answer
+        result, ttl = self._new_result(host, answers)
+        if starttls and (result["addresses"] or result["ipv6"]) and not (CASSETTE is not None and CASSETTE.replaying):
+            address = (result["addresses"] or result["ipv6"])[0]
+            with METRICS.span("starttls_probe"):
+                try:
+                    result["starttls"], result["banner"] = await self.probe_starttls_async(address)
+                except (OSError, ValueError, asyncio.TimeoutError) as err:
+                    result["error"] = f"STARTTLS probe of {address} failed - {err or type(err).__name__}"
+        self._set_cached(host, starttls, result, ttl)
+        return result
+
+    @staticmethod
+    def reply_code(lines:list) -> int:
+        """
+        Returns the code of an SMTP reply, raises ValueError if it isn't a valid reply.
+        """
+        if not lines or not lines[0][:3].isdigit():
+            raise ValueError(f"invalid SMTP reply {lines[:1]!r}")
+        return int(lines[0][:3])
+
+    @staticmethod
+    def offers_starttls(ehlo_lines:list) -> bool:
+        #the first line is the greeting, each following line is one extension keyword
+        return any(line[4:].strip().upper().split(" ")[0] == "STARTTLS" for line in ehlo_lines[1:])
+
+    def probe_starttls(self, address:str) -> tuple:
+        """
+        Connects to a mail server, returns (STARTTLS is offered, banner).
+        """
+        timeout = fit_timeout(self.timeout)
+        with socket.create_connection((address, self.port), timeout=timeout) as connection:
+            reader = connection.makefile("rb")
+
+            def read_reply() -> list:
+                lines = []
+                while len(lines) < 100:
+                    line = reader.readline(1024).decode("utf-8", errors="replace").rstrip("\r\n")
+                    lines.append(line)
+                    if line[3:4] != "-": #the last line of a reply has a space after its code
+                        break
+                return lines
+
+            banner = read_reply()
+            if self.reply_code(banner) != 220:
+                return False, banner[0]
+            connection.sendall(f"EHLO {self.helo_name}\r\n".encode())
+            ehlo = read_reply()
+            connection.sendall(b"QUIT\r\n")
+        return self.reply_code(ehlo) == 250 and self.offers_starttls(ehlo), banner[0]
+
+    async def probe_starttls_async(self, address:str) -> tuple:
+        """
+        asyncio version of probe_starttls().
+        """
+        timeout = fit_timeout(self.timeout)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(address, self.port), timeout)
+        try:
+            async def read_reply() -> list:
+                lines = []
+                while len(lines) < 100:
+                    line = (await asyncio.wait_for(reader.readline(), timeout)).decode("utf-8", errors="replace").rstrip("\r\n")
+                    lines.append(line)
+                    if line[3:4] != "-":
+                        break
+                return lines
+
+            banner = await read_reply()
+            if self.reply_code(banner) != 220:
+                return False, banner[0]
+            writer.write(f"EHLO {self.helo_name}\r\n".encode())
+            ehlo = await read_reply()
+            writer.write(b"QUIT\r\n")
+            return self.reply_code(ehlo) == 250 and self.offers_starttls(ehlo), banner[0]
+        finally:
+            writer.close()
+
+MX_HOSTS = mx_host_checker() #shared by every mx_check, so each mail host is only checked once per TTL
+MX_STARTTLS = False #whether mx_check probes the mail hosts for STARTTLS when it isn't told
+
+class lookup_backend:
+    """
+    Base class for the providers that the check classes get their DKIM, SPF and DMARC results from.
+    lookup() returns a dictionary in the MXToolbox lookup format, no matter the provider:
+    {"Failed": [], "Warnings": [], "Passed": [], "Information": [], "Errors": [], "Timeouts": []}
+    where each Failed/Warnings/Passed item is a dictionary with "Name", "Info" and "Url" keys.
+
+    Results are read from and stored in the shared RESULT_CACHE, if caching is enabled.
+    Identical lookups that are in flight at the same time (e.g the same selector of a domain listed twice in a bulk scan)
+    share one fetch and one parsed result, see SINGLE_FLIGHT.
+    Subclasses implement fetch() and fetch_async().
+    """
+    name = None
+
+    def lookup(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        cached = self._cached(command, argument)
+        if cached is not None:
+            return cached
+        return SINGLE_FLIGHT.do(("lookup", self.name, command, argument), self._fetch_and_cache, command, argument, query, auth)
+
+    async def lookup_async(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        """
+        asyncio version of lookup().
+        """
+        cached = self._cached(command, argument)
+        if cached is not None:
+            return cached
+        return await SINGLE_FLIGHT.do_async(("lookup", self.name, command, argument), self._fetch_and_cache_async, command, argument, query, auth)
+
+    def _cached(self, command:str, argument:str) -> dict|None:
+        if RESULT_CACHE is None:
+            return None
+        return RESULT_CACHE.get(self.name, command, argument)
+
+    @staticmethod
+    def cacheable(lookup_json:dict) -> bool:
+        """
+        Returns False for a lookup that timed out or failed, it is fetched again next time instead of being cached.
+        """
+        return not lookup_json["Timeouts"] and not lookup_json["Errors"]
+
+    def _cache(self, command:str, argument:str, lookup_json:dict) -> dict:
+        if RESULT_CACHE is not None and self.cacheable(lookup_json):
+            RESULT_CACHE.set(self.name, command, argument, lookup_json)
+        return lookup_json
+
+    def _fetch_and_cache(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        return self._cache(command, argument, self.fetch(command, argument, query=query, auth=auth))
+
+    async def _fetch_and_cache_async(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        return self._cache(command, argument, await self.fetch_async(command, argument, query=query, auth=auth))
+
+    def fetch(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        raise NotImplementedError
+
+    async def fetch_async(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        raise NotImplementedError
+
+class mxtoolbox_backend(lookup_backend):
+    """
+    Runs the checks with the MXToolbox lookup API, see mxtoolbox_lookup().
+    query is the check's query function, so the lookups go through the pooled HTTP clients.
+    """
+    name = "mxtoolbox"
+
+    def fetch(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        return mxtoolbox_lookup(query or HTTP_CLIENT.query, command, argument, auth)
+
+    async def fetch_async(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        return await mxtoolbox_lookup_async(query or ASYNC_HTTP_CLIENT.query, command, argument, auth)
+
+class dns_backend(lookup_backend):
+    """
+    Runs the checks locally by querying the TXT records over DNS and parsing the
+    v=spf1, v=DMARC1 and v=DKIM1 records itself, instead of asking MXToolbox.
+    -no rate limits, TLS fingerprinting or stale provider caches, and lookups take milliseconds
+    -all queries share the resolver's single socket, so many checks can run at the same time
+    -results use the same "Failed"/"Warnings"/"Passed"/"Information" format as MXToolbox
+    """
+    name = "dns"
+    SPF_URL = "https://www.rfc-editor.org/rfc/rfc7208"
+    DMARC_URL = "https://www.rfc-editor.org/rfc/rfc7489"
+    DKIM_URL = "https://www.rfc-editor.org/rfc/rfc6376"
+
+    def __init__(self, resolver:dns_resolver=None, spf_tree_resolver:spf_resolver=None):
+        self._resolver = resolver
+        self._spf_resolver = spf_tree_resolver
+
+    @property
+    def resolver(self) -> dns_resolver:
+        return self._resolver if self._resolver is not None else DNS_RESOLVER
+
+    @property
+    def spf_resolver(self) -> spf_resolver:
+        return self._spf_resolver if self._spf_resolver is not None else SPF_RESOLVER
+
+    @staticmethod
+    def record_name(command:str, argument:str) -> str:
+        """
+        Returns the name the TXT record of a check is published at.
+        DKIM arguments are already in the "selector._domainkey.domain" format.
+        """
+        if command == "dmarc":
+            return "_dmarc." + argument
+        return argument
+
+    def fetch(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        if command == "spf":
+            #SPF records are expanded with all of their includes, which also fetches the domain's own record
+            return self.evaluate_spf_tree(argument, self.spf_resolver.expand(argument))
+        try:
+            answer = self.resolver.resolve(self.record_name(command, argument), "TXT")
+        except dns_timeout_error as err:
+            return self.timeout_result(err)
+        return self.evaluate(command, argument, answer)
+
+    async def fetch_async(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        if command == "spf":
+            return self.evaluate_spf_tree(argument, await self.spf_resolver.expand_async(argument))
+        try:
+            answer = await self.resolver.resolve_async(self.record_name(command, argument), "TXT")
+        except dns_timeout_error as err:
+            return self.timeout_result(err)
+        return self.evaluate(command, argument, answer)
+
+    def evaluate_spf_tree(self, domain:str, tree:spf_node) -> dict:
+        if tree.answer is None:
+            if isinstance(tree.exception, dns_timeout_error):
+                return self.timeout_result(tree.exception)
+            raise tree.exception
+        return self.evaluate("spf", domain, tree.answer, tree)
+
+    #--RESULT HELPERS--
+
+    @staticmethod
+    def new_result() -> dict:
+        return {"Failed": [], "Warnings": [], "Passed": [], "Information": [], "Errors": [], "Timeouts": []}
+
+    @staticmethod
+    def item(name:str, info:str, url:str) -> dict:
+        return {"Name": name, "Info": info, "Url": url}
+
+    @staticmethod
+    def timeout_result(err:Exception) -> dict:
+        result = dns_backend.new_result()
+        result["Timeouts"].append(dns_backend.item("DNS Lookup", str(err), ""))
+        return result
+
+    @staticmethod
+    def parse_tags(record:str) -> dict:
+        """
+        Parses a "tag=value; tag=value" record (DKIM and DMARC) into an ordered dictionary.
+        Returns None if a tag is not in the tag=value format.
+        """
+        tags = {}
+        for part in record.split(";"):
+            part = part.strip()
+            if not part:
+                continue
+            tag, separator, value = part.partition("=")
+            if not separator:
+                return None
+            tags[tag.strip()] = value.strip()
+        return tags
+
+    def evaluate(self, command:str, argument:str, answer:dns_answer, spf_tree:spf_node=None) -> dict:
+        """
+        Turns the TXT answer for a check into an MXToolbox style result.
+        spf_tree is the domain's expanded SPF tree, without it only the record's own lookups are counted.
+        """
+        if answer.rcode not in (0, 3): #anything other than NOERROR or NXDOMAIN
+            result = self.new_result()
+            result["Errors"].append(self.item("DNS Lookup", f"DNS server returned response code {answer.rcode} for {answer.name}", ""))
+            return result
+        if command == "spf":
+            return self.evaluate_spf(argument, self.check_records(command, answer), spf_tree)
+        if command == "dmarc":
+            return self.evaluate_dmarc(argument, self.check_records(command, answer))
+        if command == "dkim":
+            return self.evaluate_dkim(argument, self.check_records(command, answer))
+        raise Exception(f"The DNS backend does not support the {command} check.")
+
+    @staticmethod
+    def is_check_record(command:str, record:str) -> bool:
+        """
+        Returns True if a TXT record belongs to the check, e.g a v=spf1 record for "spf".
+        """
+        if command == "spf":
+            return record.lower().startswith("v=spf1")
+        if command == "dmarc":
+            return record.lower().startswith("v=dmarc1")
+        if command == "dkim":
+            #DKIM records are not required to start with a version tag
+            return "p=" in record or record.lower().startswith("v=dkim1")
+        return True
+
+    @staticmethod
+    def check_records(command:str, answer:dns_answer) -> list:
+        """
+        Returns the TXT records of an answer that belong to the check.
+        """
+        return [record for record in answer.records if dns_backend.is_check_record(command, record)]
+
+    #--SPF--
+
+    SPF_MECHANISMS = ("all", "include", "a", "mx", "ptr", "ip4", "ip6", "exists")
+
+    def evaluate_spf(self, domain:str, records:list, spf_tree:spf_node=None) -> dict:
+        result = self.new_result()
+        url = self.SPF_URL
+        if not records:
+            result["Failed"].append(self.item("SPF Record Published", "No SPF Record found", url))
+            return result
+        result["Passed"].append(self.item("SPF Record Published", "SPF Record found", url))
+        result["Information"].append({"Tag": "Record", "Name": "Record", "Description": records[0]})
+        if len(records) > 1:
+            result["Failed"].append(self.item("SPF Multiple Records", f"More than one SPF record found ({len(records)})", url))
+        else:
+            result["Passed"].append(self.item("SPF Multiple Records", "Less than two records found", url))
+
+        lookups = 0
+        all_qualifier = None
+        has_redirect = False
+        after_all = False
+        syntax_errors = []
+        for qualifier, name, value, is_modifier, term in spf_resolver.parse_terms(records[0]):
+            if all_qualifier is not None:
+                after_all = True
+            if is_modifier:
+                #unknown modifiers are ignored (RFC 7208 6)
+                result["Information"].append({"Tag": name, "TagValue": value, "Name": "modifier", "Description": term})
+                if name == "redirect":
+                    has_redirect = True
+                    lookups += 1
+                continue
+            #--MECHANISMS-- e.g -all, include:_spf.google.com, a, mx/24, ip4:192.0.2.0/24
+            result["Information"].append({"Tag": name, "TagValue": value, "Name": qualifier, "Description": term})
+            if name not in self.SPF_MECHANISMS:
+                syntax_errors.append(term)
+                continue
+            if name in spf_resolver.LOOKUP_TERMS:
+                lookups += 1
+            if name == "ptr":
+                result["Warnings"].append(self.item("SPF Ptr Mechanism", "The ptr mechanism should not be used (RFC 7208 5.5)", url))
+            if name == "all":
+                all_qualifier = qualifier
+
+        if syntax_errors:
+            result["Failed"].append(self.item("SPF Syntax Check", f"The record is not valid, unknown terms: {' '.join(syntax_errors)}", url))
+        else:
+            result["Passed"].append(self.item("SPF Syntax Check", "The record is valid", url))
+        if spf_tree is not None:
+            #the expanded tree also counts the lookups of every included record
+            lookups = spf_tree.lookups
+            for error in spf_tree.errors:
+                result["Failed"].append(self.item("SPF Include Check", error, url))
+            for description, err in spf_tree.failed_lookups:
+                result["Timeouts" if isinstance(err, dns_timeout_error) else "Errors"].append(self.item("DNS Lookup", description, ""))
+            if spf_tree.void_lookups > spf_resolver.VOID_LOOKUP_LIMIT:
+                result["Failed"].append(self.item("SPF Void Lookups", f"Too many void lookups ({spf_tree.void_lookups})", url))
+        if lookups > spf_resolver.LOOKUP_LIMIT:
+            result["Failed"].append(self.item("SPF Included Lookups", f"Too many included lookups ({lookups})", url))
+        else:
+            result["Passed"].append(self.item("SPF Included Lookups", f"Number of included lookups is OK ({lookups})", url))
+        if all_qualifier == "+":
+            result["Failed"].append(self.item("SPF Record Deprecated All", "+all allows any server to send email for this domain", url))
+        elif all_qualifier == "?":
+            result["Warnings"].append(self.item("SPF Neutral All", "?all does not protect this domain", url))
+        elif all_qualifier is None and not has_redirect:
+            result["Warnings"].append(self.item("SPF All Mechanism", "No all mechanism found, the default is ?all (neutral)", url))
+        if after_all:
+            result["Warnings"].append(self.item("SPF Contains characters after ALL", "Terms after all are ignored", url))
+        return result
+
+    #--DMARC--
+
+    def evaluate_dmarc(self, domain:str, records:list) -> dict:
+        result = self.new_result()
+        url = self.DMARC_URL
+        if not records:
+            result["Failed"].append(self.item("DMARC Record Published", "No DMARC Record found", url))
+            return result
+        result["Passed"].append(self.item("DMARC Record Published", "DMARC Record found", url))
+        result["Information"].append({"Tag": "Record", "Name": "Record", "Description": records[0]})
+        if len(records) > 1:
+            result["Failed"].append(self.item("DMARC Multiple Records", f"More than one DMARC record found ({len(records)})", url))
+        tags = self.parse_tags(records[0])
+        if tags is None or list(tags)[0] != "v":
+            result["Failed"].append(self.item("DMARC Syntax Check", "The record is not valid", url))
+            return result
+        result["Passed"].append(self.item("DMARC Syntax Check", "The record is valid", url))
+        for tag, value in tags.items():
+            result["Information"].append({"Tag": tag, "TagValue": value, "Name": tag, "Description": value})
+
+        policy = tags.get("p", "").lower()
+        if "p" not in tags:
+            result["Failed"].append(self.item("DMARC Policy Tag", "Missing the required p tag", url))
+        elif policy not in ("none", "quarantine", "reject"):
+            result["Failed"].append(self.item("DMARC Policy Tag", f"Invalid policy p={tags['p']}", url))
+        elif policy == "none":
+            result["Warnings"].append(self.item("DMARC Quarantine/Reject policy enabled", "Policy is p=none, failing email is still delivered", url))
+        else:
+            result["Passed"].append(self.item("DMARC Quarantine/Reject policy enabled", f"Policy is p={policy}", url))
+        if "sp" in tags and tags["sp"].lower() not in ("none", "quarantine", "reject"):
+            result["Failed"].append(self.item("DMARC Subdomain Policy Tag", f"Invalid subdomain policy sp={tags['sp']}", url))
+        for alignment_tag in ("adkim", "aspf"):
+            if alignment_tag in tags and tags[alignment_tag].lower() not in ("r", "s"):
+                result["Failed"].append(self.item("DMARC Alignment Tag", f"Invalid {alignment_tag}={tags[alignment_tag]}, must be r or s", url))
+        if "pct" in tags:
+            if not tags["pct"].isdigit() or int(tags["pct"]) > 100:
+                result["Failed"].append(self.item("DMARC Percentage Tag", f"Invalid pct={tags['pct']}", url))
+            elif int(tags["pct"]) < 100:
+                result["Warnings"].append(self.item("DMARC Percentage Tag", f"Policy only applies to {tags['pct']}% of email", url))
+        if "rua" not in tags:
+            result["Warnings"].append(self.item("DMARC Aggregate Reports", "No rua tag, aggregate reports will not be sent", url))
+        else:
+            result["Passed"].append(self.item("DMARC Aggregate Reports", "Aggregate reports are enabled", url))
+        return result
+
+    #--DKIM--
+
+    @staticmethod
+    def rsa_key_bits(key:bytes) -> int:
+        """
+        Returns the modulus size of a DER encoded RSA public key (SubjectPublicKeyInfo or RSAPublicKey).
+        Returns 0 if the key can't be parsed.
+        """
+        def read(data:bytes, position:int) -> tuple:
+            #returns (tag, start of the value, end of the value)
+            tag = data[position]
+            length = data[position + 1]
+            position += 2
+            if length & 0x80:
+                size = length & 0x7F
+                length = int.from_bytes(data[position:position + size], "big")
+                position += size
+            return tag, position, position + length
+        try:
+            tag, start, end = read(key, 0)
+            tag, inner_start, inner_end = read(key, start)
+            if tag == 0x30: #SubjectPublicKeyInfo, skip the algorithm and read the BIT STRING
+                tag, start, end = read(key, inner_end)
+                tag, start, end = read(key, start + 1)
+                tag, inner_start, inner_end = read(key, start)
+            modulus = key[inner_start:inner_end].lstrip(b"\x00")
+            return len(modulus) * 8 - (8 - modulus[0].bit_length())
+        except (IndexError, ValueError):
+            return 0
+
+    def evaluate_dkim(self, selector_domain:str, records:list) -> dict:
+        result = self.new_result()
+        url = self.DKIM_URL
+        if not records:
+            result["Failed"].append(self.item("DKIM Record Published", "No DKIM Record found", url))
+            return result
+        result["Passed"].append(self.item("DKIM Record Published", "DKIM Record found", url))
+        result["Information"].append({"Tag": "Record", "Name": "Record", "Description": records[0]})
+        if len(records) > 1:
+            result["Warnings"].append(self.item("DKIM Multiple Records", f"More than one DKIM record found ({len(records)})", url))
+        tags = self.parse_tags(records[0])
+        if tags is None:
+            result["Failed"].append(self.item("DKIM Syntax Check", "The record is not valid", url))
+            return result
+        result["Passed"].append(self.item("DKIM Syntax Check", "The record is valid", url))
+        for tag, value in tags.items():
+            result["Information"].append({"Tag": tag, "TagValue": value, "Name": tag, "Description": value})
+
+        if "v" in tags and (tags["v"] != "DKIM1" or list(tags)[0] != "v"):
+            result["Failed"].append(self.item("DKIM Version Tag", "v must be DKIM1 and must be the first tag", url))
+        key_type = tags.get("k", "rsa").lower()
+        if key_type not in ("rsa", "ed25519"):
+            result["Failed"].append(self.item("DKIM Key Type", f"Unknown key type k={key_type}", url))
+        if "t" in tags and "y" in [flag.strip() for flag in tags["t"].split(":")]:
+            result["Warnings"].append(self.item("DKIM Testing Mode", "t=y, the domain is testing DKIM", url))
+
+        if "p" not in tags:
+            result["Failed"].append(self.item("DKIM Public Key", "Missing the required p tag", url))
+            return result
+        if tags["p"] == "":
+            result["Failed"].append(self.item("DKIM Public Key", "The key has been revoked (empty p tag)", url))
+            return result
+        try:
+            key = base64.b64decode("".join(tags["p"].split()), validate=True)
+        except ValueError:
+            result["Failed"].append(self.item("DKIM Public Key", "The public key is not valid base64", url))
+            return result
+        if key_type == "rsa":
+            key_bits = self.rsa_key_bits(key)
+            if key_bits == 0:
+                result["Failed"].append(self.item("DKIM Public Key", "The public key is not a valid RSA key", url))
+            elif key_bits < 1024:
+                result["Failed"].append(self.item("DKIM Key Length", f"The RSA key is only {key_bits} bits", url))
+            elif key_bits < 2048:
+                result["Warnings"].append(self.item("DKIM Key Length", f"The RSA key is {key_bits} bits, 2048 bits is recommended", url))
+            else:
+                result["Passed"].append(self.item("DKIM Key Length", f"The RSA key is {key_bits} bits", url))
+        elif key_type == "ed25519" and len(key) != 32:
+            result["Failed"].append(self.item("DKIM Public Key", "The public key is not a valid ed25519 key", url))
+        return result
+
+MXTOOLBOX_BACKEND = mxtoolbox_backend()
+DNS_BACKEND = dns_backend()
+BACKEND = MXTOOLBOX_BACKEND #backend used by checks that aren't given one
+BACKENDS = {"mxtoolbox": MXTOOLBOX_BACKEND, "dns": DNS_BACKEND}
+
+def get_backend(backend:lookup_backend|str=None) -> lookup_backend:
+    """
+    Returns the backend for a backend name or object, or the default BACKEND if None.
+    """
+    if backend is None:
+        return BACKEND
+    if isinstance(backend, lookup_backend):
+        return backend
+    if backend not in BACKENDS:
+        raise Exception(f"Unknown backend {backend} - must be one of: {', '.join(BACKENDS)}")
+    return BACKENDS[backend]
+
+class record_store:
+    """
+    Persistent SQLite store used by incremental_backend, keyed by provider, command and argument like result_cache.
+    For each lookup it keeps a digest of the live TXT records it was checked against, the provider's result
+    and when the check was done.
+    -safe to share between threads
+    """
+    def __init__(self, path:str, max_age:float=604800):
+        self.path = path
+        self.max_age = max_age #seconds a stored result is reused for while its record doesn't change
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "provider TEXT, command TEXT, argument TEXT, digest TEXT, value TEXT, checked_at REAL, "
+            "PRIMARY KEY (provider, command, argument))"
+        )
+
+    def get(self, provider:str, command:str, argument:str, digest:str):
+        """
+        Returns the stored result if it was checked against the same records (digest) and isn't older than max_age, otherwise None.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT digest, value, checked_at FROM records WHERE provider=? AND command=? AND argument=?",
+                (provider, command, argument.lower())
+            ).fetchone()
+        if row is None or row[0] != digest or time.time() - row[2] >= self.max_age:
+            return None
+        return json.loads(row[1])
+
+    def set(self, provider:str, command:str, argument:str, digest:str, value):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)",
+                (provider, command, argument.lower(), digest, json.dumps(value, separators=(",", ":")), time.time())
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+DEFAULT_RECORDS_FILE = os.path.join(os.path.expanduser("~"), ".cache", "email_check", "records.sqlite3")
+
+class incremental_backend(lookup_backend):
+    """
+    Wraps another backend (e.g MXToolbox) and only asks it again when a record has changed.
+    -each lookup first fetches the record's live TXT records over DNS, which is cheap, and hashes them. For SPF the
+    records of every include: and redirect= are hashed too (expanded by SPF_RESOLVER), as a change to an included
+    record (e.g an ESP adding includes) changes the result as much as a change to the domain's own record
+    -if the stored result was checked against the same records and isn't older than the store's max_age, it is reused,
+    otherwise the wrapped backend is asked and the result is stored with the new digest
+    -if the DNS fetch fails, the wrapped backend is always asked
+    -if the record the provider checked differs from live DNS (MXToolbox sometimes serves old cached records),
+    a "Provider Record Outdated" warning is added to the result
+    -the result_cache is not used, as it can't tell when a record has changed
+    """
+    def __init__(self, backend:lookup_backend|str, store:record_store, resolver:dns_resolver=None):
+        self.backend = get_backend(backend)
+        self.name = self.backend.name
+        self.store = store
+        self._resolver = resolver
+        self._lock = threading.Lock()
+        self._stats = {"unchanged": 0, "checked": 0, "outdated": 0}
+
+    @property
+    def resolver(self) -> dns_resolver:
+        return self._resolver if self._resolver is not None else DNS_RESOLVER
+
+    def stats(self) -> dict:
+        """
+        Returns a copy of the counters: unchanged (stored results reused), checked (lookups sent to the
+        wrapped backend) and outdated (provider records that differ from live DNS).
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, key:str):
+        with self._lock:
+            self._stats[key] += 1
+
+    @staticmethod
+    def digest(records:list) -> str:
+        return hashlib.sha256("\n".join(sorted(records)).encode()).hexdigest()
+
+    def live_records(self, command:str, argument:str) -> list|None:
+        """
+        Returns the live TXT records of a check, or None if they could not be fetched.
+        """
+        try:
+            answer = self.resolver.resolve(dns_backend.record_name(command, argument), "TXT")
+        except dns_timeout_error:
+            return None
+        return self._answer_records(command, answer)
+
+    async def live_records_async(self, command:str, argument:str) -> list|None:
+        """
+        asyncio version of live_records().
+        """
+        try:
+            answer = await self.resolver.resolve_async(dns_backend.record_name(command, argument), "TXT")
+        except dns_timeout_error:
+            return None
+        return self._answer_records(command, answer)
+
+    @staticmethod
+    def _answer_records(command:str, answer:dns_answer) -> list|None:
+        if answer.rcode not in (0, 3):
+            return None
+        return dns_backend.check_records(command, answer)
+
+    def included_records(self, command:str, argument:str) -> list|None:
+        """
+        Returns the records of every include: and redirect= under a domain's SPF record, an empty list for the other
+        checks, or None if one of them could not be fetched.
+        """
+        if command != "spf":
+            return []
+        return self._tree_records(SPF_RESOLVER.expand(argument))
+
+    async def included_records_async(self, command:str, argument:str) -> list|None:
+        """
+        asyncio version of included_records().
+        """
+        if command != "spf":
+            return []
+        return self._tree_records(await SPF_RESOLVER.expand_async(argument))
+
+    @staticmethod
+    def _tree_records(node:spf_node) -> list|None:
+        if not node.complete:
+            return None
+        records = []
+        seen = set()
+        nodes = list(node.children)
+        while nodes:
+            child = nodes.pop()
+            if child.domain in seen:
+                continue
+            seen.add(child.domain)
+            records.append(f"{child.domain} {child.record}")
+            nodes.extend(child.children)
+        return records
+
+    @staticmethod
+    def provider_record(lookup_json:dict) -> str|None:
+        """
+        Returns the record the provider checked (the check's record-content), None if the result has no record.
+        """
+        if not lookup_json.get("Information"):
+            return None
+        return str(lookup_json["Information"][0].get("Description", ""))
+
+    def flag_outdated(self, command:str, lookup_json:dict, records:list) -> dict:
+        """
+        Adds a warning to the result if the provider checked a different record than the one in live DNS.
+        Only record-content that looks like a record of the check is compared.
+        """
+        provider_record = self.provider_record(lookup_json)
+        if provider_record is None or records is None:
+            return lookup_json
+        normalised = " ".join(provider_record.split())
+        if not dns_backend.is_check_record(command, normalised) or normalised.lower() in ("v=spf1", "v=dmarc1", "v=dkim1"):
+            return lookup_json #the description isn't a full record, e.g only the version tag
+        if any(" ".join(record.split()) == normalised for record in records):
+            return lookup_json
+        live = records[0] if records else "no record"
+        lookup_json["Warnings"].append({
+            "Name": "Provider Record Outdated",
+            "Info": f"{self.name} checked \"{provider_record}\" but live DNS returns \"{live}\"",
+            "Url": ""
+        })
+        self._count("outdated")
+        return lookup_json
+
+    def lookup(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        return SINGLE_FLIGHT.do(("incremental", self.name, command, argument), self._lookup, command, argument, query, auth)
+
+    async def lookup_async(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        """
+        asyncio version of lookup().
+        """
+        return await SINGLE_FLIGHT.do_async(("incremental", self.name, command, argument), self._lookup_async, command, argument, query, auth)
+
+    def _lookup(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        records = self.live_records(command, argument)
+        included = self.included_records(command, argument) if records else []
+        digest, stored = self._stored(command, argument, records, included)
+        if stored is not None:
+            return stored
+        return self._store(command, argument, records, digest, self.backend.fetch(command, argument, query=query, auth=auth))
+
+    async def _lookup_async(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        records = await self.live_records_async(command, argument)
+        included = await self.included_records_async(command, argument) if records else []
+        digest, stored = self._stored(command, argument, records, included)
+        if stored is not None:
+            return stored
+        return self._store(command, argument, records, digest, await self.backend.fetch_async(command, argument, query=query, auth=auth))
+
+    def _stored(self, command:str, argument:str, records:list|None, included:list|None) -> tuple:
+        """
+        Returns the digest of the live records (and the records they include) and the stored result for them,
+        or None if the records changed.
+        """
+        digest = self.digest(records + included) if records is not None and included is not None else None
+        if digest is not None:
+            stored = self.store.get(self.name, command, argument, digest)
+            if stored is not None:
+                self._count("unchanged")
+                METRICS.count("cache_lookups_total", cache="records", outcome="hit")
+                return digest, stored
+        self._count("checked")
+        METRICS.count("cache_lookups_total", cache="records", outcome="miss")
+        return digest, None
+
+    def _store(self, command:str, argument:str, records:list|None, digest:str|None, lookup_json:dict) -> dict:
+        lookup_json = self.flag_outdated(command, lookup_json, records)
+        if self.cacheable(lookup_json):
+            self.store.set(self.name, command, argument, digest, lookup_json)
+        return lookup_json
+
+class hedged_backend(lookup_backend):
+    """
+    Wraps another backend (e.g MXToolbox) and bounds the tail latency of its lookups with hedged requests.
+    -if a lookup hasn't answered after the percentile (default p95) of the recent latencies of that command,
+    a duplicate lookup is started on the next path of hedges, and so on. The first answer wins and the others are
+    cancelled: threads stop before their next request or retry, asyncio lookups are cancelled straight away
+    -a path that fails (e.g its circuit breaker is open) starts the next path straight away, so the hedges are also
+    a fallback for a provider that is down
+    -a hedge is another backend (e.g "dns" to check the records locally), or the wrapped provider itself, which sends
+    the lookup again on a new connection
+    -at most max_ratio of the lookups are hedged, so a slow provider can't double the load
+    -until min_samples latencies of a command have been seen, initial_delay is used
+    -sync lookups run their paths on at most max_workers threads, shared by every lookup. While all of them are busy
+    (e.g with lost requests that haven't stopped yet) a lookup runs in its own thread without hedges, instead of queueing
+    """
+    def __init__(self, backend:lookup_backend|str, hedges:list, percentile:float=95, initial_delay:float=2.0, min_delay:float=0.05, max_ratio:float=0.1, window:int=500, min_samples:int=20, max_workers:int=64):
+        self.backend = get_backend(backend)
+        self.name = self.backend.name
+        self.hedges = [get_backend(hedge) for hedge in hedges]
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.window = window
+        self.min_samples = min_samples
+        self._latencies = {} #command -> deque of the latest latencies of the wrapped backend
+        self._lock = threading.Lock()
+        self._stats = {"lookups": 0, "hedged": 0, "won": 0, "fallbacks": 0}
+        self.max_workers = max_workers
+        self._executor = None
+        self._busy = 0 #paths submitted to the executor that haven't finished
+
+    def stats(self) -> dict:
+        """
+        Returns a copy of the counters: lookups, hedged (duplicates started because the lookup was slow),
+        won (lookups answered by a hedge) and fallbacks (paths started because the previous one failed).
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, key:str, command:str):
+        with self._lock:
+            self._stats[key] += 1
+        METRICS.count("hedges_total", command=command, outcome=key)
+
+    def hedge_delay(self, command:str) -> float:
+        """
+        Returns the seconds a lookup waits for the wrapped backend before it is hedged, the percentile of its recent latencies.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(command, ()))
+        if len(latencies) < self.min_samples:
+            return self.initial_delay
+        return max(self.min_delay, latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))])
+
+    def _record_latency(self, command:str, seconds:float):
+        with self._lock:
+            latencies = self._latencies.get(command)
+            if latencies is None:
+                latencies = self._latencies[command] = collections.deque(maxlen=self.window)
+            latencies.append(seconds)
+
+    def _may_hedge(self) -> bool:
+        with self._lock:
+            return self._stats["hedged"] < self.max_ratio * self._stats["lookups"]
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                #threads are only started as needed, up to max_workers
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hedge")
+                atexit.register(self.close)
+            return self._executor
+
+    def _has_worker(self) -> bool:
+        with self._lock:
+            return self._busy < self.max_workers
+
+    def _reserve_worker(self) -> bool:
+        with self._lock:
+            if self._busy >= self.max_workers:
+                return False
+            self._busy += 1
+            return True
+
+    def _release_worker(self, future:Future):
+        with self._lock:
+            self._busy -= 1
+
+    def close(self):
+        """
+        Stops the sync lookups' threads, paths that haven't started yet are cancelled.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _paths(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None, run_async:bool=False) -> list:
+        #the first path is the wrapped backend, with its cache and single flight
+        paths = [functools.partial(self.backend.lookup_async if run_async else self.backend.lookup, command, argument, query=query, auth=auth)]
+        for hedge in self.hedges:
+            if hedge.name == self.name:
+                #the same provider again, on a new connection and without joining the request that is slow
+                fresh_query = functools.partial(ASYNC_HTTP_CLIENT.query if run_async else HTTP_CLIENT.query, fresh=True)
+                paths.append(functools.partial(hedge.fetch_async if run_async else hedge.fetch, command, argument, query=fresh_query, auth=auth))
+            else:
+                paths.append(functools.partial(hedge.lookup_async if run_async else hedge.lookup, command, argument, auth=auth))
+        return paths
+
+    def lookup(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        executor = self._get_executor()
+        with self._lock:
+            self._stats["lookups"] += 1
+        paths = self._paths(command, argument, query, auth)
+        delay = self.hedge_delay(command)
+        started = time.monotonic()
+        running = {} #future -> (path index, cancel event)
+        errors = []
+
+        def start_path():
+            index = len(running) + len(errors)
+            cancel = threading.Event()
+            context = contextvars.copy_context() #keeps the domain's deadline
+            context.run(LOOKUP_CANCEL.set, cancel)
+            if self._reserve_worker():
+                future = executor.submit(context.run, paths[index])
+                future.add_done_callback(self._release_worker)
+            else:
+                #every worker is busy, the path runs in this thread instead of queueing behind them
+                future = Future()
+                try:
+                    future.set_result(context.run(paths[index]))
+                except Exception as err:
+                    future.set_exception(err)
+            running[future] = (index, cancel)
+            return time.monotonic()
+
+        last_start = start_path()
+        try:
+            while running:
+                can_hedge = len(running) + len(errors) < len(paths) and self._may_hedge() and self._has_worker()
+                done, _ = wait(running, timeout=max(0.0, last_start + delay - time.monotonic()) if can_hedge else None, return_when=FIRST_COMPLETED)
+                if not done:
+                    self._count("hedged", command)
+                    last_start = start_path()
+                    continue
+                for future in done:
+                    index, _ = running.pop(future)
+                    try:
+                        lookup_json = future.result()
+                    except BaseException as err:
+                        errors.append(err)
+                        if len(running) + len(errors) < len(paths):
+                            self._count("fallbacks", command)
+                            last_start = start_path()
+                        continue
+                    if index == 0:
+                        self._record_latency(command, time.monotonic() - started)
+                    else:
+                        self._count("won", command)
+                    return lookup_json
+            raise errors[0]
+        finally:
+            for future, (index, cancel) in running.items():
+                cancel.set()
+                future.cancel()
+                if index == 0:
+                    #the wrapped backend took at least this long, so a slow provider keeps raising the percentile
+                    self._record_latency(command, time.monotonic() - started)
+
+    async def lookup_async(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        """
+        asyncio version of lookup(), the paths run as tasks on the running event loop.
+        """
+        with self._lock:
+            self._stats["lookups"] += 1
+        paths = self._paths(command, argument, query, auth, run_async=True)
+        delay = self.hedge_delay(command)
+        started = time.monotonic()
+        running = {} #task -> path index
+        errors = []
+
+        def start_path():
+            index = len(running) + len(errors)
+            running[asyncio.ensure_future(paths[index]())] = index
+            return time.monotonic()
+
+        last_start = start_path()
+        try:
+            while running:
+                can_hedge = len(running) + len(errors) < len(paths) and self._may_hedge()
+                done, _ = await asyncio.wait(running, timeout=max(0.0, last_start + delay - time.monotonic()) if can_hedge else None, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self._count("hedged", command)
+                    last_start = start_path()
+                    continue
+                for task in done:
+                    index = running.pop(task)
+                    try:
+                        lookup_json = task.result()
+                    except Exception as err:
+                        errors.append(err)
+                        if len(running) + len(errors) < len(paths):
+                            self._count("fallbacks", command)
+                            last_start = start_path()
+                        continue
+                    if index == 0:
+                        self._record_latency(command, time.monotonic() - started)
+                    else:
+                        self._count("won", command)
+                    return lookup_json
+            raise errors[0]
+        finally:
+            for task, index in running.items():
+                task.cancel()
+                if index == 0:
+                    self._record_latency(command, time.monotonic() - started)
+
+    def fetch(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        return self.backend.fetch(command, argument, query=query, auth=auth)
+
+    async def fetch_async(self, command:str, argument:str, query=None, auth:mxtoolbox_auth=None) -> dict:
+        return await self.backend.fetch_async(command, argument, query=query, auth=auth)
+
+#--RESULT MODEL--
+class result_row(dict):
+    """
+    Read-only dictionary for one item of a lookup's Failed, Warnings or Passed list, e.g {"Name": ..., "Info": ..., "Url": ...}.
+    Rows are interned by intern(): the same item found for different domains or selectors is stored once,
+    and the keys and string values (check names, info text, URLs...) are interned strings.
+    A row is a dict, so check.failures or check.warnings can be passed to json.dumps() as they are.
+    """
+    __slots__ = ()
+    MAX_INTERNED = 100000 #rows kept for reuse, e.g texts that include a domain name are rarely shared
+    _interned = {} #(keys, values) -> row
+
+    @classmethod
+    def intern(cls, item:dict) -> "result_row":
+        keys = tuple(sys.intern(key) for key in item)
+        values = tuple(sys.intern(value) if type(value) is str else value for value in item.values())
+        try:
+            row = cls._interned.get((keys, values))
+        except TypeError: #a value that can't be hashed (e.g a list), the row is not shared
+            return cls(zip(keys, values))
+        if row is None:
+            row = cls(zip(keys, values))
+            if len(cls._interned) < cls.MAX_INTERNED:
+                cls._interned[(keys, values)] = row
+        return row
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError(f"'{type(self).__name__}' object is read-only, it may be shared with other results")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+    def to_dict(self) -> dict:
+        return dict(self)
+
+def intern_rows(items:list) -> list:
+    """
+    Returns a lookup's list of items (e.g its "Passed" list) as interned result_row.
+    """
+    return [result_row.intern(item) for item in items]
+
+def plain_value(value):
+    """
+    Returns value with every result_row and check_result replaced by plain dictionaries, e.g for json.dumps().
+    """
+    if isinstance(value, (result_row, check_result)):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [plain_value(item) for item in value]
+    return value
+
+class check_result:
+    """
+    Compact result of one lookup (a DKIM selector, an SPF or a DMARC record), loaded from the lookup's JSON.
+    -failed, warnings, passed, errors and timeouts are lists of interned result_row
+    -information is specific to each record, so it is only kept as compact JSON and parsed each time it is read
+    -result is "FAIL" if the lookup has failed checks, otherwise "TIMEOUT" or "ERROR" if part of the lookup timed out or
+    failed, and "PASS" if the lookup completed without failed checks (None until a lookup is loaded)
+    -result["failed"], result["record-content"]... still work like the dictionaries that were used before
+    """
+    __slots__ = ("result", "failed", "warnings", "passed", "errors", "timeouts", "record_content", "_information")
+    KEYS = {"failed": "failed", "warnings": "warnings", "passed": "passed", "record-content": "record_content", "information": "information", "errors": "errors", "timeouts": "timeouts"}
+
+    def __init__(self, lookup_json:dict=None):
+        self.result = None
+        self.failed, self.warnings, self.passed, self.errors, self.timeouts = [], [], [], [], []
+        self.record_content = ""
+        self._information = None
+        if lookup_json is not None:
+            self.load(lookup_json)
+
+    def load(self, lookup_json:dict):
+        """
+        Stores an MXToolbox (or dns backend) lookup response.
+        """
+        self.failed = intern_rows(lookup_json["Failed"])
+        self.warnings = intern_rows(lookup_json["Warnings"])
+        self.passed = intern_rows(lookup_json["Passed"])
+        self.errors = intern_rows(lookup_json["Errors"])
+        self.timeouts = intern_rows(lookup_json["Timeouts"])
+        if lookup_json["Information"] == []:
+            self.record_content = ""
+            self._information = None
+        else:
+            self.record_content = str(lookup_json["Information"][0]["Description"])
+            self._information = json.dumps(lookup_json["Information"], separators=(",", ":")).encode()
+        if self.failed != []:
+            self.result = "FAIL"
+        elif self.timeouts != []: #a record that couldn't be fetched isn't a record that passed
+            self.result = "TIMEOUT"
+        elif self.errors != []:
+            self.result = "ERROR"
+        else:
+            self.result = "PASS"
+
+    @property
+    def information(self) -> list:
+        return json.loads(self._information) if self._information is not None else []
+
+    def __getitem__(self, key:str):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, self.KEYS[key])
+
+    def __contains__(self, key:str) -> bool:
+        return key in self.KEYS
+
+    def get(self, key:str, default=None):
+        return self[key] if key in self.KEYS else default
+
+    def keys(self):
+        return self.KEYS.keys()
+
+    def to_dict(self) -> dict:
+        return {key: plain_value(self[key]) for key in self.KEYS}
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+class selector_result(check_result):
+    """
+    Result of one DKIM selector, see check_result.
+    Also accessible as selector["name"], selector["is_testing_selector"] and selector["valid"].
+    """
+    __slots__ = ("name", "is_testing_selector")
+    KEYS = {"name": "name", **check_result.KEYS, "is_testing_selector": "is_testing_selector", "valid": "valid"}
+
+    def __init__(self, name:str, lookup_json:dict=None):
+        self.name = sys.intern(name)
+        self.is_testing_selector = False #default value is False
+        super().__init__(lookup_json)
+
+    def load(self, lookup_json:dict):
+        super().load(lookup_json)
+        #--CHECK IF DKIM RECORD IS A TEST RECORD--
+        for information in lookup_json["Information"]:
+            if information["Tag"] == "t": #t tag means it's a testing DKIM record
+                self.is_testing_selector = True
+                break
+
+    @property
+    def valid(self) -> bool:
+        """
+        True if the selector has no failed checks, None until it has been looked up or if its lookup timed out or failed.
+        """
+        return self.result == "PASS" if self.result in ("PASS", "FAIL") else None
+
+class spf_result(check_result):
+    """
+    Result of an SPF lookup, see check_result.
+    """
+    __slots__ = ()
+
+class dmarc_result(check_result):
+    """
+    Result of a DMARC lookup, see check_result.
+    """
+    __slots__ = ()
+
+class mx_result(check_result):
+    """
+    Result of an MX check, see check_result.
+    Also accessible as result["hosts"], the mx_host_checker result of each mail host with its MX "preference".
+    """
+    __slots__ = ("hosts",)
+    KEYS = {**check_result.KEYS, "hosts": "hosts"}
+
+    def __init__(self, lookup_json:dict=None):
+        self.hosts = []
+        super().__init__(lookup_json)
+
+    def load(self, lookup_json:dict):
+        super().load(lookup_json)
+        self.hosts = lookup_json.get("Hosts", [])
+
+#--CHECKS--
+class base_check:
+    """
+    Shared base of dkim_check, spf_check and dmarc_check.
+    A check is a cheap description of what to check, creating one does no I/O. The checks are done by run(),
+    `await run_async()`, or on the first access of one of the results (result, failures, warnings...).
+    Checks used to run straight away when they were created, run=True still does that.
+    If the first access runs the check and it raises, the same exception is raised again on every later access
+    of a result, instead of running the check again, until run() or run_async() is called.
+    """
+    RESULTS = ("result", "warnings", "failures") #attributes that make a lazy check run
+    def __init__(self, domain:str, auth:mxtoolbox_auth=None, run:bool=None, backend:lookup_backend|str=None):
+        """
+        -if run is None (default) the checks are done lazily, on run(), run_async() or the first access of a result
+        -if run is True the checks are done straight away
+        -if run is False the results keep their defaults (result is None) until run() or `await run_async()` is called
+        -backend is the provider the results come from, e.g "mxtoolbox" or "dns" (default: BACKEND)
+        """
+        self.auth = auth
+        self.backend = get_backend(backend)
+        self._started = False
+        #domain arg must be a string and cannot be empty
+        if type(domain) is not str:
+            raise Exception("Domain must be a string.")
+        elif domain is None:
+            raise Exception("Domain cannot be empty.")
+        else:
+            self.domain = domain
+
+    def start(self, run:bool=None):
+        """
+        Called at the end of each subclass' __init__, does what the run argument asks for.
+        """
+        if run:
+            self.run()
+        elif run is False:
+            self.reset()
+
+    def reset(self):
+        """
+        Sets the results to their defaults, before the checks are done.
+        """
+        self._started = True
+        self.__dict__.pop("_error", None)
+        self.result = None
+        self.warnings = []
+        self.failures = []
+
+    def __getattr__(self, name:str):
+        #only called for attributes that aren't set, e.g the results of a lazy check that hasn't been run yet,
+        #or the results that are read from the check's check_result (self.details)
+        if name not in type(self).RESULTS:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        if "_error" in self.__dict__:
+            raise self._error
+        if not self.__dict__.get("_started", True):
+            try:
+                self.run()
+            except Exception as err:
+                #the results reset() set are removed again, so every later access raises the same error
+                for result in type(self).RESULTS:
+                    self.__dict__.pop(result, None)
+                self._error = err
+                raise
+            return getattr(self, name)
+        if "details" in self.__dict__:
+            return getattr(self.details, name)
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
 
-        self.result = None #Set a default result of None so
-        self.warnings = []
-        self.failures = []
+    def query(self, endpoint:str, headers:dict=None, impersonate:str=None):
+        """
+        Runs a GET request through the shared, pooled HTTP_CLIENT and returns the raw response.
+        See http_client.query()
+        """
+        return HTTP_CLIENT.query(endpoint, headers=headers, impersonate=impersonate)
 
-        
-        #domain arg must be a string and cannot be empty
-        
-        if type(domain) is not str:
-            raise Exception("Domain must be a string.")
-        elif domain is None:
-            raise Exception("Domain cannot be empty.")
-        else:
-            self.domain = domain
+    async def query_async(self, endpoint:str, headers:dict=None, impersonate:str=None):
+        """
+        Runs a GET request through the shared ASYNC_HTTP_CLIENT and returns the raw response.
+        See async_http_client.query()
+        """
+        return await ASYNC_HTTP_CLIENT.query(endpoint, headers=headers, impersonate=impersonate)
+
+class dkim_check(base_check):
+    RESULTS = base_check.RESULTS + ("selectors",)
+
+    def __init__(self, domain:str, selector:str|list=None, auth:mxtoolbox_auth=None, max_workers:int=None, run:bool=None, backend:lookup_backend|str=None, discovery:str=None):
+        """
+        -run is None (lazy, default), True or False, see base_check
+        -backend is the provider the selector results come from, e.g "mxtoolbox" or "dns" (default: BACKEND)
+        -discovery is how selectors are found if none are given: "easydmarc", "dns" or "both" (default: DISCOVERY)
+        """
+        super().__init__(domain, auth=auth, backend=backend)
+        self.discovery = discovery if discovery is not None else DISCOVERY
+        if self.discovery not in ("easydmarc", "dns", "both"):
+            raise Exception(f"Discovery must be easydmarc, dns or both. - {self.discovery}")
+        #maximum number of selectors looked up at the same time for this domain
+        self.max_workers = max_workers if max_workers is not None else DKIM_MAX_WORKERS
 
-        
         #selector arg must be in one of the following formats:
         #1. a string if there is only one selector
         #2. a list of strings if there are multiple selectors
@@ -29,15 +3618,9 @@ class dkim_check:
         #otherwise, leave the selector parameter blank and the script will find the selectors automatically
         
         
-        #--FIND SELECTORS AUTOMATICALLY IF NONE PROVIDED--
+        #--SELECTORS ARE FOUND AUTOMATICALLY IN run() IF NONE PROVIDED--
         if selector == None:
-            self.selectors = self.find_selectors() #no selector was specified, so find them    
-            if self.selectors is None:
-                raise Exception("Failed to find selectors from response.")
-            elif self.selectors == []:
-                self.result = "FAIL" #dkim check fails if there are no selectors for the domain
-                self.failures.append(f"No DKIM selectors found for {self.domain}.")
-                return #exit init if there are no selectors for the domain
+            self.requested_selectors = None
         
         #--CHECK IF PROVIDED SELECTORS ARE VALID--
         
@@ -45,9 +3628,9 @@ class dkim_check:
         elif not isinstance(selector, (str, list)): #this checks if selector is a string or a list
             raise Exception(f"Selector must be a list or string. - {selector} - {type(selector)}")
         
-        #selector was specified as a string, so convert it to a list of dictionaries for consistency
+        #selector was specified as a string, so convert it to a list for consistency
         elif type(selector) is str: 
-            self.selectors = [{"name": selector}]
+            self.requested_selectors = [selector]
         
         #selector was specified as a list
         elif type(selector) is list: 
@@ -57,24 +3640,106 @@ class dkim_check:
                 for selector_ in selector:
                     if type(selector_) is not str: #list of selectors must only contain strings for consistency
                         raise Exception(f"Selector list must only contain strings. - {selector} - {type(selector_)}")
-                    else:
-                        #convert each selector to a dictionary for consistency
-                        self.selectors = []
-                        for selector_ in selector:
-                            self.selectors.append({"name": selector_})
+                self.requested_selectors = list(selector)
         else:
             raise Exception("Failed to parse selectors.") #idk what could cause this, but just in case
         
+        #DO DKIM CHECKS
+        self.start(run)
+
+    def reset(self):
+        super().reset()
+        #convert each selector to a selector_result for consistency, the selector's lookup is loaded into it
+        self.selectors = [selector_result(selector_) for selector_ in self.requested_selectors] if self.requested_selectors is not None else None
+
+    def run(self):
+        """
+        Finds the selectors if none were provided, then runs the DKIM checks.
+        """
+        self.reset()
+        if self.selectors is None:
+            self.selectors = self.find_selectors() #no selector was specified, so find them
+            if not self.set_found_selectors():
+                return #exit if there are no selectors for the domain
+        
         """
-        self.selectors must be a list of dictionaries at this point:
-        [{"name": "selector1"}, {"name": "selector2"}]
+        self.selectors must be a list of selector_result at this point:
+        [selector_result("selector1"), selector_result("selector2")]
         """
         #print(self.selectors)
-
-        #DO DKIM CHECKS
         self.check_dkim()
-    
+
+    async def run_async(self):
+        """
+        asyncio version of run(), all lookups are done on the shared ASYNC_HTTP_CLIENT.
+        """
+        self.reset()
+        if self.selectors is None:
+            self.selectors = await self.find_selectors_async()
+            if not self.set_found_selectors():
+                return
+        await self.check_dkim_async()
+
+    def set_found_selectors(self) -> bool:
+        """
+        Checks the automatically found selectors.
+        Returns False if the DKIM check already failed because the domain has no selectors.
+        """
+        if self.selectors is None:
+            raise Exception("Failed to find selectors from response.")
+        elif self.selectors == []:
+            self.result = "FAIL" #dkim check fails if there are no selectors for the domain
+            self.failures.append(f"No DKIM selectors found for {self.domain}.")
+            return False
+        return True
+
+    @METRICS.timed("find_selectors")
     def find_selectors(self):
+        """
+        Automagically finds the selectors of a domain, with EasyDMARC, DNS probing of common
+        selectors (see selector_discovery) or both, depending on self.discovery.
+        
+        Returns a list of selectors if successful.
+        Returns None if it fails.
+        Returns an empty list if there are no selectors for the domain.
+        """
+        if self.discovery == "dns":
+            return self.merge_selectors([], SELECTOR_DISCOVERY.discover(self.domain))
+        selectors = self.find_easydmarc_selectors()
+        if self.discovery == "both":
+            selectors = self.merge_selectors(selectors, SELECTOR_DISCOVERY.discover(self.domain))
+        return selectors
+
+    @METRICS.timed("find_selectors")
+    async def find_selectors_async(self):
+        """
+        asyncio version of find_selectors().
+        """
+        if self.discovery == "dns":
+            return self.merge_selectors([], await SELECTOR_DISCOVERY.discover_async(self.domain))
+        if self.discovery == "both":
+            selectors, dns_selectors = await asyncio.gather(self.find_easydmarc_selectors_async(), SELECTOR_DISCOVERY.discover_async(self.domain))
+            return self.merge_selectors(selectors, dns_selectors)
+        return await self.find_easydmarc_selectors_async()
+
+    def merge_selectors(self, selectors, dns_selectors:list):
+        """
+        Adds the selectors found over DNS to a list of selector_result, without duplicates.
+        If EasyDMARC failed (None) the DNS selectors are used on their own, if any were found.
+        """
+        if selectors is None:
+            if not dns_selectors:
+                return None
+            selectors = []
+        names = {selector["name"].lower() for selector in selectors}
+        for name in dns_selectors:
+            if name.lower() not in names:
+                names.add(name.lower())
+                selectors.append(selector_result(name))
+        return selectors
+
+    @METRICS.timed("easydmarc")
+    def find_easydmarc_selectors(self):
         """
         Queries EasyDMARC to automagically find the selectors of a domain.
         
@@ -83,37 +3748,79 @@ class dkim_check:
         Returns an empty list if there are no selectors for the domain.
         """
         
+        cached = self.cached_selectors()
+        if cached is not None:
+            return cached
         #--QUERY FOR ALL SELECTORS--
-        easydmarc_url = f"https://easydmarc.com/tools/dkim-lookup/status?domain={self.domain}&amp;selector=auto"
-        
-        response = self.query(easydmarc_url)
+        response = self.query(self.easydmarc_url())
         #print(response.text)
+        return self.cache_selectors(self.parse_selectors(response.text))
+
+    @METRICS.timed("easydmarc")
+    async def find_easydmarc_selectors_async(self):
+        """
+        asyncio version of find_easydmarc_selectors().
+        """
+        cached = self.cached_selectors()
+        if cached is not None:
+            return cached
+        response = await self.query_async(self.easydmarc_url())
+        return self.cache_selectors(self.parse_selectors(response.text))
+
+    def cached_selectors(self):
+        """
+        Returns the selectors stored in the shared RESULT_CACHE, or None if they are not cached.
+        """
+        if RESULT_CACHE is None:
+            return None
+        names = RESULT_CACHE.get("easydmarc", "selectors", self.domain)
+        if names is None:
+            return None
+        return [selector_result(name) for name in names]
+
+    def cache_selectors(self, selectors):
+        """
+        Stores the found selectors in the shared RESULT_CACHE and returns them.
+        Failed parses (None) are never cached.
+        """
+        if RESULT_CACHE is not None and selectors is not None:
+            RESULT_CACHE.set("easydmarc", "selectors", self.domain, [selector["name"] for selector in selectors])
+        return selectors
+
+    def easydmarc_url(self) -> str:
+        return f"{EASYDMARC_URL}/tools/dkim-lookup/status?domain={self.domain}&amp;selector=auto"
 
+    def parse_selectors(self, html:str):
+        """
+        Parses the selectors out of an EasyDMARC DKIM lookup response, see find_easydmarc_selectors().
+        """
         #--PARSE EasyDMARC RESPONSE--
         #response from EasyDMARC will be in HTML format
         #each selector is in a div with the class "title"
         
         #Determine if there are no selectors for the domain
         #EasyDMARC will return a div with the class "mb-4 no-data-title" if there are no selectors
-        no_selectors_for_domain = re.search(r'<div class="mb-4 no-data-title">no selectors detected</div>', response.text)
+        no_selectors_for_domain = re.search(r'<div class="mb-4 no-data-title">no selectors detected</div>', html)
         if no_selectors_for_domain:
             return [] #cause DKIM check to fail if there are no selectors for the domain
         
         #if there are selectors, EasyDMARC will return a div with the class "title"
         #this regex will find all the selectors
-        matches = re.findall(r'<div class="title " style="font-size: 18px;">(.*?)</div>', response.text)
+        matches = re.findall(r'<div class="title " style="font-size: 18px;">(.*?)</div>', html)
 
         selectors = []
         if matches:
             for match in matches:
-                selectors.append({"name": match})
+                selectors.append(selector_result(match))
             return selectors
         else:
             return None #failed to find selectors from response
         
+    @METRICS.timed("check_dkim")
     def check_dkim(self):
         """
         Collects DKIM data for each selector from MXToolbox.
+        Selectors are looked up concurrently, up to max_workers at a time.
         Checks each selector for failed MXtoolbox checks.
 
         MXToolbox data is stored in each selectors dictionary.
@@ -129,55 +3836,32 @@ class dkim_check:
             
         
         """
-        for selector in self.selectors:
-            selector_domain_name = selector["name"] + '._domainkey.' + self.domain            
-            #--QUERY MXTOOLBOX FOR DKIM--
-            #mxtoolbox requires authentication to query their tools
-            #they do provide a free API, but you'll need an API key
-            #using this method is more user friendly as it automatically generates a temporary authentication key
-
-            #this will query mxtoolbox for a temporary authentication key
-            temp_auth_mxtoolbox_url = f"https://mxtoolbox.com/api/v1/user"
-            temp_auth = self.query(temp_auth_mxtoolbox_url)
-            temp_auth_json = temp_auth.json()
-            #print(json.dumps(temp_auth_json, indent=4, sort_keys=True))
-            temp_auth_key = temp_auth_json["TempAuthKey"]
-            
-            #this will run the MXToolbox DKIM check
-            dkim_mxtoolbox_url = f"https://mxtoolbox.com/api/v1/lookup?command=dkim&argument={selector_domain_name}&resultIndex=1&disableRhsbl=true&format=0"
-            mxtoolbox_headers = {
-                "Tempauthorization": temp_auth_key,
-                "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
-            }
-            response = self.query(dkim_mxtoolbox_url, headers=mxtoolbox_headers)
-            mxtoolbox_selector_dkim_lookup_json = response.json()
-            #print(json.dumps(response.json(), indent=4, sort_keys=True))
-
-            #--SAVE MXTOOLBOX DKIM DATA--
-            selector["failed"] = mxtoolbox_selector_dkim_lookup_json["Failed"]
-            selector["warnings"] = mxtoolbox_selector_dkim_lookup_json["Warnings"]
-            selector["passed"] = mxtoolbox_selector_dkim_lookup_json["Passed"]
-            if mxtoolbox_selector_dkim_lookup_json["Information"] == []:
-                selector["record-content"] = ""
-            else:
-                selector["record-content"] = str(mxtoolbox_selector_dkim_lookup_json["Information"][0]["Description"])
-            selector["information"] = mxtoolbox_selector_dkim_lookup_json["Information"]
-            selector["errors"] = mxtoolbox_selector_dkim_lookup_json["Errors"]
-            selector["timeouts"] = mxtoolbox_selector_dkim_lookup_json["Timeouts"]
-            selector["is_testing_selector"] = False #default value is False
-            
-            #--CHECK IF DKIM RECORD IS A TEST RECORD--
-            for information in selector["information"]:
-                if information["Tag"] == "t": #t tag means it's a testing DKIM record
-                    selector["is_testing_selector"] = True
-                    break
-            
-            #--CHECK IF DKIM RECORD HAS ANY FAILED CHECKS--        
-            if selector["failed"] == []:
-                selector["valid"] = True
-            else:
-                selector["valid"] = False
+        #--QUERY MXTOOLBOX FOR EACH SELECTOR CONCURRENTLY--
+        #each lookup only writes to its own selector dictionary, and runs in a copy of the context so the domain's deadline still applies
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(self.selectors)))) as executor:
+            futures = [context_submit(executor, self.lookup_selector, selector) for selector in self.selectors]
+            for future in futures:
+                future.result()
         
+        self.evaluate_selectors()
+
+    @METRICS.timed("check_dkim")
+    async def check_dkim_async(self):
+        """
+        asyncio version of check_dkim(), up to max_workers selectors are looked up at the same time.
+        """
+        limit = asyncio.Semaphore(max(1, self.max_workers))
+        async def lookup(selector:dict):
+            async with limit:
+                await self.lookup_selector_async(selector)
+        await asyncio.gather(*[lookup(selector) for selector in self.selectors])
+        
+        self.evaluate_selectors()
+
+    def evaluate_selectors(self):
+        """
+        Sets the DKIM result, failures and warnings from the selector data collected by check_dkim().
+        """
         #--CHECK IF DKIM CHECK FAILED--
         #if any non-testing selector is not valid, then the DKIM check fails
         for selector in self.selectors:
@@ -187,6 +3871,13 @@ class dkim_check:
                 return
             else:
                 self.result = "PASS"
+        #--CHECK IF ANY SELECTOR COULD NOT BE CHECKED--
+        #the DKIM result is unknown, not passed, if a selector's lookup timed out or failed
+        for selector in self.selectors:
+            if selector["valid"] is None:
+                self.warnings.append(f"Selector {selector['name']} could not be checked - {selector.result}")
+                if self.result == "PASS":
+                    self.result = selector.result
         #--Produce warnings if any testing selector has failed checks--
         for selector in self.selectors:
             if selector["is_testing_selector"] == True and selector["valid"] == False:
@@ -208,49 +3899,61 @@ class dkim_check:
         if total_selectors == testing_selectors:
             self.warnings.append(f"All selectors are test selectors for {self.domain}. Please add a non-testing selector to your domain.")
         
-    def query(self, endpoint:str, headers:str="", impersonate:str="chrome110"):
+    def lookup_selector(self, selector:dict):
         """
-        -runs a GET request against the provided endpoint and returns the raw requests.Session() GET response
-        -slowly retries up to 5 times if the request fails
-        -impersontates chrome110 by default - this gets around TLS fingerprinting, as
-        mxtoolbox will block any traffic (returns 401) using the requests library TLS fingerprint. 
-        
+        Collects the MXToolbox DKIM data for a single selector and stores it in the selector's dictionary.
         """
-        session = requests.Session()
-        retries = 5
-        num_of_trys = 0
-        while num_of_trys < retries:
-            try:
-                response = session.get(endpoint, headers=headers, impersonate=impersonate)
-                response.raise_for_status() #check if the status isn't successful
-                return response
-            
-            except requests.exceptions.HTTPError as http_err:
-                if response.status_code == 401: #no need to retry if the error is 401
-                    raise Exception(f"Unauthorized access to {endpoint}. Please check your credentials. - {response.status_code} - {response.reason} - {response.text}")
-                num_of_trys += 1
-                time.sleep(1)
-            except Exception as err: #generic and unknown errors that don't fall under HTTPError
-                raise Exception(f"Failed to query {endpoint} with error: {err}")
-        #this exception will only trigger if num_of_trys is less than retries - i.e it tried 5 times
-        raise Exception(f"Failed to query {endpoint} after 5 retries. Last HTTP status code: {response.status_code} - {response.reason} - {response.text}")
-            
+        selector_domain_name = selector["name"] + '._domainkey.' + self.domain            
+        #--QUERY MXTOOLBOX FOR DKIM--
+        #the TempAuthKey is shared between all selectors and checks, see mxtoolbox_auth
+        mxtoolbox_selector_dkim_lookup_json = self.backend.lookup("dkim", selector_domain_name, query=self.query, auth=self.auth)
+        #print(json.dumps(mxtoolbox_selector_dkim_lookup_json, indent=4, sort_keys=True))
+        self.save_selector_data(selector, mxtoolbox_selector_dkim_lookup_json)
+
+    async def lookup_selector_async(self, selector:dict):
+        """
+        asyncio version of lookup_selector().
+        """
+        selector_domain_name = selector["name"] + '._domainkey.' + self.domain
+        mxtoolbox_selector_dkim_lookup_json = await self.backend.lookup_async("dkim", selector_domain_name, query=self.query_async, auth=self.auth)
+        self.save_selector_data(selector, mxtoolbox_selector_dkim_lookup_json)
+
+    def save_selector_data(self, selector:selector_result, mxtoolbox_selector_dkim_lookup_json:dict):
+        """
+        Stores an MXToolbox DKIM lookup response in the selector's selector_result.
+        """
+        #--SAVE MXTOOLBOX DKIM DATA--
+        selector.load(mxtoolbox_selector_dkim_lookup_json)
+
+
+class spf_check(base_check):
+    RESULTS = base_check.RESULTS + ("passed", "record_content", "information", "errors", "timeouts")
+
+    def __init__(self, domain:str, auth:mxtoolbox_auth=None, run:bool=None, backend:lookup_backend|str=None):
+        """
+        -run is None (lazy, default), True or False, see base_check
+        -backend is the provider the results come from, e.g "mxtoolbox" or "dns" (default: BACKEND)
+        """
+        super().__init__(domain, auth=auth, backend=backend)
 
-class spf_check:
-    def __init__(self, domain:str):
-        self.result = None
-        #domain arg must be a string and cannot be empty
-        if type(domain) is not str:
-            raise Exception("Domain must be a string.")
-        elif domain is None:
-            raise Exception("Domain cannot be empty.")
-        else:
-            self.domain = domain
-        
         #DO SPF CHECKS
+        self.start(run)
+
+    def run(self):
+        """
+        Runs the SPF checks.
+        """
+        self.reset()
         self.check_spf()
-        
 
+    async def run_async(self):
+        """
+        asyncio version of run(), the lookup is done on the shared ASYNC_HTTP_CLIENT.
+        """
+        self.reset()
+        await self.check_spf_async()
+
+    @METRICS.timed("check_spf")
     def check_spf(self):
             """
             Queries MXToolbox SPF Check .
@@ -258,171 +3961,679 @@ class spf_check:
             """
             
             #--QUERY MXTOOLBOX FOR SPF--
-            #mxtoolbox requires authentication to query their tools
-            #they do provide a free API, but you'll need an API key
-            #using this method is more user friendly as it automatically generates a temporary authentication key
-
-            #this will query mxtoolbox for a temporary authentication key
-            temp_auth_mxtoolbox_url = f"https://mxtoolbox.com/api/v1/user"
-            temp_auth = self.query(temp_auth_mxtoolbox_url)
-            temp_auth_json = temp_auth.json()
-            #print(json.dumps(temp_auth_json, indent=4, sort_keys=True))
-            temp_auth_key = temp_auth_json["TempAuthKey"]
-                
-            #this will run the MXToolbox DKIM check
-            spf_mxtoolbox_url = f"https://mxtoolbox.com/api/v1/lookup?command=spf&argument={self.domain}&resultIndex=1&disableRhsbl=true&format=0"
-            mxtoolbox_headers = {
-                "Tempauthorization": temp_auth_key,
-                "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
-            }
-            response = self.query(spf_mxtoolbox_url, headers=mxtoolbox_headers)
-            spf_response_json = response.json()
+            #the TempAuthKey is shared between all selectors and checks, see mxtoolbox_auth
+            spf_response_json = self.backend.lookup("spf", self.domain, query=self.query, auth=self.auth)
             #print(json.dumps(spf_response_json, indent=4, sort_keys=True))
 
-            #--SAVE MXTOOLBOX SPF DATA--
-            self.failures = spf_response_json["Failed"]
-            self.warnings = spf_response_json["Warnings"]
-            self.passed = spf_response_json["Passed"]
-            if spf_response_json["Information"] == []:
-                self.record_content = ""
-            else:
-                self.record_content = str(spf_response_json["Information"][0]["Description"])
-            self.information = spf_response_json["Information"]
-            self.errors = spf_response_json["Errors"]
-            self.timeouts = spf_response_json["Timeouts"]
+            self.save_spf_data(spf_response_json)
 
-            #--CHECK IF SPF CHECK FAILED--
-            if self.failures == []:
-                self.result = "PASS"
+    @METRICS.timed("check_spf")
+    async def check_spf_async(self):
+        """
+        asyncio version of check_spf().
+        """
+        spf_response_json = await self.backend.lookup_async("spf", self.domain, query=self.query_async, auth=self.auth)
+        self.save_spf_data(spf_response_json)
+
+    def save_spf_data(self, response_json:dict):
+        """
+        Stores an MXToolbox SPF lookup response and sets the SPF result.
+        passed, record_content, information, errors and timeouts are read from self.details, see spf_result.
+        """
+        #--SAVE MXTOOLBOX SPF DATA--
+        self.details = spf_result(response_json)
+        self.failures = self.details.failed
+        self.warnings = self.details.warnings
+        self.result = self.details.result
+
+
+class dmarc_check(base_check):
+    RESULTS = base_check.RESULTS + ("passed", "record_content", "information", "errors", "timeouts")
+
+    def __init__(self, domain:str, auth:mxtoolbox_auth=None, run:bool=None, backend:lookup_backend|str=None):
+        """
+        -run is None (lazy, default), True or False, see base_check
+        -backend is the provider the results come from, e.g "mxtoolbox" or "dns" (default: BACKEND)
+        """
+        super().__init__(domain, auth=auth, backend=backend)
+
+        #DO DMARC CHECKS
+        self.start(run)
+
+    def run(self):
+        """
+        Runs the DMARC checks.
+        """
+        self.reset()
+        self.check_dmarc()
+
+    async def run_async(self):
+        """
+        asyncio version of run(), the lookup is done on the shared ASYNC_HTTP_CLIENT.
+        """
+        self.reset()
+        await self.check_dmarc_async()
+
+    @METRICS.timed("check_dmarc")
+    def check_dmarc(self):
+            """
+            Queries MXToolbox DMARC Check .
+            Checks for failed MXtoolbox checks.
+            """
+            
+            #--QUERY MXTOOLBOX FOR DMARC--
+            #the TempAuthKey is shared between all selectors and checks, see mxtoolbox_auth
+            dmarc_response_json = self.backend.lookup("dmarc", self.domain, query=self.query, auth=self.auth)
+            #print(json.dumps(dmarc_response_json, indent=4, sort_keys=True))
+
+            self.save_dmarc_data(dmarc_response_json)
+
+    @METRICS.timed("check_dmarc")
+    async def check_dmarc_async(self):
+        """
+        asyncio version of check_dmarc().
+        """
+        dmarc_response_json = await self.backend.lookup_async("dmarc", self.domain, query=self.query_async, auth=self.auth)
+        self.save_dmarc_data(dmarc_response_json)
+
+    def save_dmarc_data(self, response_json:dict):
+        """
+        Stores an MXToolbox DMARC lookup response and sets the DMARC result.
+        passed, record_content, information, errors and timeouts are read from self.details, see dmarc_result.
+        """
+        #--SAVE MXTOOLBOX DMARC DATA--
+        self.details = dmarc_result(response_json)
+        self.failures = self.details.failed
+        self.warnings = self.details.warnings
+        self.result = self.details.result
+      
+
+class mx_check(base_check):
+    RESULTS = base_check.RESULTS + ("passed", "record_content", "information", "errors", "timeouts", "hosts")
+    MX_URL = "https://www.rfc-editor.org/rfc/rfc5321#section-5.1"
+    NULL_MX_URL = "https://www.rfc-editor.org/rfc/rfc7505"
+    STARTTLS_URL = "https://www.rfc-editor.org/rfc/rfc3207"
+
+    def __init__(self, domain:str, run:bool=None, starttls:bool=None, hosts:mx_host_checker=None):
+        """
+        -run is None (lazy, default), True or False, see base_check
+        -the MX records and mail hosts are always looked up over DNS, whatever the backend of the other checks
+        -starttls is whether the mail hosts are probed for STARTTLS on port 25, None uses MX_STARTTLS
+        -hosts is the mx_host_checker that checks and caches the mail hosts (default: MX_HOSTS)
+        """
+        super().__init__(domain)
+        self.starttls = MX_STARTTLS if starttls is None else starttls
+        self.host_checker = hosts if hosts is not None else MX_HOSTS
+
+        #DO MX CHECKS
+        self.start(run)
+
+    def run(self):
+        """
+        Runs the MX checks.
+        """
+        self.reset()
+        self.check_mx()
+
+    async def run_async(self):
+        """
+        asyncio version of run(), the queries and probes are done on the running event loop.
+        """
+        self.reset()
+        await self.check_mx_async()
+
+    @METRICS.timed("check_mx")
+    def check_mx(self):
+        """
+        Resolves the domain's MX records, then checks every mail host at the same time, see mx_host_checker.
+        """
+        try:
+            answer = self.host_checker.resolver.resolve(self.domain, "MX")
+        except dns_timeout_error as err:
+            self.save_mx_data(dns_backend.timeout_result(err))
+            return
+        host_results = self.host_checker.check_hosts(self.mail_hosts(answer), self.starttls)
+        self.save_mx_data(self.evaluate(answer, host_results))
+
+    @METRICS.timed("check_mx")
+    async def check_mx_async(self):
+        """
+        asyncio version of check_mx().
+        """
+        try:
+            answer = await self.host_checker.resolver.resolve_async(self.domain, "MX")
+        except dns_timeout_error as err:
+            self.save_mx_data(dns_backend.timeout_result(err))
+            return
+        host_results = await self.host_checker.check_hosts_async(self.mail_hosts(answer), self.starttls)
+        self.save_mx_data(self.evaluate(answer, host_results))
+
+    @staticmethod
+    def mail_hosts(answer:dns_answer) -> list:
+        """
+        Returns the mail hosts to check from an MX answer, without duplicates and without a null MX.
+        """
+        if answer.rcode != 0:
+            return []
+        return list(dict.fromkeys(host for _, host in answer.records if host not in ("", ".")))
+
+    def evaluate(self, answer:dns_answer, host_results:dict) -> dict:
+        """
+        Turns the MX answer and the results of its mail hosts into an MXToolbox style result,
+        with the mail hosts in an extra "Hosts" list.
+        """
+        item = dns_backend.item
+        result = dns_backend.new_result()
+        result["Hosts"] = []
+        if answer.rcode not in (0, 3): #anything other than NOERROR or NXDOMAIN
+            result["Errors"].append(item("DNS Lookup", f"DNS server returned response code {answer.rcode} for {answer.name}", ""))
+            return result
+        records = sorted(answer.records)
+        if not records:
+            result["Failed"].append(item("MX Records Published", f"No MX records found for {self.domain}", self.MX_URL))
+            return result
+
+        #--NULL MX--
+        null_records = [record for record in records if record[1] in ("", ".")]
+        if null_records:
+            result["Information"].extend({"Preference": preference, "Hostname": ".", "Description": f"{preference} ."} for preference, _ in null_records)
+            if len(records) == 1:
+                result["Passed"].append(item("Null MX", f"{self.domain} publishes a null MX record, it does not accept email", self.NULL_MX_URL))
+                return result
+            result["Failed"].append(item("Null MX", "A null MX record must be the only MX record of the domain", self.NULL_MX_URL))
+
+        #--MAIL HOSTS--
+        unresolved = []
+        for preference, host in records:
+            if host in ("", "."):
+                continue
+            host_result = host_results[host]
+            result["Information"].append({"Preference": preference, "Hostname": host, "Description": f"{preference} {host}"})
+            result["Hosts"].append({"preference": preference, **host_result})
+            if host_result["addresses"] or host_result["ipv6"]:
+                continue
+            if host_result["error"]:
+                #a host that couldn't be looked up makes the check TIMEOUT or ERROR, not PASS
+                result["Timeouts" if host_result["timed_out"] else "Errors"].append(item("MX Host Lookup", f"{host} - {host_result['error']}", ""))
             else:
-                self.result = "FAIL"
+                unresolved.append(host)
+        if any(re.fullmatch(r"[0-9.]+|[0-9a-f]*:[0-9a-f:.]*", host) for _, host in records):
+            result["Failed"].append(item("MX Host Is A Name", "MX records must point to host names, not IP addresses", self.MX_URL))
+        if unresolved:
+            result["Failed"].append(item("MX Hosts Resolve", f"{', '.join(unresolved)} has no A or AAAA record", self.MX_URL))
+        elif not result["Errors"] and not result["Timeouts"]:
+            result["Passed"].append(item("MX Hosts Resolve", f"All {len(result['Hosts'])} MX hosts have an A or AAAA record", self.MX_URL))
+        if len(result["Hosts"]) == 1:
+            result["Warnings"].append(item("Redundant MX Hosts", "Only one MX host, mail waits in the senders' queues while it is down", self.MX_URL))
+
+        #--STARTTLS--
+        if self.starttls:
+            probed = [host for host in result["Hosts"] if host["starttls"] is not None]
+            for host in result["Hosts"]:
+                #many networks block outgoing port 25, so a probe that couldn't connect doesn't make the check an ERROR
+                if host["starttls"] is None and (host["addresses"] or host["ipv6"]) and host["error"]:
+                    result["Warnings"].append(item("STARTTLS Probe", host["error"], self.STARTTLS_URL))
+            plaintext = [host["host"] for host in probed if not host["starttls"]]
+            if plaintext:
+                result["Warnings"].append(item("STARTTLS", f"{', '.join(plaintext)} does not offer STARTTLS, mail to it is sent unencrypted", self.STARTTLS_URL))
+            elif probed:
+                result["Passed"].append(item("STARTTLS", f"All {len(probed)} probed MX hosts offer STARTTLS", self.STARTTLS_URL))
+        return result
+
+    def save_mx_data(self, response_json:dict):
+        """
+        Stores an MX result and sets the MX result.
+        passed, record_content, information, errors, timeouts and hosts are read from self.details, see mx_result.
+        """
+        self.details = mx_result(response_json)
+        self.failures = self.details.failed
+        self.warnings = self.details.warnings
+        self.result = self.details.result
+
+CHECK_NAMES = ("dkim", "spf", "dmarc", "mx") #the result keys of do_all_checks(), besides "domain"
+MX_CHECK = False #whether do_all_checks() runs the MX check when it isn't told, see --mx
+
+def do_all_checks(domain:str, selector:str|list=None, parallel:bool=False, backend:lookup_backend|str=None, deadline:float=None, mx:bool=None) -> dict:
+    """
+    Runs all checks for a domain.
+    Returns a dictionary of the results.
+
+    -deadline is the maximum number of seconds spent on the domain's requests, including retries,
+    once it runs out the remaining requests raise deadline_exceeded_error. None means no deadline
+
+    -if parallel is True, the DKIM, SPF and DMARC checks run at the same time, so the domain takes
+    about as long as its slowest check instead of the sum of all three
+    -in parallel mode an exception raised by one check is stored in that check's result slot
+    (e.g results["spf"] is the Exception) instead of discarding the results of the other checks
+
+    -if mx is True the domain's MX records and mail hosts are checked as well (results["mx"]), see mx_check.
+    None uses MX_CHECK. The MX check only uses DNS (and SMTP), so it always runs next to the other checks,
+    also when parallel is False
+    """
+    if mx is None:
+        mx = MX_CHECK
+    results = {}
+    results["domain"] = domain
+    with domain_deadline(deadline):
+        if not parallel:
+            with contextlib.ExitStack() as stack:
+                mx_future = context_submit(stack.enter_context(ThreadPoolExecutor(max_workers=1)), mx_check, domain, run=True) if mx else None
+                results["dkim"] = dkim_check(domain, selector, run=True, backend=backend)
+                results["spf"] = spf_check(domain, run=True, backend=backend)
+                results["dmarc"] = dmarc_check(domain, run=True, backend=backend)
+                if mx_future is not None:
+                    results["mx"] = mx_future.result()
+            return results
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {
+                "dkim": context_submit(executor, dkim_check, domain, selector, run=True, backend=backend),
+                "spf": context_submit(executor, spf_check, domain, run=True, backend=backend),
+                "dmarc": context_submit(executor, dmarc_check, domain, run=True, backend=backend)
+            }
+            if mx:
+                futures["mx"] = context_submit(executor, mx_check, domain, run=True)
+            for check_name, future in futures.items():
+                try:
+                    results[check_name] = future.result()
+                except Exception as err:
+                    results[check_name] = err
+    return results
+
+async def async_do_all_checks(domain:str, selector:str|list=None, backend:lookup_backend|str=None, deadline:float=None, mx:bool=None) -> dict:
+    """
+    asyncio version of do_all_checks().
+    The DKIM, SPF, DMARC (and MX) checks run concurrently on the running event loop, and like the parallel
+    mode of do_all_checks() an exception raised by one check is stored in that check's result slot.
+    """
+    if mx is None:
+        mx = MX_CHECK
+    results = {}
+    results["domain"] = domain
+    checks = {}
+    create_checks = [("dkim", lambda: dkim_check(domain, selector, run=False, backend=backend)),
+                     ("spf", lambda: spf_check(domain, run=False, backend=backend)),
+                     ("dmarc", lambda: dmarc_check(domain, run=False, backend=backend))]
+    if mx:
+        create_checks.append(("mx", lambda: mx_check(domain, run=False)))
+    for check_name, create_check in create_checks:
+        try:
+            checks[check_name] = create_check()
+        except Exception as err:
+            results[check_name] = err
+    
+    with domain_deadline(deadline):
+        outcomes = await asyncio.gather(*[check.run_async() for check in checks.values()], return_exceptions=True)
+    for (check_name, check), outcome in zip(checks.items(), outcomes):
+        results[check_name] = outcome if isinstance(outcome, BaseException) else check
+    return {key: results[key] for key in ("domain",) + CHECK_NAMES if key in results}
+
+def read_domains(file) -> iter:
+    """
+    Yields the domains from a file object, one domain per line.
+    Blank lines and lines starting with # are skipped.
+    The file is read lazily, so very large domain lists are never fully loaded into memory.
+    """
+    for line in file:
+        domain = line.strip()
+        if domain and not domain.startswith("#"):
+            yield domain
+
+def bulk_scan(domains, selector:str|list=None, workers:int=10, rate:float=None, provider_limits:dict=None, deadline:float=None, provider_rates:dict=None, checkpoint:"scan_checkpoint"=None, backend:lookup_backend|str=None) -> iter:
+    """
+    Runs do_all_checks() (in parallel mode) for many domains at once and yields each domain's results
+    as soon as it finishes - results are NOT yielded in the order of the input.
+
+    -domains can be any iterable, e.g read_domains(), it is only read as workers become free
+    -workers is the global limit of domains checked at the same time
+    -rate is the maximum number of domains started per second, None means no limit
+    -provider_limits is a dictionary of host -> maximum concurrent requests for that provider,
+    e.g {"mxtoolbox.com": 5, "easydmarc.com": 2}. These limits are applied to the shared HTTP_CLIENT and SCHEDULER
+    -provider_rates is a dictionary of host -> maximum requests per second for that provider, shared by every
+    worker through SCHEDULER. Below these limits, the concurrency per provider adapts to its latency and errors
+    -deadline is the per-domain deadline in seconds, see do_all_checks()
+    -checkpoint is an optional scan_checkpoint, domains it has already recorded are skipped, and each domain
+    is recorded once the caller has handled its results (i.e when the next result is requested)
+    -backend is passed to do_all_checks(), None uses the default BACKEND
+    """
+    if provider_limits:
+        for host, limit in provider_limits.items():
+            HTTP_CLIENT.set_host_limit(host, limit)
+            SCHEDULER.set_max_limit(host, limit)
+    if provider_rates:
+        for host, host_rate in provider_rates.items():
+            SCHEDULER.set_rate(host, host_rate)
+
+    #domains are numbered by their position in the input, so the checkpoint can record them
+    domains = checkpoint.pending(domains) if checkpoint is not None else enumerate(domains)
+    next_start = time.monotonic()
+    pending = {} #future -> input index
+    no_more_domains = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            #--KEEP THE WORKERS BUSY--
+            while not no_more_domains and len(pending) < workers:
+                try:
+                    index, domain = next(domains)
+                except StopIteration:
+                    no_more_domains = True
+                    break
+                if rate:
+                    #space out domain starts so no more than rate domains are started per second
+                    delay = next_start - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_start = max(next_start, time.monotonic()) + 1 / rate
+                pending[executor.submit(do_all_checks, domain, selector, True, backend=backend, deadline=deadline)] = index
+            
+            if not pending:
+                break
+            
+            #--YIELD FINISHED DOMAINS--
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                yield future.result()
+                if checkpoint is not None:
+                    checkpoint.record(index)
+
+#--JSON OUTPUT--
+def check_to_dict(check) -> dict:
+    """
+    Returns a JSON serialisable dictionary of a dkim_check, spf_check, dmarc_check or mx_check.
+    A check that raised an exception is returned as {"result": "ERROR", "error": message}.
+    """
+    if isinstance(check, BaseException):
+        return {"result": "ERROR", "error": str(check), "error_type": type(check).__name__}
+    check_dict = {"result": check.result, "failures": plain_value(check.failures), "warnings": plain_value(check.warnings)}
+    if isinstance(check, dkim_check):
+        check_dict["selectors"] = plain_value(check.selectors) if check.selectors is not None else []
+        return check_dict
+    for attribute in ("passed", "record_content", "information", "errors", "timeouts"):
+        check_dict[attribute] = plain_value(getattr(check, attribute, None))
+    if isinstance(check, mx_check):
+        check_dict["hosts"] = plain_value(check.hosts)
+    return check_dict
+
+def result_to_dict(results:dict) -> dict:
+    """
+    Returns a JSON serialisable dictionary of the results of do_all_checks().
+    """
+    return {"domain": results["domain"], **{check_name: check_to_dict(results[check_name]) for check_name in CHECK_NAMES if check_name in results}}
+
+def result_to_json(results:dict) -> str:
+    """
+    Returns the results of do_all_checks() as a single JSON line (without the newline).
+    """
+    return json.dumps(result_to_dict(results), separators=(",", ":"), default=str)
+
+class jsonl_writer:
+    """
+    Writes one JSON line per domain to a file object (e.g sys.stdout) and flushes it straight away,
+    so results can be read (e.g with tail -f or jq) while a scan is still running.
+    """
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, results:dict):
+        self.file.write(result_to_json(results) + "\n")
+        self.file.flush()
+
+class scan_checkpoint:
+    """
+    Records which domains of an input have been finished, so an interrupted bulk scan can be resumed
+    without redoing them. Domains are identified by their position (index) in the input.
+    -results are finished out of order, so the checkpoint stores a low-water mark (every index below it is
+    finished) plus the few finished indexes above it. Its size depends on the number of workers, not on the input
+    -the file is rewritten atomically after every finished domain
+    -source is stored in the file (e.g the input file's path), resuming with a different source raises an exception
+    """
+    def __init__(self, path:str, source:str=None):
+        self.path = path
+        self.source = source
+        self.low_water_mark = 0 #every index below this is finished
+        self.finished = set() #finished indexes above the low-water mark
+        if os.path.exists(path):
+            with open(path, "r") as checkpoint_file:
+                state = json.load(checkpoint_file)
+            if source is not None and state.get("source") not in (None, source):
+                raise Exception(f"Checkpoint {path} is for {state['source']}, not {source}.")
+            self.low_water_mark = state["low_water_mark"]
+            self.finished = set(state["finished"])
+
+    @property
+    def count(self) -> int:
+        """
+        Number of finished domains.
+        """
+        return self.low_water_mark + len(self.finished)
+
+    def pending(self, domains) -> iter:
+        """
+        Yields (index, domain) for every domain of the input that isn't finished yet.
+        """
+        for index, domain in enumerate(domains):
+            if index >= self.low_water_mark and index not in self.finished:
+                yield index, domain
+
+    def record(self, index:int):
+        """
+        Marks the domain at index as finished and saves the checkpoint.
+        """
+        self.finished.add(index)
+        while self.low_water_mark in self.finished:
+            self.finished.remove(self.low_water_mark)
+            self.low_water_mark += 1
+        self.save()
+
+    def save(self):
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as checkpoint_file:
+            json.dump({"source": self.source, "low_water_mark": self.low_water_mark, "finished": sorted(self.finished)}, checkpoint_file)
+        os.replace(temporary_path, self.path)
+
+#--SHARDING--
+def shard_of(domain:str, shards:int) -> int:
+    """
+    Returns the shard (0 to shards - 1) of a domain with jump consistent hashing.
+    -the same domain always goes to the same shard, on every process and machine
+    -going from n to n + 1 shards only moves 1/(n + 1) of the domains
+    """
+    key = int.from_bytes(hashlib.sha1(domain.lower().rstrip(".").encode()).digest()[:8], "big")
+    bucket, jump = -1, 0
+    while jump < shards:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+def shard_domains(domains, shards:int, shard_index:int) -> iter:
+    """
+    Yields the domains that belong to shard_index out of shards, see shard_of().
+    """
+    for domain in domains:
+        if shard_of(domain, shards) == shard_index:
+            yield domain
+
+class work_queue:
+    """
+    Work queue in a shared directory (e.g a network share), so several processes or machines can scan one domain list.
+    -the list is split into chunk files in pending/, a worker claims a chunk by atomically moving it to claimed/,
+    and once the chunk is finished its results are written to results/<chunk>.jsonl
+    -a claim that hasn't been touched for claim_timeout seconds is moved back to pending/ (its worker died), so an
+    interrupted scan resumes by running the same command again. A chunk can then be scanned twice, merge_results()
+    keeps one result per domain
+    """
+    def __init__(self, path:str, claim_timeout:float=600):
+        self.path = path
+        self.claim_timeout = claim_timeout
+        for directory in ("pending", "claimed", "results"):
+            os.makedirs(os.path.join(path, directory), exist_ok=True)
+
+    @property
+    def ready(self) -> bool:
+        """
+        True once every chunk of the domain list has been added.
+        """
+        return os.path.exists(os.path.join(self.path, "ready"))
+
+    @property
+    def finished(self) -> bool:
+        """
+        True once every chunk of the domain list has been added and scanned, none is pending or claimed.
+        """
+        #claimed/ is listed again after pending/, so a chunk that moves between them while they are listed is seen
+        return self.ready and not any(os.listdir(os.path.join(self.path, directory)) for directory in ("claimed", "pending", "claimed"))
 
-    def query(self, endpoint:str, headers:str="", impersonate:str="chrome110"):
+    def add(self, domains, chunk_size:int=100) -> bool:
         """
-        -runs a GET request against the provided endpoint and returns the raw requests.Session() GET response
-        -slowly retries up to 5 times if the request fails
-        -impersontates chrome110 by default - this gets around TLS fingerprinting, as
-        mxtoolbox will block any traffic (returns 401) using the requests library TLS fingerprint. 
-        
+        Splits the domains into chunks of chunk_size domains and adds them to the queue.
+        Only the first worker to call add() on a queue adds its domains, the others return False and share its chunks.
+        -the adding worker touches adding/ after every chunk. If it hasn't been touched for claim_timeout seconds and
+        the list isn't ready, the worker died while adding, and the next worker to call add() takes over
+        -chunks are numbered by their position in the list, so a worker that takes over skips the chunks that are
+        already pending, claimed or finished
         """
-        session = requests.Session()
-        retries = 5
-        num_of_trys = 0
-        while num_of_trys < retries:
+        adding = os.path.join(self.path, "adding")
+        try:
+            os.mkdir(adding)
+        except FileExistsError:
             try:
-                response = session.get(endpoint, headers=headers, impersonate=impersonate)
-                response.raise_for_status() #check if the status isn't successful
-                return response
-            
-            except requests.exceptions.HTTPError as http_err:
-                if response.status_code == 401: #no need to retry if the error is 401
-                    raise Exception(f"Unauthorized access to {endpoint}. Please check your credentials. - {response.status_code} - {response.reason} - {response.text}")
-                num_of_trys += 1
-                time.sleep(1)
-            except Exception as err: #generic and unknown errors that don't fall under HTTPError
-                raise Exception(f"Failed to query {endpoint} with error: {err}")
-        #this exception will only trigger if num_of_trys is less than retries - i.e it tried 5 times
-        raise Exception(f"Failed to query {endpoint} after 5 retries. Last HTTP status code: {response.status_code} - {response.reason} - {response.text}")
-            
-class dmarc_check:
-    def __init__(self, domain:str):
-        self.result = None
-        #domain arg must be a string and cannot be empty
-        if type(domain) is not str:
-            raise Exception("Domain must be a string.")
-        elif domain is None:
-            raise Exception("Domain cannot be empty.")
-        else:
-            self.domain = domain
-        
-        #DO SPF CHECKS
-        self.check_dmarc()
-        
+                if self.ready or time.time() - os.path.getmtime(adding) < self.claim_timeout:
+                    return False
+            except FileNotFoundError: #removed by a worker that failed to add the list
+                return False
+        os.utime(adding)
+        try:
+            for number, chunk in enumerate(iter(lambda: list(itertools.islice(domains, chunk_size)), [])):
+                name = f"{number:08d}"
+                if any(os.path.exists(os.path.join(self.path, directory, name + extension)) for directory, extension in (("pending", ".txt"), ("claimed", ".txt"), ("results", ".jsonl"))):
+                    continue
+                temporary_path = os.path.join(self.path, f"{name}.{socket.gethostname()}.{os.getpid()}.tmp")
+                with open(temporary_path, "w") as chunk_file:
+                    chunk_file.write("\n".join(chunk) + "\n")
+                os.replace(temporary_path, os.path.join(self.path, "pending", f"{name}.txt"))
+                os.utime(adding)
+        except BaseException:
+            #the next worker to call add() takes over straight away
+            try:
+                os.rmdir(adding)
+            except OSError:
+                pass
+            raise
+        open(os.path.join(self.path, "ready"), "w").close()
+        return True
 
-    def check_dmarc(self):
-            """
-            Queries MXToolbox DMARC Check .
-            Checks for failed MXtoolbox checks.
-            """
-            
-            #--QUERY MXTOOLBOX FOR DMARC--
-            #mxtoolbox requires authentication to query their tools
-            #they do provide a free API, but you'll need an API key
-            #using this method is more user friendly as it automatically generates a temporary authentication key
-
-            #this will query mxtoolbox for a temporary authentication key
-            temp_auth_mxtoolbox_url = f"https://mxtoolbox.com/api/v1/user"
-            temp_auth = self.query(temp_auth_mxtoolbox_url)
-            temp_auth_json = temp_auth.json()
-            #print(json.dumps(temp_auth_json, indent=4, sort_keys=True))
-            temp_auth_key = temp_auth_json["TempAuthKey"]
-                
-            #this will run the MXToolbox DKIM check
-            dmarc_mxtoolbox_url = f"https://mxtoolbox.com/api/v1/lookup?command=dmarc&argument={self.domain}&resultIndex=1&disableRhsbl=true&format=0"
-            mxtoolbox_headers = {
-                "Tempauthorization": temp_auth_key,
-                "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
-            }
-            response = self.query(dmarc_mxtoolbox_url, headers=mxtoolbox_headers)
-            dmarc_response_json = response.json()
-            #print(json.dumps(dmarc_response_json, indent=4, sort_keys=True))
+    def requeue_stale(self):
+        """
+        Moves the claims older than claim_timeout back to pending/.
+        """
+        claimed = os.path.join(self.path, "claimed")
+        for chunk in os.listdir(claimed):
+            try:
+                if time.time() - os.path.getmtime(os.path.join(claimed, chunk)) >= self.claim_timeout:
+                    os.rename(os.path.join(claimed, chunk), os.path.join(self.path, "pending", chunk))
+            except FileNotFoundError: #finished or requeued by another worker
+                pass
 
-            #--SAVE MXTOOLBOX SPF DATA--
-            self.failures = dmarc_response_json["Failed"]
-            self.warnings = dmarc_response_json["Warnings"]
-            self.passed = dmarc_response_json["Passed"]
-            if dmarc_response_json["Information"] == []:
-                self.record_content = ""
-            else:
-                self.record_content = str(dmarc_response_json["Information"][0]["Description"])
-            self.information = dmarc_response_json["Information"]
-            self.errors = dmarc_response_json["Errors"]
-            self.timeouts = dmarc_response_json["Timeouts"]
+    def claim(self) -> tuple:
+        """
+        Claims the next pending chunk, returns (chunk, domains), or None if no chunk is pending.
+        """
+        self.requeue_stale()
+        for chunk in sorted(os.listdir(os.path.join(self.path, "pending"))):
+            pending_path = os.path.join(self.path, "pending", chunk)
+            claimed_path = os.path.join(self.path, "claimed", chunk)
+            try:
+                os.utime(pending_path) #the claim's age is its modification time
+                os.rename(pending_path, claimed_path)
+            except FileNotFoundError: #claimed by another worker
+                continue
+            with open(claimed_path, "r") as chunk_file:
+                return chunk, list(read_domains(chunk_file))
+        return None
 
-            #--CHECK IF SPF CHECK FAILED--
-            if self.failures == []:
-                self.result = "PASS"
-            else:
-                self.result = "FAIL"
+    def heartbeat(self, chunk:str):
+        """
+        Marks a claimed chunk as still being worked on.
+        """
+        try:
+            os.utime(os.path.join(self.path, "claimed", chunk))
+        except FileNotFoundError:
+            pass
 
-    def query(self, endpoint:str, headers:str="", impersonate:str="chrome110"):
+    def complete(self, chunk:str, lines:list):
         """
-        -runs a GET request against the provided endpoint and returns the raw requests.Session() GET response
-        -slowly retries up to 5 times if the request fails
-        -impersontates chrome110 by default - this gets around TLS fingerprinting, as
-        mxtoolbox will block any traffic (returns 401) using the requests library TLS fingerprint. 
-        
+        Stores the JSON lines of a finished chunk and removes its claim.
         """
-        session = requests.Session()
-        retries = 5
-        num_of_trys = 0
-        while num_of_trys < retries:
-            try:
-                response = session.get(endpoint, headers=headers, impersonate=impersonate)
-                response.raise_for_status() #check if the status isn't successful
-                return response
-            
-            except requests.exceptions.HTTPError as http_err:
-                if response.status_code == 401: #no need to retry if the error is 401
-                    raise Exception(f"Unauthorized access to {endpoint}. Please check your credentials. - {response.status_code} - {response.reason} - {response.text}")
-                num_of_trys += 1
-                time.sleep(1)
-            except Exception as err: #generic and unknown errors that don't fall under HTTPError
-                raise Exception(f"Failed to query {endpoint} with error: {err}")
-        #this exception will only trigger if num_of_trys is less than retries - i.e it tried 5 times
-        raise Exception(f"Failed to query {endpoint} after 5 retries. Last HTTP status code: {response.status_code} - {response.reason} - {response.text}")
-      
-def do_all_checks(domain:str, selector:str|list=None) -> dict:
+        results_path = os.path.join(self.path, "results", chunk.rsplit(".", 1)[0] + ".jsonl")
+        with open(f"{results_path}.tmp", "w") as results_file:
+            results_file.writelines(lines)
+        os.replace(f"{results_path}.tmp", results_path)
+        try:
+            os.remove(os.path.join(self.path, "claimed", chunk))
+        except FileNotFoundError:
+            pass
+
+def scan_queue(queue:work_queue, selector:str|list=None, poll_interval:float=1.0, domains=None, **scan_options) -> iter:
     """
-    Runs all checks for a domain.
-    Returns a dictionary of the results.
+    Claims chunks of a work_queue until every chunk has been scanned, and yields each domain's results like bulk_scan().
+    -domains is the domain list, it is added to the queue if no other worker has added it, see work_queue.add()
+    -while other workers hold the last claims, the worker keeps polling, so a claim whose worker died is
+    scanned once it times out
+    -scan_options (workers, rate, deadline...) are passed to bulk_scan() for each chunk
+    Stopping early leaves the current chunk claimed, it is picked up again once its claim times out.
     """
-    results = {}
-    results["domain"] = domain
-    results["dkim"] = dkim_check(domain, selector)
-    results["spf"] = spf_check(domain)
-    results["dmarc"] = dmarc_check(domain)
-    return results
+    while True:
+        if domains is not None and not queue.ready:
+            queue.add(domains) #only the first worker adds the list, or a worker that takes over from it
+        claimed = queue.claim()
+        if claimed is None:
+            if queue.finished:
+                return
+            time.sleep(poll_interval) #chunks are still being added, or scanned by other workers
+            continue
+        chunk, domains = claimed
+        lines = []
+        for results in bulk_scan(domains, selector, **scan_options):
+            lines.append(result_to_json(results) + "\n")
+            queue.heartbeat(chunk)
+            yield results
+        queue.complete(chunk, lines)
+
+def result_lines(path:str) -> iter:
+    """
+    Yields (offset, line) for every non-empty line of a JSONL result file, offset is the line's position in bytes.
+    """
+    with open(path, "rb") as results_file:
+        offset = 0
+        for line in results_file:
+            if line.strip():
+                yield offset, line
+            offset += len(line)
+
+def merge_results(paths:list) -> iter:
+    """
+    Yields one result dictionary per domain from JSONL result files (e.g the parts of a sharded scan),
+    a directory is read as every .jsonl file in it. When a domain appears more than once, the last result read is kept.
+    The files are read twice, first to find the position of each domain's last result, then to yield those results
+    one at a time, so only the positions are held in memory, not the results.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".jsonl")))
+        else:
+            files.append(path)
+    last = {} #domain -> (file number, offset) of its last result
+    for number, path in enumerate(files):
+        for offset, line in result_lines(path):
+            last[json.loads(line)["domain"]] = (number, offset)
+    for number, path in enumerate(files):
+        for offset, line in result_lines(path):
+            results = json.loads(line)
+            if last[results["domain"]] == (number, offset):
+                yield results
 
 def print_into_coulmns(list_:list, num_columns:int=2, colour:str=""):
     """
@@ -446,85 +4657,81 @@ def print_into_coulmns(list_:list, num_columns:int=2, colour:str=""):
         print()  # Move to the next line for the next row
 
 
-def main():
-    parser = argparse.ArgumentParser(description='')
-    parser.add_argument('-d', '--domain', dest='domain', help='Domain Name you want to test.', required=True)
-    parser.add_argument('-s', '--selector', dest='selector', help='DKIM Selector, can be extracted from email.', required=False)
-    parser.add_argument('-v', '--verbose', dest='verbose', help='Print detailed results.', action='store_true', required=False)
-    #parser.add_argument('-j', '--json', dest='json', help='Print results in JSON format.', action='store_true', required=False)
-    #parser.add_argument('-o', '--output', dest='output', help='Output results to a file.', required=False)
-    args = parser.parse_args()
-
-    #if only -j used, default will be use json.dumps to print to stdout
-    #if only -o used, default will be print to file
-    #if only -v used, default will be print detailed results
+OKGREEN = '\033[92m'
+OKBLUE = '\033[94m'
+OKCYAN = '\033[96m'
+ENDC = '\033[0m'
+FAIL = '\033[91m'
+PURPLE = '\033[95m'
+WARNING = '\033[93m'
+UNDERLINE_BLUE = '\033[4;34m'
+ORANGE = '\033[33m'
+BOLD = '\033[1m'
+BLINK = '\33[6m'
 
-    #if -o and -j used, print to file in json format
-    #if -o and -v used, print to file in detailed format
-
-    #if -j and -v used, raise exception
-    #if args.json and args.verbose:
-    #    raise Exception("Cannot use both -j (--json) and -v (--verbose) arguments.")
-    
+list_indent = " -  "
+indent = "    "
 
+def disable_colours():
+    """
+    Turns off the ANSI colour codes, e.g when the detailed results are written to a file.
+    """
+    global OKGREEN, OKBLUE, OKCYAN, ENDC, FAIL, PURPLE, WARNING, UNDERLINE_BLUE, ORANGE, BOLD, BLINK
+    OKGREEN = OKBLUE = OKCYAN = ENDC = FAIL = PURPLE = WARNING = UNDERLINE_BLUE = ORANGE = BOLD = BLINK = ""
 
-    OKGREEN = '\033[92m'
-    OKBLUE = '\033[94m'
-    OKCYAN = '\033[96m'
-    ENDC = '\033[0m'
-    FAIL = '\033[91m'
-    PURPLE = '\033[95m'
-    WARNING = '\033[93m'
-    UNDERLINE_BLUE = '\033[4;34m'
-    ORANGE = '\033[33m'
-    BOLD = '\033[1m'
-    BLINK = '\33[6m'
-    
-    list_indent = " -  "
-    indent = "    "
-
-    def print_mxtoolbox_list(data:list, is_selector:bool=False, include_url:bool=False):
-        #prints a list of dictionaries in a pretty format
-        #dictionaries must have "Name", "Info", and "Url" keys - MXToolbox API response format
-        if type(data) is not list:
-            raise Exception(f"Argument 'list' must be a list data type. - {type(data)}")
-        
-        if is_selector == True: #increase indent for selectors
-            for check in data:
-                print(f"{indent * 3}* {check['Name']} - {check['Info']}")
-                
-                if include_url == True:
-                    print(f"{indent * 5}{list_indent}{check['Url']}")
-        else:    
-            for check in data:
-                print(f"{indent * 2}* {check['Name']} - {check['Info']}")
-                if include_url == True:
-                    print(f"{indent * 4}{list_indent}{check['Url']}")
+def print_mxtoolbox_list(data:list, is_selector:bool=False, include_url:bool=False):
+    #prints a list of dictionaries in a pretty format
+    #dictionaries must have "Name", "Info", and "Url" keys - MXToolbox API response format
+    if type(data) is not list:
+        raise Exception(f"Argument 'list' must be a list data type. - {type(data)}")
 
+    if is_selector == True: #increase indent for selectors
+        for check in data:
+            print(f"{indent * 3}* {check['Name']} - {check['Info']}")
 
-    #dkim = dkim_check("rsolutions.com")
-    #print(f"{dkim.domain} - Result: {dkim.result} - Warnings: {dkim.warnings} - Failures: {dkim.failures} - Passed: {dkim.passed}")
-    
-    #spf = spf_check("rsolutions.com")
-    #print(f"{spf.domain} - Result: {spf.result} - Warnings: {spf.warnings} - Failures: {spf.failures} - Passed: {spf.passed}")
-    
-    #dmarc = dmarc_check("rsolutions.com")
-    #print(f"{dmarc.domain} - Result: {dmarc.result} - Warnings: {dmarc.warnings} - Failures: {dmarc.failures} - Passed: {dmarc.passed}")
+            if include_url == True:
+                print(f"{indent * 5}{list_indent}{check['Url']}")
+    else:    
+        for check in data:
+            print(f"{indent * 2}* {check['Name']} - {check['Info']}")
+            if include_url == True:
+                print(f"{indent * 4}{list_indent}{check['Url']}")
 
+def print_backend_stats():
+    """
+    Prints how many lookups the hedged backend hedged, and how many records the incremental backend reused,
+    re-checked and found outdated, if they are in use.
+    """
+    backend = BACKEND
+    if isinstance(backend, hedged_backend):
+        stats = backend.stats()
+        print(f"[*] Hedged: {stats['hedged']} of {stats['lookups']} lookups hedged, {stats['won']} answered by a hedge, {stats['fallbacks']} fallbacks after a failure", file=sys.stderr)
+        backend = backend.backend
+    if isinstance(backend, incremental_backend):
+        stats = backend.stats()
+        print(f"[*] Incremental: {stats['unchanged']} unchanged records reused, {stats['checked']} checked, {stats['outdated']} provider records differ from DNS", file=sys.stderr)
 
-    print(f"[*] Running DMARC, DKIM, and SPF checks for {BLINK}{str(args.domain)}{ENDC}...")
-    
-    if args.selector:
-        print(f"[*] Using DKIM selector {PURPLE}{str(args.selector)}{ENDC}")
-        results = do_all_checks(str(args.domain), str(args.selector))
+def write_metrics(profile:bool=False, metrics_file:str=None):
+    """
+    Prints the --profile breakdown to stderr and/or writes the Prometheus metrics to a file.
+    """
+    if profile:
+        print(f"\n[*] Profile:\n{METRICS.report()}", file=sys.stderr)
+    if metrics_file:
+        with open(metrics_file, "w") as file:
+            file.write(METRICS.prometheus_text())
 
-    else:
-        results = do_all_checks(str(args.domain))
+def print_results(results:dict, verbose:bool=False, show_selectors:bool=True):
+    """
+    Pretty prints the results of do_all_checks() for a single domain.
+    If show_selectors is True, the DKIM selectors that were found are printed as well.
+    """
+    if show_selectors and not isinstance(results['dkim'], BaseException):
         #print DKIM selectors found for the domain
         if len(results['dkim'].selectors) == 1: 
-            print(f"[*] Found {len(results['dkim'].selectors)} DKIM selector for {str(args.domain)}:")
+            print(f"[*] Found {len(results['dkim'].selectors)} DKIM selector for {str(results['domain'])}:")
         else:
-            print(f"[*] Found {len(results['dkim'].selectors)} DKIM selectors for {str(args.domain)}:")
+            print(f"[*] Found {len(results['dkim'].selectors)} DKIM selectors for {str(results['domain'])}:")
         #print all found selectors into columns for space saving
         selector_names = []
         for selector in results['dkim'].selectors:
@@ -532,12 +4739,14 @@ def main():
         print_into_coulmns(selector_names, colour=f"{list_indent}{PURPLE}")
 
     #Pretty DKIM Results
-    if results["dkim"].result == "FAIL":
+    if isinstance(results["dkim"], BaseException):
+        print(f"{ENDC}[*] DKIM Check: {FAIL}ERROR{ENDC} - {results['dkim']}")
+    elif results["dkim"].result != "PASS": #FAIL, TIMEOUT or ERROR
         print(f"{ENDC}[*] DKIM Check: {FAIL}{results['dkim'].result}{ENDC}")
     else:
         print(f"{ENDC}[*] DKIM Check: {OKGREEN}{results['dkim'].result}{ENDC}")
     
-    if args.verbose:
+    if verbose and not isinstance(results['dkim'], BaseException):
         for selector in results['dkim'].selectors:
             print("")
             print(f"{indent}{UNDERLINE_BLUE}{selector['name']}:{ENDC}")
@@ -571,12 +4780,14 @@ def main():
     
     #Pretty SPF Results
     print("\n")
-    if results["spf"].result == "FAIL":
+    if isinstance(results["spf"], BaseException):
+        print(f"{ENDC}[*] SPF Check: {FAIL}ERROR{ENDC} - {results['spf']}")
+    elif results["spf"].result != "PASS": #FAIL, TIMEOUT or ERROR
         print(f"{ENDC}[*] SPF Check: {FAIL}{results['spf'].result}{ENDC}")
     else:
         print(f"{ENDC}[*] SPF Check: {OKGREEN}{results['spf'].result}{ENDC}")
     
-    if args.verbose:
+    if verbose and not isinstance(results['spf'], BaseException):
         if results['spf'].record_content == "":
             print(f"{indent}{OKGREEN}Record Content: {ENDC}None")
         else:
@@ -605,12 +4816,14 @@ def main():
     
     #Pretty DMARC Results
     print("\n")
-    if results["dmarc"].result == "FAIL":
+    if isinstance(results["dmarc"], BaseException):
+        print(f"{ENDC}[*] DMARC Check: {FAIL}ERROR{ENDC} - {results['dmarc']}")
+    elif results["dmarc"].result != "PASS": #FAIL, TIMEOUT or ERROR
         print(f"{ENDC}[*] DMARC Check: {FAIL}{results['dmarc'].result}{ENDC}")
     else:
         print(f"{ENDC}[*] DMARC Check: {OKGREEN}{results['dmarc'].result}{ENDC}")
 
-    if args.verbose:
+    if verbose and not isinstance(results['dmarc'], BaseException):
         if results['dmarc'].record_content == "":
             print(f"{indent}{OKGREEN}Record Content: {ENDC}None")
         else:
@@ -635,6 +4848,876 @@ def main():
             print_mxtoolbox_list(results['dmarc'].passed, include_url=False)
         print(f"{indent}{PURPLE}Timeouts: {ENDC}{results['dmarc'].timeouts}")
         print(f"{indent}{FAIL}Errors: {ENDC}{results['dmarc'].errors}")
+
+    #Pretty MX Results
+    if "mx" not in results:
+        return
+    print("\n")
+    if isinstance(results["mx"], BaseException):
+        print(f"{ENDC}[*] MX Check: {FAIL}ERROR{ENDC} - {results['mx']}")
+    elif results["mx"].result != "PASS": #FAIL, TIMEOUT or ERROR
+        print(f"{ENDC}[*] MX Check: {FAIL}{results['mx'].result}{ENDC}")
+    else:
+        print(f"{ENDC}[*] MX Check: {OKGREEN}{results['mx'].result}{ENDC}")
+
+    if verbose and not isinstance(results['mx'], BaseException):
+        #MAIL HOSTS
+        if results['mx'].hosts == []:
+            print(f"{indent}{OKGREEN}Mail Hosts: {ENDC}None")
+        else:
+            print(f"{indent}{OKGREEN}Mail Hosts: {ENDC}")
+        for host in results['mx'].hosts:
+            addresses = ", ".join(host['addresses'] + host['ipv6']) or "no address"
+            starttls = "" if host['starttls'] is None else f" - STARTTLS: {ORANGE}{host['starttls']}{ENDC}"
+            print(f"{indent}{list_indent}{host['preference']} {BOLD}{host['host']}{ENDC} ({addresses}){starttls}")
+        #FAILED CHECKS
+        if results['mx'].failures == []:
+            print(f"{indent}{FAIL}Failed: {ENDC}[]")
+        else:
+            print(f"{indent}{FAIL}Failed: {ENDC}")
+            print_mxtoolbox_list(results['mx'].failures, include_url=True)
+        #WARNINGS
+        if results['mx'].warnings == []:
+            print(f"{indent}{WARNING}Warnings: {ENDC}[]")
+        else:
+            print(f"{indent}{WARNING}Warnings: {ENDC}")
+            print_mxtoolbox_list(results['mx'].warnings, include_url=True)
+        #PASSED CHECKS
+        if results['mx'].passed == []:
+            print(f"{indent}{OKBLUE}Passed: {ENDC}[]")
+        else:
+            print(f"{indent}{OKBLUE}Passed: {ENDC}")
+            print_mxtoolbox_list(results['mx'].passed, include_url=False)
+        print(f"{indent}{PURPLE}Timeouts: {ENDC}{results['mx'].timeouts}")
+        print(f"{indent}{FAIL}Errors: {ENDC}{results['mx'].errors}")
+
+#--SERVER MODE--
+class check_server(ThreadingHTTPServer):
+    """
+    HTTP server used by serve(), each request is handled in its own thread.
+    Every request shares the module's HTTP_CLIENT, MXTOOLBOX_AUTH, RESULT_CACHE, SCHEDULER and CIRCUIT_BREAKER,
+    so connections, the TempAuthKey and cached lookups stay warm between requests.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address:tuple, workers:int=10, deadline:float=None, quiet:bool=False):
+        super().__init__(address, check_request_handler)
+        self.workers = workers #domains checked at the same time per batch
+        self.deadline = deadline #default per-domain deadline
+        self.quiet = quiet
+        self.started = time.monotonic()
+
+class check_request_handler(BaseHTTPRequestHandler):
+    """
+    Request handler of check_server, see serve() for the endpoints.
+    """
+    protocol_version = "HTTP/1.1" #keep-alive, clients can reuse their connection as well
+    server_version = "email_check"
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def send_body(self, status:int, body:str, content_type:str):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status:int, data:dict):
+        self.send_body(status, json.dumps(data, separators=(",", ":"), default=str), "application/json")
+
+    def send_chunk(self, data:str):
+        data = data.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def check_options(self, options:dict) -> tuple:
+        """
+        Returns (selector, backend, deadline) from the query string or JSON body of a request.
+        Raises ValueError if one of them is invalid.
+        """
+        selector = options.get("selector") or None
+        if isinstance(selector, list) and len(selector) == 1:
+            selector = selector[0]
+        backend = options.get("backend") or None
+        if backend is not None and backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend} - must be one of: {', '.join(BACKENDS)}")
+        deadline = options.get("deadline")
+        deadline = float(deadline) if deadline not in (None, "") else self.server.deadline
+        return selector, backend, deadline
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/health":
+            providers = {urlsplit(provider_url).hostname: CIRCUIT_BREAKER.state(urlsplit(provider_url).hostname) for provider_url in (MXTOOLBOX_URL, EASYDMARC_URL)}
+            self.send_json(200, {"status": "ok", "uptime": round(time.monotonic() - self.server.started, 3), "providers": providers})
+        elif url.path == "/metrics":
+            self.send_body(200, METRICS.prometheus_text(), "text/plain; version=0.0.4")
+        elif url.path == "/check":
+            params = parse_qs(url.query)
+            domain = params.get("domain", [""])[0].strip()
+            if not domain:
+                return self.send_json(400, {"error": "Missing domain parameter."})
+            #?selector=a&selector=b and ?selector=a,b are both accepted
+            options = {key: values[0] for key, values in params.items()}
+            options["selector"] = [selector for values in params.get("selector", []) for selector in values.split(",") if selector]
+            try:
+                selector, backend, deadline = self.check_options(options)
+            except ValueError as err:
+                return self.send_json(400, {"error": str(err)})
+            results = do_all_checks(domain, selector, parallel=True, backend=backend, deadline=deadline)
+            self.send_body(200, result_to_json(results), "application/json")
+        else:
+            self.send_json(404, {"error": f"Not found: {url.path}"})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/check":
+            return self.send_json(404, {"error": f"Not found: {url.path}"})
+        if "Content-Length" not in self.headers:
+            return self.send_json(411, {"error": "Missing Content-Length header."})
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+
+        #--READ THE BATCH--
+        #a JSON object {"domains": [...], "selector": ..., "backend": ..., "deadline": ...},
+        #a JSON list of domains, or a text body with one domain per line
+        try:
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                options = json.loads(body)
+                if isinstance(options, list):
+                    options = {"domains": options}
+                if not isinstance(options, dict) or not isinstance(options.get("domains"), list):
+                    raise ValueError("The JSON body must be a list of domains or an object with a \"domains\" list.")
+                domains = [str(domain).strip() for domain in options["domains"] if str(domain).strip()]
+            else:
+                options = {}
+                domains = list(read_domains(body.splitlines()))
+            selector, backend, deadline = self.check_options(options)
+        except ValueError as err:
+            return self.send_json(400, {"error": str(err)})
+
+        #--STREAM THE RESULTS--
+        #one JSON line per domain as soon as it finishes, in the same format as -j (--json)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        scan = bulk_scan(domains, selector, workers=self.server.workers, deadline=deadline, backend=backend)
+        try:
+            for results in scan:
+                self.send_chunk(result_to_json(results) + "\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            #the client went away, stop starting new domains
+            self.close_connection = True
+        finally:
+            scan.close()
+
+def serve(host:str="127.0.0.1", port:int=8025, workers:int=10, deadline:float=None, quiet:bool=False, warm:bool=True):
+    """
+    Serves do_all_checks() over a small local JSON HTTP API until interrupted (Ctrl+C).
+    -GET /check?domain=example.com&selector=s1,s2&backend=dns&deadline=10 returns the results of one domain,
+    selector, backend and deadline are optional
+    -POST /check with a JSON list of domains, a JSON object {"domains": [...], "selector": ..., "backend": ...,
+    "deadline": ...} or one domain per line, streams one JSON line per domain as each one finishes
+    -GET /metrics returns the timings and counters in the Prometheus text format
+    -GET /health returns the uptime and the circuit breaker state of each provider
+    -workers is the number of domains checked at the same time per batch
+    -deadline is the default per-domain deadline in seconds
+    -if warm is True the MXToolbox TempAuthKey is fetched when the server starts instead of on the first request
+    """
+    server = check_server((host, port), workers=workers, deadline=deadline, quiet=quiet)
+    if warm and get_backend().name == "mxtoolbox":
+        def warm_auth():
+            try:
+                MXTOOLBOX_AUTH.get_key(HTTP_CLIENT.query)
+            except Exception as err:
+                print(f"[!] Could not fetch the MXToolbox TempAuthKey: {err}", file=sys.stderr)
+        threading.Thread(target=warm_auth, daemon=True).start()
+    print(f"[*] Serving on http://{host}:{server.server_port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+#--MONITOR MODE--
+class monitor_store:
+    """
+    Persistent SQLite priority queue of the domains watched by monitor, ordered by when each domain is next due.
+    For each domain it keeps its DKIM selector, its priority, when it was last checked and the DKIM, SPF and DMARC
+    states of that check.
+    -safe to share between threads
+    """
+    def __init__(self, path:str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS domains ("
+            "domain TEXT PRIMARY KEY, selector TEXT, priority INTEGER DEFAULT 0, next_due REAL, last_checked REAL, state TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS domains_next_due ON domains (next_due)")
+
+    def add(self, domain:str, selector:str|list=None, priority:int=0):
+        """
+        Adds a domain, due straight away. Adding a domain that is already watched only changes its selector and priority.
+        """
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO domains (domain, selector, priority, next_due) VALUES (?, ?, ?, 0) "
+                "ON CONFLICT (domain) DO UPDATE SET selector=excluded.selector, priority=excluded.priority",
+                (domain.lower(), json.dumps(selector), priority)
+            )
+
+    def remove(self, domain:str):
+        with self._lock:
+            self._db.execute("DELETE FROM domains WHERE domain=?", (domain.lower(),))
+
+    def due(self, now:float, limit:int, exclude:set=()) -> list:
+        """
+        Returns up to limit domains that are due at now, highest priority first and then the most overdue first,
+        as (domain, selector, priority, state) tuples. Domains in exclude (e.g being checked) are skipped.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT domain, selector, priority, state FROM domains WHERE next_due<=? ORDER BY priority DESC, next_due LIMIT ?",
+                (now, limit + len(exclude))
+            ).fetchall()
+        due = [(domain, json.loads(selector), priority, json.loads(state) if state else None) for domain, selector, priority, state in rows if domain not in exclude]
+        return due[:limit]
+
+    def next_due(self, exclude:set=()) -> float:
+        """
+        Returns when the next domain is due, or None if no domain is watched.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT domain, next_due FROM domains ORDER BY next_due LIMIT ?", (len(exclude) + 1,)).fetchall()
+        for domain, next_due in rows:
+            if domain not in exclude:
+                return next_due
+        return None
+
+    def update(self, domain:str, state:dict, next_due:float):
+        """
+        Stores the states of a finished check and when the domain is due again.
+        """
+        with self._lock:
+            self._db.execute(
+                "UPDATE domains SET state=?, next_due=?, last_checked=? WHERE domain=?",
+                (json.dumps(state, separators=(",", ":")), next_due, time.time(), domain.lower())
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM domains").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+DEFAULT_MONITOR_FILE = os.path.join(os.path.expanduser("~"), ".cache", "email_check", "monitor.sqlite3")
+
+class monitor:
+    """
+    Re-checks the domains of a monitor_store continuously, each one when it is due, instead of the whole list on a fixed schedule.
+    -a domain is due interval seconds after its last check, divided by 1 + its priority, and multiplied by failing_factor
+    while one of its checks fails or errors, so failing domains are re-checked sooner
+    -the interval is never shorter than min_interval or the lowest TTL of the domain's records (resolvers can keep
+    serving the old record until then), nor longer than max_interval, and is spread by +-10% so domains added
+    together don't stay due together
+    -budget is the maximum number of provider requests per hour, counted from the requests_total counter of METRICS.
+    Due domains wait (highest priority first) while the budget is spent
+    -workers is the maximum number of domains checked at the same time, deadline is the per-domain deadline
+    """
+    STATES = ("dkim", "spf", "dmarc")
+
+    def __init__(self, store:monitor_store, interval:float=21600, min_interval:float=300, max_interval:float=86400, failing_factor:float=0.25, budget:float=None, workers:int=10, deadline:float=None):
+        self.store = store
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.failing_factor = failing_factor
+        self.budget = budget
+        self.workers = workers
+        self.deadline = deadline
+        self.checked = 0 #domains checked by run()
+
+        #--REQUEST BUDGET--
+        #token bucket refilled at budget / 3600 requests per second, holding up to 5 minutes of budget
+        self._capacity = max(1.0, budget / 12) if budget else None
+        self._tokens = self._capacity
+        self._refilled = time.monotonic()
+        self._requests_seen = self.requests_total()
+        self._requests_per_domain = 10.0 #estimate reserved for each domain being checked, updated as domains finish
+        self._requests_spent = 0
+
+    @staticmethod
+    def requests_total() -> float:
+        return sum(value for (name, _), value in METRICS.stats()["counters"].items() if name == "requests_total")
+
+    def _refill(self):
+        now = time.monotonic()
+        requests = self.requests_total()
+        self._requests_spent += requests - self._requests_seen
+        if self._capacity is not None:
+            self._tokens = min(self._capacity, self._tokens + (now - self._refilled) * self.budget / 3600) - (requests - self._requests_seen)
+        self._refilled = now
+        self._requests_seen = requests
+
+    def _budget_wait(self, in_flight:int) -> float:
+        """
+        Returns 0 if another domain can be started within the budget, otherwise the seconds until it can.
+        """
+        if self._capacity is None:
+            return 0
+        needed = self._requests_per_domain * (in_flight + 1)
+        if not in_flight:
+            needed = min(needed, self._capacity) #a small budget can hold less than one domain's requests
+        missing = needed - self._tokens
+        return max(0.0, missing * 3600 / self.budget) if missing > 0 else 0
+
+    @staticmethod
+    def record_ttl(domain:str, dkim) -> int:
+        """
+        Returns the lowest TTL of the domain's DMARC, SPF (the domain's TXT records) and DKIM selector records,
+        or None if none of them could be resolved.
+        """
+        names = [domain, f"_dmarc.{domain}"]
+        if not isinstance(dkim, BaseException):
+            names.extend(f"{selector.name}._domainkey.{domain}" for selector in dkim.selectors or [])
+        ttls = []
+        futures = []
+        for name in names:
+            try:
+                futures.append(DNS_RESOLVER.submit(name, "TXT"))
+            except Exception: #no resolver, the interval is used on its own
+                break
+        for future in futures:
+            try:
+                ttls.append(future.result().ttl)
+            except Exception:
+                pass
+        return min(ttls) if ttls else None
+
+    def check(self, domain:str, selector:str|list=None) -> tuple:
+        """
+        Checks one domain, returns (results of do_all_checks(), lowest record TTL).
+        """
+        results = do_all_checks(domain, selector, parallel=True, deadline=self.deadline)
+        return results, self.record_ttl(domain, results["dkim"])
+
+    @classmethod
+    def states(cls, results:dict) -> dict:
+        """
+        Returns {"dkim": "PASS", "spf": "FAIL", ...}, a check that raised an exception is "ERROR".
+        """
+        return {check_name: "ERROR" if isinstance(results[check_name], BaseException) or results[check_name].result not in ("PASS", "FAIL") else results[check_name].result for check_name in cls.STATES}
+
+    def next_interval(self, states:dict, priority:int, ttl:int=None) -> float:
+        """
+        Returns the seconds until a domain with these states, priority and record TTL is due again.
+        """
+        interval = self.interval
+        if any(state != "PASS" for state in states.values()):
+            interval *= self.failing_factor
+        interval /= 1 + max(0, priority)
+        interval = min(max(interval, ttl or 0, self.min_interval), self.max_interval)
+        return interval * random.uniform(0.9, 1.1)
+
+    def changes(self, previous:dict, states:dict) -> dict:
+        """
+        Returns {check: {"from": old, "to": new}} for every check whose result flipped between PASS and FAIL.
+        An ERROR is not a change, the previous state is kept until the check succeeds again.
+        """
+        if not previous:
+            return {}
+        return {
+            check_name: {"from": previous[check_name], "to": states[check_name]}
+            for check_name in self.STATES
+            if states[check_name] != "ERROR" and previous.get(check_name) not in (None, "ERROR", states[check_name])
+        }
+
+    def run(self, once:bool=False) -> iter:
+        """
+        Checks the due domains until interrupted, and yields a change event whenever a domain's DKIM, SPF or DMARC result
+        flips between PASS and FAIL: {"event": "change", "domain": ..., "time": ..., "changes": {"spf": {"from": "PASS",
+        "to": "FAIL"}}, "results": ...} where results are in the -j (--json) format.
+        -the first check of a domain only records its states
+        -if once is True, only the domains that are due when run() starts are checked, and run() returns once they are done
+        """
+        stop_at = time.time() if once else None
+        in_flight = {} #future -> (domain, priority, state)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                #--START DUE DOMAINS--
+                self._refill()
+                now = time.time()
+                checking = {domain for domain, _, _ in in_flight.values()}
+                budget_wait = self._budget_wait(len(in_flight))
+                if len(in_flight) < self.workers and not budget_wait:
+                    for domain, selector, priority, state in self.store.due(stop_at or now, self.workers - len(in_flight), exclude=checking):
+                        if self._budget_wait(len(in_flight)):
+                            break
+                        in_flight[context_submit(executor, self.check, domain, selector)] = (domain, priority, state)
+                        checking.add(domain)
+                    budget_wait = self._budget_wait(len(in_flight))
+
+                #--WAIT FOR A CHECK, THE NEXT DUE DOMAIN OR THE BUDGET--
+                if once:
+                    if not in_flight and not self.store.due(stop_at, 1):
+                        return
+                    timeout = None if in_flight else budget_wait
+                elif len(in_flight) >= self.workers:
+                    timeout = None
+                else:
+                    next_due = self.store.next_due(exclude=checking)
+                    timeout = max(budget_wait, next_due - now) if next_due is not None else 60
+                    timeout = min(timeout, 60) #picks up domains added to the store by another process
+                if not in_flight:
+                    time.sleep(max(0.0, timeout))
+                    continue
+                done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                #--RECORD FINISHED DOMAINS--
+                for future in done:
+                    domain, priority, previous = in_flight.pop(future)
+                    try:
+                        results, ttl = future.result()
+                    except Exception as err:
+                        results, ttl = {"domain": domain, **{check_name: err for check_name in self.STATES}}, None
+                    states = self.states(results)
+                    changes = self.changes(previous, states)
+                    next_due = time.time() + self.next_interval(states, priority, ttl)
+                    if previous:
+                        #an ERROR keeps the last known state, so the next successful check is compared to it
+                        states = {check_name: previous.get(check_name) if state == "ERROR" and previous.get(check_name) else state for check_name, state in states.items()}
+                    self.store.update(domain, states, next_due)
+                    self.checked += 1
+                    self._refill()
+                    self._requests_per_domain = max(1.0, self._requests_spent / self.checked)
+                    if changes:
+                        yield {"event": "change", "domain": domain, "time": round(time.time(), 3), "changes": changes, "results": result_to_dict(results)}
+
+def add_config_arguments(parser:argparse.ArgumentParser):
+    """
+    Adds the options shared by the CLI and the serve mode (providers, retries, backend, caches...).
+    """
+    parser.add_argument('--mxtoolbox-rate', dest='mxtoolbox_rate', help='Maximum number of requests per second to MXToolbox, shared by every worker.', type=float, default=None, required=False)
+    parser.add_argument('--easydmarc-rate', dest='easydmarc_rate', help='Maximum number of requests per second to EasyDMARC, shared by every worker.', type=float, default=None, required=False)
+    parser.add_argument('--selector-workers', dest='selector_workers', help='Maximum number of DKIM selectors looked up at the same time per domain. (default: 8)', type=int, default=8, required=False)
+    parser.add_argument('--pool-size', dest='pool_size', help='Maximum number of pooled keep-alive connections per provider host. (default: 10)', type=int, default=10, required=False)
+    parser.add_argument('--auth-max-age', dest='auth_max_age', help='Seconds to reuse the MXToolbox TempAuthKey before fetching a new one. (default: 600)', type=float, default=600, required=False)
+    parser.add_argument('--timeout', dest='timeout', help='Seconds to wait for each provider request. (default: 15)', type=float, default=15.0, required=False)
+    parser.add_argument('--retries', dest='retries', help='Maximum number of tries per provider request, retries wait with exponential backoff or the Retry-After header. (default: 5)', type=int, default=5, required=False)
+    parser.add_argument('--deadline', dest='deadline', help='Maximum number of seconds spent on each domain, including retries.', type=float, default=None, required=False)
+    parser.add_argument('--breaker-threshold', dest='breaker_threshold', help='Failed requests in a row before a provider is skipped. (default: 5)', type=int, default=5, required=False)
+    parser.add_argument('--breaker-reset', dest='breaker_reset', help='Seconds a failing provider is skipped before it is tried again. (default: 30)', type=float, default=30.0, required=False)
+    parser.add_argument('-b', '--backend', dest='backend', help='Where the DKIM, SPF and DMARC results come from: "mxtoolbox" or "dns" to query and check the records locally. (default: mxtoolbox)', choices=list(BACKENDS), default='mxtoolbox', required=False)
+    parser.add_argument('--resolver', dest='resolver', help='DNS server used by the dns backend, e.g "1.1.1.1" or "127.0.0.1:5353". (default: first nameserver in /etc/resolv.conf)', default=None, required=False)
+    parser.add_argument('--discovery', dest='discovery', help='How DKIM selectors are found when none are given: "easydmarc", "dns" to probe common selectors over DNS, or "both". (default: easydmarc)', choices=["easydmarc", "dns", "both"], default="easydmarc", required=False)
+    parser.add_argument('--selector-wordlist', dest='selector_wordlist', help='File with extra DKIM selectors (one per line) to probe with --discovery dns/both.', default=None, required=False)
+    parser.add_argument('--incremental', dest='incremental', help='Only ask the provider again for records whose live DNS content changed since the last run, or whose stored result is older than --incremental-max-age.', action='store_true', required=False)
+    parser.add_argument('--incremental-max-age', dest='incremental_max_age', help='Seconds a stored result is reused for while its record does not change. (default: 604800)', type=float, default=604800, required=False)
+    parser.add_argument('--records-file', dest='records_file', help=f'Path of the record store used by --incremental. (default: {DEFAULT_RECORDS_FILE})', default=DEFAULT_RECORDS_FILE, required=False)
+    parser.add_argument('--mx', dest='mx', help='Also check the MX records and mail hosts of the domains, over DNS.', action='store_true', required=False)
+    parser.add_argument('--starttls', dest='starttls', help='MX check: connect to each mail host on port 25 to see if it offers STARTTLS, implies --mx.', action='store_true', required=False)
+    parser.add_argument('--starttls-timeout', dest='starttls_timeout', help='MX check: seconds to wait for each step of a STARTTLS probe. (default: 5)', type=float, default=5.0, required=False)
+    parser.add_argument('--hedge', dest='hedge', help='Backend that a slow lookup is sent to as well, the first answer wins: "dns" to check the records locally, or the --backend itself to send it again on a new connection. Can be used multiple times, hedges are started in order.', choices=list(BACKENDS), action='append', default=[], required=False)
+    parser.add_argument('--hedge-percentile', dest='hedge_percentile', help='Latency percentile of the --backend after which a lookup is hedged. (default: 95)', type=float, default=95, required=False)
+    parser.add_argument('--hedge-max-ratio', dest='hedge_max_ratio', help='Maximum share of the lookups that are hedged. (default: 0.1)', type=float, default=0.1, required=False)
+    parser.add_argument('--no-cache', dest='no_cache', help='Do not read or store lookups in the result cache.', action='store_true', required=False)
+    parser.add_argument('--refresh', dest='refresh', help='Ignore cached lookups, but store the fresh results in the cache.', action='store_true', required=False)
+    parser.add_argument('--cache-file', dest='cache_file', help=f'Path of the result cache. (default: {DEFAULT_CACHE_FILE})', default=DEFAULT_CACHE_FILE, required=False)
+    parser.add_argument('--cache-ttl', dest='cache_ttl', help='Cache TTL in seconds for a record type, e.g "spf=600". Can be used multiple times. Types: dkim, spf, dmarc, selectors', action='append', default=[], required=False)
+    parser.add_argument('--cache-max-entries', dest='cache_max_entries', help='Maximum number of cached lookups, least recently used lookups are removed first. (default: 100000)', type=int, default=100000, required=False)
+    parser.add_argument('--record', dest='record', help='Record every provider response and DNS answer in this cassette file (a JSON lines file), to --replay later. Disables the result cache.', default=None, required=False)
+    parser.add_argument('--replay', dest='replay', help='Answer every provider and DNS query from this cassette file instead of the network, e.g to re-score a recorded scan offline. Disables the result cache.', default=None, required=False)
+
+def configure(args:argparse.Namespace, parser:argparse.ArgumentParser=None):
+    """
+    Applies the options added by add_config_arguments() to the module's shared clients, caches and backend.
+    Invalid options are reported with parser.error(), or raise an exception if no parser is given.
+    """
+    def fail(message:str):
+        if parser is None:
+            raise Exception(message)
+        parser.error(message)
+
+    MXTOOLBOX_AUTH.max_age = args.auth_max_age
+    HTTP_CLIENT.pool_size = args.pool_size
+    if args.mxtoolbox_rate:
+        SCHEDULER.set_rate(urlsplit(MXTOOLBOX_URL).hostname, args.mxtoolbox_rate)
+    if args.easydmarc_rate:
+        SCHEDULER.set_rate(urlsplit(EASYDMARC_URL).hostname, args.easydmarc_rate)
+    RETRY_POLICY.timeout = args.timeout
+    RETRY_POLICY.attempts = max(1, args.retries)
+    CIRCUIT_BREAKER.failure_threshold = args.breaker_threshold
+    CIRCUIT_BREAKER.reset_timeout = args.breaker_reset
+    global DKIM_MAX_WORKERS, RESULT_CACHE, BACKEND, DISCOVERY, CASSETTE, MX_CHECK, MX_STARTTLS
+    DKIM_MAX_WORKERS = args.selector_workers
+    MX_CHECK = args.mx or args.starttls
+    MX_STARTTLS = args.starttls
+    MX_HOSTS.timeout = args.starttls_timeout
+    BACKEND = BACKENDS[args.backend]
+    DISCOVERY = args.discovery
+    if args.selector_wordlist:
+        with open(args.selector_wordlist, "r") as wordlist:
+            SELECTOR_DISCOVERY.wordlist.extend(read_domains(wordlist)) #same format as a domain list
+    if args.resolver:
+        DNS_RESOLVER.server = dns_resolver.parse_server(args.resolver)
+    if args.incremental:
+        BACKEND = incremental_backend(BACKEND, record_store(args.records_file, max_age=args.incremental_max_age))
+    if args.hedge:
+        if not 0 < args.hedge_percentile < 100:
+            fail("--hedge-percentile must be between 0 and 100.")
+        BACKEND = hedged_backend(BACKEND, [BACKENDS[hedge] for hedge in args.hedge], percentile=args.hedge_percentile, max_ratio=args.hedge_max_ratio)
+    if args.record or args.replay:
+        if args.record and args.replay:
+            fail("Cannot use both --record and --replay.")
+        try:
+            CASSETTE = cassette(args.record or args.replay, mode="record" if args.record else "replay")
+        except Exception as err: #missing or corrupt file
+            fail(f"Cannot open cassette {args.record or args.replay} - {err}")
+    #a replayed scan is re-scored from the recorded responses, not from cached results, and a recorded scan
+    #queries everything so that every response ends up in the cassette
+    if not args.no_cache and not args.replay and not args.record:
+        cache_ttls = {}
+        for cache_ttl in args.cache_ttl:
+            try:
+                record_type, ttl = cache_ttl.split("=", 1)
+                cache_ttls[record_type.strip().lower()] = float(ttl)
+            except ValueError:
+                fail(f"--cache-ttl must be in the format TYPE=SECONDS - {cache_ttl}")
+        RESULT_CACHE = result_cache(args.cache_file, ttls=cache_ttls, max_entries=args.cache_max_entries, refresh=args.refresh)
+
+def serve_main(argv:list):
+    """
+    Entry point of "email_check.py serve", see serve().
+    """
+    parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} serve", description='Serve the DKIM, SPF and DMARC checks over a local JSON HTTP API.')
+    parser.add_argument('--host', dest='host', help='Address to listen on. (default: 127.0.0.1)', default='127.0.0.1', required=False)
+    parser.add_argument('--port', dest='port', help='Port to listen on. (default: 8025)', type=int, default=8025, required=False)
+    parser.add_argument('-w', '--workers', dest='workers', help='Maximum number of domains checked at the same time per batch request. (default: 10)', type=int, default=10, required=False)
+    parser.add_argument('-q', '--quiet', dest='quiet', help='Do not log each request to stderr.', action='store_true', required=False)
+    parser.add_argument('--no-warm', dest='no_warm', help='Do not fetch the MXToolbox TempAuthKey when the server starts.', action='store_true', required=False)
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+    configure(args, parser)
+    serve(args.host, args.port, workers=args.workers, deadline=args.deadline, quiet=args.quiet, warm=not args.no_warm)
+
+def scan_from_args(args:argparse.Namespace, selector:str|list=None, checkpoint:scan_checkpoint=None, share:int=1) -> iter:
+    """
+    Yields the results of the bulk scan of the CLI options: the -f domain list (only the --shard-index shard with --shards),
+    or the --queue-dir work queue. With share > 1 the --rate and provider limits are divided between share processes.
+    The domain file is closed once the scan finishes or is stopped.
+    """
+    provider_limits = {}
+    if args.mxtoolbox_limit:
+        provider_limits[urlsplit(MXTOOLBOX_URL).hostname] = max(1, args.mxtoolbox_limit // share)
+    if args.easydmarc_limit:
+        provider_limits[urlsplit(EASYDMARC_URL).hostname] = max(1, args.easydmarc_limit // share)
+    scan_options = {"workers": args.workers, "rate": args.rate / share if args.rate else None, "provider_limits": provider_limits, "deadline": args.deadline}
+    with contextlib.nullcontext(sys.stdin) if args.file == "-" else open(args.file, "r") as domain_file:
+        domains = read_domains(domain_file)
+        if args.queue_dir:
+            yield from scan_queue(work_queue(args.queue_dir), selector, domains=domains, **scan_options)
+            return
+        if args.shards > 1:
+            domains = shard_domains(domains, args.shards, args.shard_index)
+        yield from bulk_scan(domains, selector, checkpoint=checkpoint, **scan_options)
+
+def shard_worker(args:argparse.Namespace, selector:str|list, process_index:int, part_path:str):
+    """
+    Runs one process of a --processes scan and writes its results to part_path as JSONL.
+    -each process scans its own shard (or takes chunks from the --queue-dir work queue), with --shards every
+    machine's shard is split again between its processes
+    -the provider rates, limits and --rate are divided between the processes, as they share the machine's address
+    """
+    for option in ("mxtoolbox_rate", "easydmarc_rate"):
+        if getattr(args, option):
+            setattr(args, option, getattr(args, option) / args.processes)
+    if not args.queue_dir:
+        args.shard_index = args.shard_index * args.processes + process_index
+        args.shards = args.shards * args.processes
+    configure(args)
+    with open(part_path, "w") as part:
+        writer = jsonl_writer(part)
+        for results in scan_from_args(args, selector, share=args.processes):
+            writer.write(results)
+    print_backend_stats()
+    write_metrics(args.profile, f"{args.metrics_file}.{process_index}" if args.metrics_file else None)
+
+def scan_processes(args:argparse.Namespace, selector:str|list=None, poll_interval:float=0.5) -> iter:
+    """
+    Runs a --processes scan in args.processes worker processes (see shard_worker()), and yields the results as
+    dictionaries in the -j (--json) format while the processes write them to their part files.
+    Each domain is yielded once, a --queue-dir chunk whose claim timed out can be scanned by two processes.
+    """
+    context = multiprocessing.get_context("spawn") #a clean interpreter, no locks, sessions or cache connections copied from this one
+    seen = set() #domains already yielded
+    with tempfile.TemporaryDirectory(prefix="email_check-") as parts:
+        paths = [os.path.join(parts, f"{process_index:04d}.jsonl") for process_index in range(args.processes)]
+        for path in paths:
+            open(path, "w").close() #so they can be read before the processes open them
+        processes = [context.Process(target=shard_worker, args=(args, selector, process_index, path)) for process_index, path in enumerate(paths)]
+        for process in processes:
+            process.start()
+        readers = [open(path, "rb") for path in paths]
+        unfinished = [b""] * len(paths) #the start of a line that is still being written
+        running = set(range(len(processes)))
+        try:
+            while True:
+                #checked before reading, so the last lines of a process that has just exited are still read
+                for process_index in [process_index for process_index in running if not processes[process_index].is_alive()]:
+                    running.remove(process_index)
+                    processes[process_index].join()
+                    if processes[process_index].exitcode != 0:
+                        print(f"[!] Process {process_index} exited with code {processes[process_index].exitcode}, some of its domains may be missing.", file=sys.stderr)
+                for process_index, reader in enumerate(readers):
+                    *lines, unfinished[process_index] = (unfinished[process_index] + reader.read()).split(b"\n")
+                    for line in lines:
+                        if line.strip():
+                            results = json.loads(line)
+                            if results["domain"] not in seen:
+                                seen.add(results["domain"])
+                                yield results
+                if not running:
+                    return
+                time.sleep(poll_interval)
+        finally:
+            for reader in readers:
+                reader.close()
+            for process in processes:
+                if process.is_alive(): #the caller stopped early
+                    process.terminate()
+                process.join()
+
+def merge_main(argv:list):
+    """
+    Entry point of "email_check.py merge", see merge_results().
+    """
+    parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} merge", description='Merge the JSONL results of sharded scans into one report, with one result per domain.')
+    parser.add_argument('paths', nargs='+', help='JSONL result files, or directories of them, e.g the results directory of a --queue-dir.')
+    parser.add_argument('-o', '--output', dest='output', help='Output the merged results to a file.', required=False)
+    args = parser.parse_args(argv)
+    output = open(args.output, "w") if args.output else sys.stdout
+    summary = {check_name: {} for check_name in CHECK_NAMES}
+    merged = 0
+    for results in merge_results(args.paths):
+        output.write(json.dumps(results, separators=(",", ":")) + "\n")
+        for check_name, counts in summary.items():
+            if check_name in results: #e.g results scanned without the MX check
+                result = (results[check_name] or {}).get("result")
+                counts[result] = counts.get(result, 0) + 1
+        merged += 1
+    output.flush()
+    print(f"[*] Merged {merged} domains", file=sys.stderr)
+    for check_name, counts in summary.items():
+        if counts:
+            print(f"[*] {check_name.upper()}: " + ", ".join(f"{count} {result}" for result, count in sorted(counts.items(), key=lambda item: -item[1])), file=sys.stderr)
+
+def monitor_main(argv:list):
+    """
+    Entry point of "email_check.py monitor", see monitor.
+    """
+    parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} monitor", description='Watch a portfolio of domains, re-checking each one when it is due and reporting when a DKIM, SPF or DMARC result flips.')
+    parser.add_argument('--db', dest='db', help=f'Path of the monitor database that keeps the watched domains, their schedule and last results. (default: {DEFAULT_MONITOR_FILE})', default=DEFAULT_MONITOR_FILE, required=False)
+    parser.add_argument('-d', '--domain', dest='domains', help='Domain to add to the watched domains. Can be used multiple times.', action='append', default=[], required=False)
+    parser.add_argument('-f', '--file', dest='file', help='File with one domain per line to add to the watched domains, use "-" to read from stdin.', default=None, required=False)
+    parser.add_argument('-s', '--selector', dest='selector', help='DKIM Selector of the added domains.', required=False)
+    parser.add_argument('--priority', dest='priority', help='Priority of the added domains, a domain with priority N is re-checked N + 1 times as often and first when the budget is short. (default: 0)', type=int, default=0, required=False)
+    parser.add_argument('--remove', dest='remove', help='Domain to stop watching. Can be used multiple times.', action='append', default=[], required=False)
+    parser.add_argument('--interval', dest='interval', help='Seconds between the checks of a passing domain with priority 0. (default: 21600)', type=float, default=21600, required=False)
+    parser.add_argument('--min-interval', dest='min_interval', help='Minimum seconds between two checks of a domain. (default: 300)', type=float, default=300, required=False)
+    parser.add_argument('--max-interval', dest='max_interval', help='Maximum seconds between two checks of a domain, even when its records have a longer TTL. (default: 86400)', type=float, default=86400, required=False)
+    parser.add_argument('--failing-factor', dest='failing_factor', help='Interval multiplier for a domain whose last check failed or errored. (default: 0.25)', type=float, default=0.25, required=False)
+    parser.add_argument('--budget', dest='budget', help='Maximum number of provider requests per hour.', type=float, default=None, required=False)
+    parser.add_argument('-w', '--workers', dest='workers', help='Maximum number of domains checked at the same time. (default: 10)', type=int, default=10, required=False)
+    parser.add_argument('-o', '--output', dest='output', help='Append the change events to a file, one JSON line per event. (default: stdout)', required=False)
+    parser.add_argument('--once', dest='once', help='Only check the domains that are due now, then exit.', action='store_true', required=False)
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.min_interval > args.max_interval:
+        parser.error("--min-interval cannot be greater than --max-interval.")
+    if args.budget is not None and args.budget <= 0:
+        parser.error("--budget must be greater than 0.")
+    configure(args, parser)
+
+    store = monitor_store(args.db)
+    selector = str(args.selector) if args.selector else None
+    added = 0
+    for domain in args.domains:
+        store.add(domain, selector, args.priority)
+        added += 1
+    if args.file:
+        with contextlib.nullcontext(sys.stdin) if args.file == "-" else open(args.file, "r") as domain_file:
+            for domain in read_domains(domain_file):
+                store.add(domain, selector, args.priority)
+                added += 1
+    for domain in args.remove:
+        store.remove(domain)
+    if added or args.remove:
+        print(f"[*] Added {added} and removed {len(args.remove)} domains, watching {len(store)} domains", file=sys.stderr)
+    if not len(store):
+        parser.error("No domains to watch, add some with -d (--domain) or -f (--file).")
+
+    output = open(args.output, "a") if args.output else sys.stdout
+    watcher = monitor(store, interval=args.interval, min_interval=args.min_interval, max_interval=args.max_interval, failing_factor=args.failing_factor, budget=args.budget, workers=args.workers, deadline=args.deadline)
+    events = 0
+    try:
+        for event in watcher.run(once=args.once):
+            output.write(json.dumps(event, separators=(",", ":"), default=str) + "\n")
+            output.flush()
+            events += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
+    print(f"[*] Checked {watcher.checked} domains, {events} changes", file=sys.stderr)
+
+def main():
+    #--SUBCOMMANDS--
+    subcommands = {"serve": serve_main, "merge": merge_main, "monitor": monitor_main}
+    if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+        subcommands[sys.argv[1]](sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description='', epilog='Use "%(prog)s serve -h" for the HTTP server mode, "%(prog)s merge -h" to merge sharded results and "%(prog)s monitor -h" to watch domains for changes.')
+    domain_group = parser.add_mutually_exclusive_group(required=True)
+    domain_group.add_argument('-d', '--domain', dest='domain', help='Domain Name you want to test.')
+    domain_group.add_argument('-f', '--file', dest='file', help='File with one domain per line to test in bulk, use "-" to read from stdin.')
+    parser.add_argument('-s', '--selector', dest='selector', help='DKIM Selector, can be extracted from email.', required=False)
+    parser.add_argument('-v', '--verbose', dest='verbose', help='Print detailed results.', action='store_true', required=False)
+    parser.add_argument('-p', '--parallel', dest='parallel', help='Run the DKIM, SPF and DMARC checks at the same time.', action='store_true', required=False)
+    parser.add_argument('-w', '--workers', dest='workers', help='Bulk mode: maximum number of domains checked at the same time. (default: 10)', type=int, default=10, required=False)
+    parser.add_argument('--rate', dest='rate', help='Bulk mode: maximum number of domains started per second.', type=float, default=None, required=False)
+    parser.add_argument('--mxtoolbox-limit', dest='mxtoolbox_limit', help='Bulk mode: maximum number of concurrent requests to MXToolbox.', type=int, default=None, required=False)
+    parser.add_argument('--easydmarc-limit', dest='easydmarc_limit', help='Bulk mode: maximum number of concurrent requests to EasyDMARC.', type=int, default=None, required=False)
+    add_config_arguments(parser)
+    parser.add_argument('-j', '--json', dest='json', help='Print results in JSON format, one line per domain.', action='store_true', required=False)
+    parser.add_argument('-o', '--output', dest='output', help='Output results to a file.', required=False)
+    parser.add_argument('--profile', dest='profile', help='Print a breakdown of where the time went (queries, auth, TLS handshakes, retries, EasyDMARC...) at the end of the run.', action='store_true', required=False)
+    parser.add_argument('--metrics-file', dest='metrics_file', help='Write the timings and counters to a file in the Prometheus text format at the end of the run.', default=None, required=False)
+    parser.add_argument('--checkpoint', dest='checkpoint', help='Bulk mode: file that records finished domains, an interrupted scan started again with the same file resumes where it stopped.', default=None, required=False)
+    parser.add_argument('--processes', dest='processes', help='Bulk mode: split the domains between this many worker processes, each with its share of the provider rates and limits. Requires -j (--json). (default: 1)', type=int, default=1, required=False)
+    parser.add_argument('--shards', dest='shards', help='Bulk mode: split the domains into this many shards, e.g one per machine, and only scan the --shard-index shard. (default: 1)', type=int, default=1, required=False)
+    parser.add_argument('--shard-index', dest='shard_index', help='Bulk mode: the shard scanned with --shards, from 0 to shards - 1. (default: 0)', type=int, default=0, required=False)
+    parser.add_argument('--queue-dir', dest='queue_dir', help='Bulk mode: share the domain list with other processes or machines through a work queue in this directory, e.g on a network share. Every worker runs the same command.', default=None, required=False)
+    args = parser.parse_args()
+    if args.json and args.verbose:
+        parser.error("Cannot use both -j (--json) and -v (--verbose) arguments.")
+    if args.checkpoint and not args.file:
+        parser.error("--checkpoint can only be used with -f (--file).")
+    if (args.processes > 1 or args.shards > 1 or args.queue_dir) and not args.file:
+        parser.error("--processes, --shards and --queue-dir can only be used with -f (--file).")
+    if args.processes > 1 and (not args.json or args.file == "-" or args.checkpoint or args.record):
+        parser.error("--processes requires -j (--json) and a domain file, and cannot be used with --checkpoint or --record.")
+    if not 0 <= args.shard_index < args.shards:
+        parser.error("--shard-index must be between 0 and --shards - 1.")
+    if args.queue_dir and (args.checkpoint or args.shards > 1):
+        parser.error("--queue-dir cannot be used with --checkpoint or --shards, the queue keeps track of finished domains.")
+    configure(args, parser)
+
+    #if only -j used, default will be use json.dumps to print to stdout
+    #if only -o used, default will be print to file
+    #if only -v used, default will be print detailed results
+
+    #if -o and -j used, print to file in json format
+    #if -o and -v used, print to file in detailed format
+
+    #if -j and -v used, raise exception
+    checkpoint = None
+    if args.checkpoint:
+        try:
+            checkpoint = scan_checkpoint(args.checkpoint, source=args.file)
+        except Exception as err:
+            parser.error(str(err))
+    if args.output:
+        #a resumed scan adds to the results of the interrupted one
+        output = open(args.output, "a" if checkpoint is not None and checkpoint.count else "w")
+        disable_colours()
+    else:
+        output = sys.stdout
+    writer = jsonl_writer(output) if args.json else None
+    
+
+
+    #dkim = dkim_check("rsolutions.com")
+    #print(f"{dkim.domain} - Result: {dkim.result} - Warnings: {dkim.warnings} - Failures: {dkim.failures} - Passed: {dkim.passed}")
+    
+    #spf = spf_check("rsolutions.com")
+    #print(f"{spf.domain} - Result: {spf.result} - Warnings: {spf.warnings} - Failures: {spf.failures} - Passed: {spf.passed}")
+    
+    #dmarc = dmarc_check("rsolutions.com")
+    #print(f"{dmarc.domain} - Result: {dmarc.result} - Warnings: {dmarc.warnings} - Failures: {dmarc.failures} - Passed: {dmarc.passed}")
+
+
+    selector = str(args.selector) if args.selector else None
+
+    #--BULK MODE--
+    if args.file:
+        if selector and not args.json:
+            print(f"[*] Using DKIM selector {PURPLE}{selector}{ENDC}", file=output)
+        if checkpoint is not None and checkpoint.count:
+            print(f"[*] Resuming from {args.checkpoint}, skipping {checkpoint.count} finished domains", file=sys.stderr)
+        if args.processes > 1:
+            #results are written as the processes write them, already in JSON
+            scanned = 0
+            start = time.monotonic()
+            for results in scan_processes(args, selector):
+                output.write(json.dumps(results, separators=(",", ":")) + "\n")
+                output.flush()
+                scanned += 1
+            elapsed = time.monotonic() - start
+            print(f"[*] Scanned {scanned} domains in {elapsed:.1f}s with {args.processes} processes ({scanned / elapsed if elapsed else 0:.2f} domains/sec)", file=sys.stderr)
+            return
+
+        scanned = 0
+        start = time.monotonic()
+        #results are printed as soon as each domain finishes, not in the order of the input
+        for results in scan_from_args(args, selector, checkpoint=checkpoint):
+            with METRICS.span("render"):
+                if writer is not None:
+                    writer.write(results)
+                else:
+                    with contextlib.redirect_stdout(output):
+                        print(f"{ENDC}[*] Results for {BOLD}{results['domain']}{ENDC}:")
+                        print_results(results, verbose=args.verbose, show_selectors=selector is None)
+                        print("\n")
+                    output.flush()
+            scanned += 1
+        elapsed = time.monotonic() - start
+        print(f"[*] Scanned {scanned} domains in {elapsed:.1f}s ({scanned / elapsed if elapsed else 0:.2f} domains/sec)", file=sys.stderr)
+        print_backend_stats()
+        write_metrics(args.profile, args.metrics_file)
+        return
+
+    if writer is None:
+        print(f"[*] Running DMARC, DKIM, and SPF checks for {BLINK}{str(args.domain)}{ENDC}...", file=output)
+    
+    if selector and writer is None:
+        print(f"[*] Using DKIM selector {PURPLE}{selector}{ENDC}", file=output)
+    results = do_all_checks(str(args.domain), selector, parallel=args.parallel, deadline=args.deadline)
+    with METRICS.span("render"):
+        if writer is not None:
+            writer.write(results)
+        else:
+            with contextlib.redirect_stdout(output):
+                print_results(results, verbose=args.verbose, show_selectors=selector is None)
+    print_backend_stats()
+    write_metrics(args.profile, args.metrics_file)
     
 if __name__ == "__main__":
     main()
@@ -644,29 +5727,11 @@ if __name__ == "__main__":
     #convert each selector to a subclass of dkim_check
         #convert each selector dictionary key to a class attribute
 #General
-    #check if the record MXToolbox returns matches the record returned by a DNS query - DKIM, SPF, DMARC
-        #sometimes MXToolbox has old records cached
-    
-    #make each DKIM, DMARC, SPF check class a subclass of a general check class
-        # - can call all the checks from one class, while still being able to call each check individually
-        # - reduces the need to re-create the query function for each check, also gets rid of the domain
-        #   check in each __init__ 
-        # - queries to "https://mxtoolbox.com/api/v1/user" for a temp auth key can be done once and stored
-        # - dynamically output results if all checks use the same attributes/format
+    #dynamically output results from base_check, if all checks use the same attributes/format
     
-    #add option to output in json
-    #add option to output to file
-        #output in json or detailed format to a file
-    
-    #add a check for the domain's MX records
-
     #allow users to use their MXToolbox API key instead of generating a temp auth key
         #requires whole new endpoint for queries
     
-    #add threading 
-        #multiple domain
-        #multiple selectors
-        #each check a new thread
     
 
     
@@ -0,0 +1,154 @@
+import os
+import socket
+import struct
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import email_check
+
+#--STUB DNS SERVER--
+TYPES = email_check.dns_resolver.TYPES
+TYPE_NAMES = email_check.dns_resolver.TYPE_NAMES
+
+def encode_name(name:str) -> bytes:
+    return b"".join(bytes([len(label)]) + label.encode() for label in name.rstrip(".").split(".") if label) + b"\x00"
+
+def encode_rdata(rtype:str, value) -> bytes:
+    if rtype == "TXT":
+        data = value.encode()
+        #long records are split into 255 byte strings, like real servers do
+        return b"".join(bytes([len(data[i:i + 255])]) + data[i:i + 255] for i in range(0, max(len(data), 1), 255))
+    if rtype == "MX":
+        preference, host = value
+        return struct.pack("!H", preference) + encode_name(host)
+    if rtype == "A":
+        return socket.inet_pton(socket.AF_INET, value)
+    if rtype == "AAAA":
+        return socket.inet_pton(socket.AF_INET6, value)
+    return encode_name(value)
+
+class stub_dns_server:
+    """
+    In-process DNS server for the tests, answers from a zone over UDP and TCP on 127.0.0.1.
+    -zone is {(name, type): [values]}, TXT values are strings, MX values are (preference, host) tuples
+    -names in servfail are answered with SERVFAIL, queries for names in drop are never answered
+    -names in truncate are answered with the TC flag over UDP, so the client has to ask again over TCP
+    """
+    def __init__(self):
+        self.zone = {}
+        self.servfail = set()
+        self.drop = set()
+        self.truncate = set()
+        self.ttl = 300
+        self.queries = [] #(transport, name, type) of every query received
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp.bind(("127.0.0.1", 0))
+        self.port = self._udp.getsockname()[1]
+        self._tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._tcp.bind(("127.0.0.1", self.port))
+        self._tcp.listen()
+        self._closed = False
+        threading.Thread(target=self._serve_udp, daemon=True).start()
+        threading.Thread(target=self._serve_tcp, daemon=True).start()
+
+    @property
+    def address(self) -> str:
+        return f"127.0.0.1:{self.port}"
+
+    def answer(self, query:bytes, transport:str) -> bytes|None:
+        message_id = struct.unpack("!H", query[:2])[0]
+        name, offset = email_check.dns_resolver.read_name(query, 12)
+        name = name.lower()
+        rtype = TYPE_NAMES.get(struct.unpack("!H", query[offset:offset + 2])[0])
+        question = query[12:offset + 4]
+        self.queries.append((transport, name, rtype))
+        if name in self.drop:
+            return None
+        if name in self.servfail:
+            return struct.pack("!HHHHHH", message_id, 0x8182, 1, 0, 0, 0) + question
+        if transport == "udp" and name in self.truncate:
+            return struct.pack("!HHHHHH", message_id, 0x8380, 1, 0, 0, 0) + question
+        values = self.zone.get((name, rtype), [])
+        rcode = 0 if any(zone_name == name for zone_name, _ in self.zone) else 3
+        answers = b""
+        for value in values:
+            rdata = encode_rdata(rtype, value)
+            #the owner name is a compression pointer to the question, like most servers send it
+            answers += b"\xc0\x0c" + struct.pack("!HHIH", TYPES[rtype], 1, self.ttl, len(rdata)) + rdata
+        authority = b""
+        if not values:
+            soa = encode_name("ns.test") + encode_name("hostmaster.test") + struct.pack("!IIIII", 1, 7200, 3600, 86400, 60)
+            authority = b"\xc0\x0c" + struct.pack("!HHIH", TYPES["SOA"], 1, 120, len(soa)) + soa
+        header = struct.pack("!HHHHHH", message_id, 0x8180 | rcode, 1, len(values), 1 if authority else 0, 0)
+        return header + question + answers + authority
+
+    def _serve_udp(self):
+        while not self._closed:
+            try:
+                query, client = self._udp.recvfrom(4096)
+                response = self.answer(query, "udp")
+                if response is not None:
+                    self._udp.sendto(response, client)
+            except OSError:
+                return
+
+    def _serve_tcp(self):
+        while not self._closed:
+            try:
+                connection, _ = self._tcp.accept()
+            except OSError:
+                return
+            with connection:
+                length = struct.unpack("!H", email_check.dns_resolver._recv_exactly(connection, 2))[0]
+                response = self.answer(email_check.dns_resolver._recv_exactly(connection, length), "tcp")
+                if response is not None:
+                    connection.sendall(struct.pack("!H", len(response)) + response)
+
+    def close(self):
+        self._closed = True
+        self._udp.close()
+        self._tcp.close()
+
+@pytest.fixture
+def dns_server():
+    server = stub_dns_server()
+    yield server
+    server.close()
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    """
+    Every test gets its own shared resolver state, and no result cache or cassette.
+    """
+    monkeypatch.setattr(email_check, "RESULT_CACHE", None)
+    monkeypatch.setattr(email_check, "CASSETTE", None)
+    monkeypatch.setattr(email_check, "SPF_RESOLVER", email_check.spf_resolver())
+    monkeypatch.setattr(email_check, "MX_HOSTS", email_check.mx_host_checker())
+    monkeypatch.setattr(email_check, "MX_STARTTLS", False)
+
+@pytest.fixture
+def resolver(dns_server, monkeypatch):
+    """
+    Points the shared DNS_RESOLVER at the stub server.
+    """
+    dns_resolver = email_check.dns_resolver(dns_server.address, timeout=0.2, retries=0)
+    monkeypatch.setattr(email_check, "DNS_RESOLVER", dns_resolver)
+    yield dns_resolver
+    dns_resolver.close()
+
+@pytest.fixture
+def black_hole(monkeypatch):
+    """
+    Points the shared DNS_RESOLVER at a UDP port that never answers.
+    """
+    silent_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    silent_socket.bind(("127.0.0.1", 0))
+    dns_resolver = email_check.dns_resolver(f"127.0.0.1:{silent_socket.getsockname()[1]}", timeout=0.1, retries=0)
+    monkeypatch.setattr(email_check, "DNS_RESOLVER", dns_resolver)
+    yield dns_resolver
+    dns_resolver.close()
+    silent_socket.close()
@@ -0,0 +1,79 @@
+import pytest
+
+import email_check
+
+def test_record_and_replay(tmp_path):
+    path = str(tmp_path / "scan.jsonl")
+    recording = email_check.cassette(path, mode="record")
+    recording.record_http("https://example.com/api?q=1", email_check.cassette_response("https://example.com/api?q=1", 200, b'{"ok": true}', {"Content-Type": "application/json"}))
+    recording.record_dns(email_check.dns_answer("example.com", "MX", 0, [(10, "mx.example.com")], 300))
+    recording.record_dns(email_check.dns_answer("example.com", "TXT", 3, [], 60))
+    #the first response for an entry wins
+    recording.record_dns(email_check.dns_answer("example.com", "TXT", 0, ["v=spf1 -all"], 300))
+    recording.close()
+
+    replay = email_check.cassette(path)
+    response = replay.replay_http("https://example.com/api?q=1")
+    assert (response.status_code, response.json(), response.headers) == (200, {"ok": True}, {"Content-Type": "application/json"})
+    answer = replay.replay_dns("Example.com.", "mx")
+    assert (answer.name, answer.rtype, answer.rcode, answer.records, answer.ttl) == ("example.com", "MX", 0, [(10, "mx.example.com")], 300)
+    answer = replay.replay_dns("example.com", "TXT")
+    assert (answer.rcode, answer.records, answer.ttl) == (3, [], 60)
+    with pytest.raises(email_check.cassette_miss_error):
+        replay.replay_dns("other.example.com", "TXT")
+    replay.close()
+
+def test_recording_appends_to_an_existing_cassette(tmp_path):
+    path = str(tmp_path / "scan.jsonl")
+    for name in ("a.example.com", "b.example.com"):
+        recording = email_check.cassette(path, mode="record")
+        recording.record_dns(email_check.dns_answer(name, "TXT", 0, [name], 300))
+        recording.close()
+    replay = email_check.cassette(path)
+    assert [replay.replay_dns(name, "TXT").records for name in ("a.example.com", "b.example.com")] == [["a.example.com"], ["b.example.com"]]
+    replay.close()
+
+def test_cut_off_line_is_dropped(tmp_path):
+    path = str(tmp_path / "scan.jsonl")
+    recording = email_check.cassette(path, mode="record")
+    recording.record_dns(email_check.dns_answer("example.com", "TXT", 0, ["v=spf1 -all"], 300))
+    recording.close()
+    with open(path, "rb") as file:
+        complete = file.read()
+    with open(path, "ab") as file:
+        file.write(b'{"entry":"dns/TXT/cut.example.com","meta')
+
+    replay = email_check.cassette(path)
+    assert replay.replay_dns("example.com", "TXT").records == ["v=spf1 -all"]
+    with pytest.raises(email_check.cassette_miss_error):
+        replay.replay_dns("cut.example.com", "TXT")
+    replay.close()
+
+    email_check.cassette(path, mode="record").close()
+    with open(path, "rb") as file:
+        assert file.read() == complete
+
+def test_missing_cassette_cannot_be_replayed(tmp_path):
+    with pytest.raises(Exception, match="does not exist"):
+        email_check.cassette(str(tmp_path / "missing.jsonl"))
+
+def scan_dict() -> dict:
+    results = email_check.do_all_checks("example.com", selector="s1", backend="dns")
+    return {name: email_check.check_to_dict(results[name]) for name in ("spf", "dmarc", "dkim")}
+
+def test_checks_replay_offline(dns_server, resolver, monkeypatch, tmp_path):
+    path = str(tmp_path / "scan.jsonl")
+    dns_server.zone[("example.com", "TXT")] = ["v=spf1 include:_spf.example.net -all"]
+    dns_server.zone[("_spf.example.net", "TXT")] = ["v=spf1 ip4:192.0.2.0/24 ~all"]
+    dns_server.zone[("_dmarc.example.com", "TXT")] = ["v=DMARC1; p=reject; rua=mailto:dmarc@example.com"]
+    monkeypatch.setattr(email_check, "CASSETTE", email_check.cassette(path, mode="record"))
+    recorded = scan_dict()
+    email_check.CASSETTE.close()
+
+    dns_server.close()
+    monkeypatch.setattr(email_check, "SPF_RESOLVER", email_check.spf_resolver())
+    monkeypatch.setattr(email_check, "CASSETTE", email_check.cassette(path))
+    replayed = scan_dict()
+    email_check.CASSETTE.close()
+    assert replayed == recorded
+    assert recorded["spf"]["result"] == recorded["dmarc"]["result"] == "PASS"
@@ -0,0 +1,195 @@
+import asyncio
+import base64
+import json
+import pickle
+
+import pytest
+
+import email_check
+
+def der(tag:int, content:bytes) -> bytes:
+    if len(content) < 0x80:
+        return bytes([tag, len(content)]) + content
+    size = (len(content).bit_length() + 7) // 8
+    return bytes([tag, 0x80 | size]) + len(content).to_bytes(size, "big") + content
+
+def der_integer(value:int) -> bytes:
+    return der(0x02, value.to_bytes(value.bit_length() // 8 + 1, "big"))
+
+def rsa_key(bits:int, spki:bool=True) -> bytes:
+    rsa_public_key = der(0x30, der_integer((1 << (bits - 1)) | 1) + der_integer(65537))
+    if not spki:
+        return rsa_public_key
+    algorithm = der(0x30, der(0x06, bytes.fromhex("2a864886f70d010101")) + b"\x05\x00")
+    return der(0x30, algorithm + der(0x03, b"\x00" + rsa_public_key))
+
+def lookup_json(**lists) -> dict:
+    result = email_check.dns_backend.new_result()
+    for key, items in lists.items():
+        result[key] = items
+    return result
+
+ROW = {"Name": "DNS Lookup", "Info": "timed out", "Url": ""}
+
+#--DKIM--
+
+@pytest.mark.parametrize("bits", [512, 1024, 2048, 4096])
+def test_rsa_key_bits(bits):
+    assert email_check.dns_backend.rsa_key_bits(rsa_key(bits)) == bits
+    assert email_check.dns_backend.rsa_key_bits(rsa_key(bits, spki=False)) == bits
+
+def test_rsa_key_bits_of_garbage_is_zero():
+    assert email_check.dns_backend.rsa_key_bits(b"\x30\x82") == 0
+
+def dkim_result(record:str) -> dict:
+    return email_check.DNS_BACKEND.evaluate_dkim("s1._domainkey.example.com", [record])
+
+def test_evaluate_dkim_key_lengths():
+    assert dkim_result("v=DKIM1; k=rsa; p=" + base64.b64encode(rsa_key(2048)).decode())["Failed"] == []
+    assert dkim_result("v=DKIM1; k=rsa; p=" + base64.b64encode(rsa_key(1024)).decode())["Warnings"][0]["Name"] == "DKIM Key Length"
+    assert dkim_result("v=DKIM1; k=rsa; p=" + base64.b64encode(rsa_key(512)).decode())["Failed"][0]["Name"] == "DKIM Key Length"
+
+def test_evaluate_dkim_failures():
+    assert dkim_result("v=DKIM1; p=")["Failed"][0]["Info"] == "The key has been revoked (empty p tag)"
+    assert dkim_result("v=DKIM1; p=not base64!")["Failed"][0]["Info"] == "The public key is not valid base64"
+    assert dkim_result("v=DKIM1; k=dsa; p=AAAA")["Failed"][0]["Name"] == "DKIM Key Type"
+    assert dkim_result("k=rsa; v=DKIM1; p=" + base64.b64encode(rsa_key(2048)).decode())["Failed"][0]["Name"] == "DKIM Version Tag"
+    assert email_check.DNS_BACKEND.evaluate_dkim("s1._domainkey.example.com", [])["Failed"][0]["Name"] == "DKIM Record Published"
+
+def test_testing_selector(dns_server, resolver):
+    dns_server.zone[("s1._domainkey.example.com", "TXT")] = ["v=DKIM1; t=y; p=" + base64.b64encode(rsa_key(2048)).decode()]
+    check = email_check.dkim_check("example.com", selector="s1", backend="dns")
+    assert check.result == "PASS"
+    assert check.selectors[0]["is_testing_selector"] is True
+    assert "All selectors are test selectors for example.com. Please add a non-testing selector to your domain." in check.warnings
+
+#--DMARC--
+
+def dmarc_result(record:str) -> dict:
+    return email_check.DNS_BACKEND.evaluate_dmarc("example.com", [record])
+
+def test_evaluate_dmarc():
+    result = dmarc_result("v=DMARC1; p=reject; rua=mailto:dmarc@example.com")
+    assert (result["Failed"], result["Warnings"]) == ([], [])
+    result = dmarc_result("v=DMARC1; p=none; pct=50")
+    assert [warning["Name"] for warning in result["Warnings"]] == ["DMARC Quarantine/Reject policy enabled", "DMARC Percentage Tag", "DMARC Aggregate Reports"]
+    assert [failure["Name"] for failure in dmarc_result("v=DMARC1; p=block; adkim=x")["Failed"]] == ["DMARC Policy Tag", "DMARC Alignment Tag"]
+    assert dmarc_result("p=reject; v=DMARC1")["Failed"][0]["Name"] == "DMARC Syntax Check"
+    assert email_check.DNS_BACKEND.evaluate_dmarc("example.com", [])["Failed"][0]["Name"] == "DMARC Record Published"
+
+def test_dmarc_check(dns_server, resolver):
+    dns_server.zone[("_dmarc.example.com", "TXT")] = ["v=DMARC1; p=quarantine; rua=mailto:dmarc@example.com"]
+    check = email_check.dmarc_check("example.com", backend="dns")
+    assert check.result == "PASS"
+    assert check.record_content == "v=DMARC1; p=quarantine; rua=mailto:dmarc@example.com"
+    assert email_check.dmarc_check("other.example.com", backend="dns").result == "FAIL"
+
+#--FAILED LOOKUPS--
+
+def test_check_result_states():
+    assert email_check.check_result(lookup_json()).result == "PASS"
+    assert email_check.check_result(lookup_json(Timeouts=[ROW])).result == "TIMEOUT"
+    assert email_check.check_result(lookup_json(Errors=[ROW])).result == "ERROR"
+    assert email_check.check_result(lookup_json(Failed=[ROW], Timeouts=[ROW])).result == "FAIL"
+    assert email_check.selector_result("s1", lookup_json(Timeouts=[ROW])).valid is None
+
+def test_timeouts_are_not_a_pass_and_are_not_cached(black_hole, monkeypatch, tmp_path):
+    monkeypatch.setattr(email_check, "RESULT_CACHE", email_check.result_cache(str(tmp_path / "cache.sqlite3")))
+    assert email_check.spf_check("example.com", backend="dns").result == "TIMEOUT"
+    assert email_check.dmarc_check("example.com", backend="dns").result == "TIMEOUT"
+    assert email_check.dkim_check("example.com", selector="s1", backend="dns").result == "TIMEOUT"
+    for command, argument in (("spf", "example.com"), ("dmarc", "example.com"), ("dkim", "s1._domainkey.example.com")):
+        assert email_check.RESULT_CACHE.get("dns", command, argument) is None
+    email_check.RESULT_CACHE.close()
+
+def test_servfail_is_an_error(dns_server, resolver):
+    dns_server.servfail.add("_dmarc.example.com")
+    assert email_check.dmarc_check("example.com", backend="dns").result == "ERROR"
+
+def test_results_are_cached(dns_server, resolver, monkeypatch, tmp_path):
+    monkeypatch.setattr(email_check, "RESULT_CACHE", email_check.result_cache(str(tmp_path / "cache.sqlite3")))
+    dns_server.zone[("_dmarc.example.com", "TXT")] = ["v=DMARC1; p=reject"]
+    email_check.dmarc_check("example.com", backend="dns", run=True)
+    assert email_check.RESULT_CACHE.get("dns", "dmarc", "example.com")["Passed"] != []
+    email_check.RESULT_CACHE.close()
+
+#--RESULT MODEL--
+
+def test_result_rows_are_shared_read_only_dicts():
+    row = email_check.result_row.intern(ROW)
+    assert row is email_check.result_row.intern(dict(ROW))
+    assert json.loads(json.dumps([row])) == [ROW]
+    assert pickle.loads(pickle.dumps(row)) == ROW
+    with pytest.raises(TypeError):
+        row["Info"] = "changed"
+    with pytest.raises(TypeError):
+        row.update(Info="changed")
+
+def test_check_failures_are_json_serializable(dns_server, resolver):
+    check = email_check.spf_check("example.com", backend="dns")
+    assert json.loads(json.dumps(check.failures)) == [{"Name": "SPF Record Published", "Info": "No SPF Record found", "Url": email_check.dns_backend.SPF_URL}]
+
+def test_check_to_dict_round_trip(dns_server, resolver):
+    dns_server.zone[("example.com", "TXT")] = ["v=spf1 ip4:192.0.2.0/24 -all"]
+    check_dict = email_check.check_to_dict(email_check.spf_check("example.com", backend="dns"))
+    assert json.loads(json.dumps(check_dict)) == check_dict
+    assert check_dict["result"] == "PASS"
+    assert check_dict["record_content"] == "v=spf1 ip4:192.0.2.0/24 -all"
+
+#--LAZY CHECKS--
+
+class failing_backend(email_check.lookup_backend):
+    name = "failing"
+
+    def __init__(self):
+        self.fetches = 0
+
+    def fetch(self, command:str, argument:str, query=None, auth=None) -> dict:
+        self.fetches += 1
+        raise Exception("provider is down")
+
+def test_lazy_check_keeps_its_first_error():
+    backend = failing_backend()
+    check = email_check.spf_check("example.com", backend=backend)
+    assert backend.fetches == 0
+    for attribute in ("result", "failures", "passed", "result"):
+        with pytest.raises(Exception, match="provider is down"):
+            getattr(check, attribute)
+    assert backend.fetches == 1
+
+def test_async_cancelled_check_is_stored_as_its_error(dns_server, resolver, monkeypatch):
+    async def cancelled(self):
+        raise email_check.lookup_cancelled_error()
+    monkeypatch.setattr(email_check.spf_check, "run_async", cancelled)
+    results = asyncio.run(email_check.async_do_all_checks("example.com", selector="s1", backend="dns"))
+    assert isinstance(results["spf"], email_check.lookup_cancelled_error)
+    assert email_check.check_to_dict(results["spf"])["result"] == "ERROR"
+    assert results["dmarc"].result == "FAIL"
+
+#--INCREMENTAL--
+
+class counting_backend(email_check.lookup_backend):
+    name = "counting"
+
+    def __init__(self):
+        self.fetches = 0
+
+    def fetch(self, command:str, argument:str, query=None, auth=None) -> dict:
+        self.fetches += 1
+        return lookup_json()
+
+def test_incremental_spf_rechecks_changed_includes(dns_server, resolver, tmp_path):
+    dns_server.zone[("example.com", "TXT")] = ["v=spf1 include:_spf.example.net -all"]
+    dns_server.zone[("_spf.example.net", "TXT")] = ["v=spf1 ip4:192.0.2.0/24 ~all"]
+    backend = counting_backend()
+    store = email_check.record_store(str(tmp_path / "records.sqlite3"))
+    incremental = email_check.incremental_backend(backend, store)
+    incremental.lookup("spf", "example.com")
+    incremental.lookup("spf", "example.com")
+    assert backend.fetches == 1
+    #the domain's own record is unchanged, only the included one
+    dns_server.zone[("_spf.example.net", "TXT")] = ["v=spf1 ip4:192.0.2.0/24 include:_spf2.example.net ~all"]
+    email_check.SPF_RESOLVER.clear()
+    incremental.lookup("spf", "example.com")
+    assert backend.fetches == 2
+    store.close()
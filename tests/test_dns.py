@@ -0,0 +1,110 @@
+import struct
+import time
+
+import pytest
+
+import email_check
+from conftest import encode_name
+
+def test_build_query_has_question_and_edns():
+    query = email_check.dns_resolver("127.0.0.1").build_query(0x1234, "Example.com.", "TXT")
+    message_id, flags, qdcount, ancount, nscount, arcount = struct.unpack("!HHHHHH", query[:12])
+    assert (message_id, flags, qdcount, ancount, nscount, arcount) == (0x1234, 0x0100, 1, 0, 0, 1)
+    name, offset = email_check.dns_resolver.read_name(query, 12)
+    assert name == "Example.com"
+    assert struct.unpack("!HH", query[offset:offset + 4]) == (16, 1)
+
+def test_read_name_follows_compression_pointers():
+    #"example.com" at offset 12, then "mail" + a pointer to it
+    message = b"\x00" * 12 + encode_name("example.com") + b"\x04mail\xc0\x0c"
+    assert email_check.dns_resolver.read_name(message, 12) == ("example.com", 25)
+    assert email_check.dns_resolver.read_name(message, 25) == ("mail.example.com", 32)
+
+def test_read_name_rejects_compression_loops():
+    message = b"\x00" * 12 + b"\xc0\x0c"
+    with pytest.raises(Exception, match="compression loop"):
+        email_check.dns_resolver.read_name(message, 12)
+
+def test_parse_answer_mx_with_compressed_names():
+    question = encode_name("example.com") + struct.pack("!HH", 15, 1)
+    answer = b"\xc0\x0c" + struct.pack("!HHIH", 15, 1, 300, 9) + struct.pack("!H", 10) + b"\x04mail\xc0\x0c"
+    message = struct.pack("!HHHHHH", 1, 0x8180, 1, 1, 0, 0) + question + answer
+    parsed = email_check.dns_resolver("127.0.0.1").parse_answer(message, "example.com", "MX")
+    assert (parsed.rcode, parsed.records, parsed.ttl) == (0, [(10, "mail.example.com")], 300)
+
+def test_parse_answer_joins_txt_strings_and_uses_soa_minimum():
+    question = encode_name("example.com") + struct.pack("!HH", 16, 1)
+    rdata = b"\x05hello\x06 world"
+    answer = b"\xc0\x0c" + struct.pack("!HHIH", 16, 1, 30, len(rdata)) + rdata
+    message = struct.pack("!HHHHHH", 1, 0x8180, 1, 1, 0, 0) + question + answer
+    assert email_check.dns_resolver("127.0.0.1").parse_answer(message, "example.com", "TXT").records == ["hello world"]
+
+    soa = encode_name("ns.test") + encode_name("hostmaster.test") + struct.pack("!IIIII", 1, 2, 3, 4, 60)
+    authority = b"\xc0\x0c" + struct.pack("!HHIH", 6, 1, 120, len(soa)) + soa
+    message = struct.pack("!HHHHHH", 1, 0x8183, 1, 0, 1, 0) + question + authority
+    negative = email_check.dns_resolver("127.0.0.1").parse_answer(message, "example.com", "TXT")
+    assert (negative.rcode, negative.records, negative.ttl) == (3, [], 60)
+
+def test_resolve_over_udp(dns_server, resolver):
+    dns_server.zone[("example.com", "TXT")] = ["v=spf1 -all", "other"]
+    dns_server.zone[("example.com", "MX")] = [(10, "mx.example.com")]
+    assert resolver.resolve("example.com", "TXT").records == ["v=spf1 -all", "other"]
+    assert resolver.resolve("example.com", "MX").records == [(10, "mx.example.com")]
+    assert resolver.resolve("missing.example.com", "TXT").rcode == 3
+
+def test_truncated_answer_falls_back_to_tcp(dns_server, resolver):
+    record = "v=spf1 " + " ".join(f"ip4:10.0.{i}.0/24" for i in range(100)) + " -all"
+    dns_server.zone[("big.example.com", "TXT")] = [record]
+    dns_server.truncate.add("big.example.com")
+    assert resolver.resolve("big.example.com", "TXT").records == [record]
+    assert [transport for transport, name, _ in dns_server.queries if name == "big.example.com"] == ["udp", "tcp"]
+
+def test_unanswered_query_times_out(black_hole):
+    with pytest.raises(email_check.dns_timeout_error):
+        black_hole.resolve("example.com", "TXT")
+
+def test_servfail_keeps_the_rcode(dns_server, resolver):
+    dns_server.servfail.add("example.com")
+    assert resolver.resolve("example.com", "TXT").rcode == 2
+
+def test_discovery_negative_cache_is_bounded(dns_server, resolver):
+    dns_server.zone[("s1._domainkey.example.com", "TXT")] = ["v=DKIM1; p=AAAA"]
+    discovery = email_check.selector_discovery(wordlist=["s1", "s2", "s3"], negative_ttl=0.2, max_entries=3)
+    assert discovery.discover("example.com") == ["s1"]
+    assert discovery.candidates("example.com") == ["s1"]
+    discovery.discover("example.net")
+    assert list(discovery._negative) == [("example.net", "s1"), ("example.net", "s2"), ("example.net", "s3")]
+    time.sleep(0.25)
+    #expired entries are dropped when they are looked up
+    assert discovery.candidates("example.net") == ["s1", "s2", "s3"]
+    assert list(discovery._negative) == []
+
+def test_submit_waits_for_a_free_message_id(black_hole):
+    black_hole.MAX_PENDING = 2
+    started = time.monotonic()
+    futures = [black_hole.submit(f"d{i}.example.com", "TXT") for i in range(3)]
+    #the third query was only sent once one of the first two had timed out
+    assert time.monotonic() - started >= black_hole.timeout
+    assert len(black_hole._pending) <= 2
+    for future in futures:
+        with pytest.raises(email_check.dns_timeout_error):
+            future.result(5)
+
+def test_failed_send_is_not_left_pending(dns_server, resolver):
+    class failing_socket:
+        def __init__(self, dns_socket):
+            self.dns_socket = dns_socket
+
+        def send(self, packet:bytes):
+            raise BlockingIOError("no buffer space")
+
+        def __getattr__(self, name:str):
+            return getattr(self.dns_socket, name)
+    resolver.resolve("example.com", "TXT") #opens the socket
+    real_socket = resolver._socket
+    resolver._socket = failing_socket(real_socket)
+    future = resolver.submit("example.com", "TXT")
+    resolver._socket = real_socket
+    with pytest.raises(email_check.dns_timeout_error, match="could not be sent"):
+        future.result(1)
+    assert resolver._pending == {}
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+
+import pytest
+
+import email_check
+
+ENDPOINT = "https://mxtoolbox.com/api/v1/lookup/spf/example.com"
+
+class fake_response:
+    status_code = 200
+    content = b"{}"
+    infos = {}
+
+class blocking_session:
+    """
+    Session whose requests wait until release is set, so a test can hold the host's only connection.
+    """
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def get(self, endpoint:str, **kwargs):
+        self.started.set()
+        self.release.wait(5)
+        return fake_response()
+
+class blocking_async_session:
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.started = asyncio.Event()
+
+    async def get(self, endpoint:str, **kwargs):
+        self.started.set()
+        await self.release.wait()
+        return fake_response()
+
+def test_cancelled_queued_async_request_frees_its_slot():
+    scheduler = email_check.provider_scheduler()
+    client = email_check.async_http_client(pool_size=1, scheduler=scheduler)
+
+    async def run():
+        state = client._get_loop_state()
+        await state["session"].close()
+        session = state["session"] = blocking_async_session()
+        running = asyncio.create_task(client.get(ENDPOINT))
+        await session.started.wait()
+        queued = asyncio.create_task(client.get(ENDPOINT))
+        await asyncio.sleep(0.05)
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        session.release.set()
+        await running
+    asyncio.run(run())
+    assert scheduler.stats()["mxtoolbox.com"]["in_flight"] == 0
+
+def test_deadline_covers_the_wait_for_a_connection():
+    scheduler = email_check.provider_scheduler()
+    client = email_check.http_client(pool_size=1, scheduler=scheduler)
+    session = blocking_session()
+    client._get_pool("mxtoolbox.com")["idle"].put(session)
+    running = threading.Thread(target=client.get, args=(ENDPOINT,))
+    running.start()
+    session.started.wait(5)
+    with email_check.domain_deadline(0.1):
+        with pytest.raises(email_check.deadline_exceeded_error, match="waiting for a connection"):
+            client.get(ENDPOINT)
+    session.release.set()
+    running.join()
+    assert scheduler.stats()["mxtoolbox.com"]["in_flight"] == 0
+    assert client._get_pool("mxtoolbox.com")["idle"].qsize() == 1
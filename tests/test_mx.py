@@ -0,0 +1,144 @@
+import asyncio
+import socket
+import threading
+
+import email_check
+
+def smtp_server(ehlo_reply:bytes) -> socket.socket:
+    """
+    Mail server on 127.0.0.1 that sends a banner and answers EHLO with ehlo_reply, once per connection.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+
+    def serve():
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except OSError:
+                return
+            with connection:
+                connection.sendall(b"220 mx.example.com ESMTP\r\n")
+                connection.recv(1024)
+                connection.sendall(ehlo_reply)
+    threading.Thread(target=serve, daemon=True).start()
+    return listener
+
+def mx_check(domain:str, **kwargs) -> email_check.mx_check:
+    return email_check.mx_check(domain, run=True, hosts=email_check.mx_host_checker(timeout=0.5), **kwargs)
+
+def test_two_resolving_hosts_pass(dns_server, resolver):
+    dns_server.zone[("example.com", "MX")] = [(20, "mx2.example.com"), (10, "mx1.example.com")]
+    dns_server.zone[("mx1.example.com", "A")] = ["192.0.2.1"]
+    dns_server.zone[("mx2.example.com", "AAAA")] = ["2001:db8::1"]
+    check = mx_check("example.com")
+    assert (check.result, check.failures, check.warnings) == ("PASS", [], [])
+    assert [(host["preference"], host["host"], host["addresses"], host["ipv6"]) for host in check.hosts] == [
+        (10, "mx1.example.com", ["192.0.2.1"], []),
+        (20, "mx2.example.com", [], ["2001:db8::1"]),
+    ]
+
+def test_single_host_warns(dns_server, resolver):
+    dns_server.zone[("example.com", "MX")] = [(10, "mx.example.com")]
+    dns_server.zone[("mx.example.com", "A")] = ["192.0.2.1"]
+    check = mx_check("example.com")
+    assert check.result == "PASS"
+    assert [warning["Name"] for warning in check.warnings] == ["Redundant MX Hosts"]
+
+def test_missing_and_bad_records_fail(dns_server, resolver):
+    dns_server.zone[("example.com", "TXT")] = ["v=spf1 -all"]
+    dns_server.zone[("ip.example.com", "MX")] = [(10, "192.0.2.1")]
+    dns_server.zone[("gone.example.com", "MX")] = [(10, "mx.gone.example.com")]
+    assert mx_check("example.com").failures[0]["Name"] == "MX Records Published"
+    assert "MX Host Is A Name" in [failure["Name"] for failure in mx_check("ip.example.com").failures]
+    check = mx_check("gone.example.com")
+    assert check.result == "FAIL"
+    assert check.failures[0]["Info"] == "mx.gone.example.com has no A or AAAA record"
+
+def test_null_mx(dns_server, resolver):
+    dns_server.zone[("example.com", "MX")] = [(0, ".")]
+    dns_server.zone[("mixed.example.com", "MX")] = [(0, "."), (10, "mx.example.com")]
+    dns_server.zone[("mx.example.com", "A")] = ["192.0.2.1"]
+    assert mx_check("example.com").result == "PASS"
+    assert mx_check("mixed.example.com").failures[0]["Name"] == "Null MX"
+
+def test_unanswered_mx_lookup_times_out(black_hole):
+    check = mx_check("example.com")
+    assert (check.result, check.failures) == ("TIMEOUT", [])
+
+def test_unanswered_host_lookup_times_out(dns_server, resolver):
+    dns_server.zone[("example.com", "MX")] = [(10, "mx1.example.com"), (20, "slow.example.net")]
+    dns_server.zone[("mx1.example.com", "A")] = ["192.0.2.1"]
+    dns_server.drop.add("slow.example.net")
+    check = mx_check("example.com")
+    assert (check.result, check.failures) == ("TIMEOUT", [])
+    assert check.timeouts[0]["Name"] == "MX Host Lookup"
+
+def test_servfail_host_lookup_is_an_error(dns_server, resolver):
+    dns_server.zone[("example.com", "MX")] = [(10, "broken.example.net")]
+    dns_server.servfail.add("broken.example.net")
+    assert mx_check("example.com").result == "ERROR"
+
+def test_starttls_probe(dns_server, resolver):
+    dns_server.zone[("example.com", "MX")] = [(10, "mx.example.com")]
+    dns_server.zone[("mx.example.com", "A")] = ["127.0.0.1"]
+    for ehlo_reply, offered in ((b"250-mx.example.com\r\n250 STARTTLS\r\n", True), (b"250 mx.example.com\r\n", False)):
+        server = smtp_server(ehlo_reply)
+        hosts = email_check.mx_host_checker(timeout=0.5, port=server.getsockname()[1], helo_name="test.example.com")
+        check = email_check.mx_check("example.com", run=True, starttls=True, hosts=hosts)
+        server.close()
+        assert check.hosts[0]["starttls"] is offered
+        assert check.hosts[0]["banner"] == "220 mx.example.com ESMTP"
+        assert ("STARTTLS" in [warning["Name"] for warning in check.warnings]) is not offered
+
+def test_blocked_starttls_probe_is_a_warning(dns_server, resolver):
+    dns_server.zone[("example.com", "MX")] = [(10, "mx.example.com")]
+    dns_server.zone[("mx.example.com", "A")] = ["127.0.0.1"]
+    closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    closed.bind(("127.0.0.1", 0))
+    port = closed.getsockname()[1]
+    closed.close()
+    check = email_check.mx_check("example.com", run=True, starttls=True, hosts=email_check.mx_host_checker(timeout=0.5, port=port, helo_name="test.example.com"))
+    assert check.result == "PASS"
+    assert "STARTTLS Probe" in [warning["Name"] for warning in check.warnings]
+
+def test_async_mx_check(dns_server, resolver):
+    dns_server.zone[("example.com", "MX")] = [(10, "mx.example.com")]
+    dns_server.zone[("mx.example.com", "A")] = ["192.0.2.1"]
+
+    async def run() -> email_check.mx_check:
+        check = email_check.mx_check("example.com", run=False, hosts=email_check.mx_host_checker(timeout=0.5))
+        await check.run_async()
+        return check
+    assert asyncio.run(run()).result == "PASS"
+
+def test_mx_is_opt_in(dns_server, resolver):
+    dns_server.zone[("example.com", "MX")] = [(10, "mx.example.com")]
+    assert "mx" not in email_check.do_all_checks("example.com", selector="s1", backend="dns")
+    assert email_check.do_all_checks("example.com", selector="s1", backend="dns", mx=True)["mx"].result == "FAIL"
+
+def test_hosts_are_checked_without_a_thread_each(dns_server, resolver):
+    hosts = [f"mx{i}.example.com" for i in range(5)]
+    for host in hosts:
+        dns_server.zone[(host, "A")] = ["192.0.2.1"]
+    checker = email_check.mx_host_checker(timeout=0.5)
+    resolver.resolve("example.com", "MX") #starts the resolver's receiver thread
+    threads = threading.active_count()
+    results = checker.check_hosts(hosts)
+    assert [results[host]["addresses"] for host in hosts] == [["192.0.2.1"]] * 5
+    assert threading.active_count() == threads
+    assert checker._executor is None
+
+def test_probes_share_a_bounded_executor(dns_server, resolver):
+    hosts = [f"mx{i}.example.com" for i in range(4)]
+    for host in hosts:
+        dns_server.zone[(host, "A")] = ["127.0.0.1"]
+    server = smtp_server(b"250-mx.example.com\r\n250 STARTTLS\r\n")
+    checker = email_check.mx_host_checker(timeout=0.5, port=server.getsockname()[1], helo_name="test.example.com", max_workers=2)
+    results = checker.check_hosts(hosts, starttls=True)
+    server.close()
+    assert all(results[host]["starttls"] for host in hosts)
+    assert checker._executor._max_workers == 2
+    checker.close()
+    assert checker._executor is None
@@ -0,0 +1,64 @@
+import os
+import time
+
+import pytest
+
+import email_check
+
+DOMAINS = [f"d{i}.example.com" for i in range(10)]
+
+@pytest.fixture(autouse=True)
+def offline_scan(monkeypatch):
+    def bulk_scan(domains, selector=None, **scan_options):
+        for domain in domains:
+            yield {"domain": domain}
+    monkeypatch.setattr(email_check, "bulk_scan", bulk_scan)
+
+def scanned_domains(queue:email_check.work_queue) -> list:
+    return sorted(results["domain"] for results in email_check.merge_results([os.path.join(queue.path, "results")]))
+
+def test_workers_wait_for_the_claims_of_dead_workers(tmp_path):
+    queue = email_check.work_queue(str(tmp_path), claim_timeout=0.3)
+    assert queue.add(iter(DOMAINS), chunk_size=3)
+    dead_claim = queue.claim() #claimed by a worker that died without finishing it
+    assert dead_claim[1] == DOMAINS[:3]
+    assert not queue.finished
+    results = [results["domain"] for results in email_check.scan_queue(queue, poll_interval=0.05)]
+    assert sorted(results) == DOMAINS
+    assert queue.finished
+    assert scanned_domains(queue) == DOMAINS
+
+def test_list_is_added_once(tmp_path):
+    first = email_check.work_queue(str(tmp_path))
+    second = email_check.work_queue(str(tmp_path))
+    assert first.add(iter(DOMAINS), chunk_size=4)
+    assert not second.add(iter(DOMAINS), chunk_size=4)
+    assert sorted(os.listdir(tmp_path / "pending")) == ["00000000.txt", "00000001.txt", "00000002.txt"]
+
+def test_worker_takes_over_from_a_dead_adder(tmp_path):
+    domains = [f"d{i}.example.com" for i in range(250)]
+    queue = email_check.work_queue(str(tmp_path), claim_timeout=0.3)
+    #the first worker queued one chunk of the default size, then died before the list was ready
+    os.mkdir(tmp_path / "adding")
+    (tmp_path / "pending" / "00000000.txt").write_text("\n".join(domains[:100]) + "\n")
+    assert not queue.add(iter(domains)) #the adder is still within claim_timeout
+    time.sleep(0.35)
+    assert sorted(results["domain"] for results in email_check.scan_queue(queue, poll_interval=0.05, domains=iter(domains))) == sorted(domains)
+    assert queue.ready
+
+def test_failed_adder_hands_over_straight_away(tmp_path):
+    queue = email_check.work_queue(str(tmp_path))
+
+    def failing_domains():
+        yield from DOMAINS[:4]
+        raise OSError("domain file went away")
+    with pytest.raises(OSError):
+        queue.add(failing_domains(), chunk_size=4)
+    assert not queue.ready
+    assert queue.add(iter(DOMAINS), chunk_size=4)
+    assert sorted(os.listdir(tmp_path / "pending")) == ["00000000.txt", "00000001.txt", "00000002.txt"]
+
+def test_merge_keeps_the_last_result_of_each_domain(tmp_path):
+    (tmp_path / "a.jsonl").write_text('{"domain":"a.com","run":1}\n{"domain":"b.com","run":1}\n\n')
+    (tmp_path / "b.jsonl").write_text('{"domain":"a.com","run":2}\n{"domain":"c.com","run":2}\n')
+    assert list(email_check.merge_results([str(tmp_path)])) == [{"domain": "b.com", "run": 1}, {"domain": "a.com", "run": 2}, {"domain": "c.com", "run": 2}]
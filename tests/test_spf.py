@@ -0,0 +1,59 @@
+import email_check
+
+def test_parse_terms():
+    assert email_check.spf_resolver.parse_terms("v=spf1 -all include:_spf.google.com redirect=_spf.example.com a/24 mx:example.com/24") == [
+        ("-", "all", "", False, "-all"),
+        ("+", "include", "_spf.google.com", False, "include:_spf.google.com"),
+        ("+", "redirect", "_spf.example.com", True, "redirect=_spf.example.com"),
+        ("+", "a", "", False, "a/24"),
+        ("+", "mx", "example.com", False, "mx:example.com/24"),
+    ]
+
+def test_expand_counts_nested_lookups(dns_server, resolver):
+    dns_server.zone[("example.com", "TXT")] = ["v=spf1 include:_spf.example.net mx -all"]
+    dns_server.zone[("_spf.example.net", "TXT")] = ["v=spf1 include:a.example.net include:b.example.net ~all"]
+    dns_server.zone[("a.example.net", "TXT")] = ["v=spf1 ip4:192.0.2.0/24 ~all"]
+    dns_server.zone[("b.example.net", "TXT")] = ["v=spf1 ip6:2001:db8::/32 ~all"]
+    dns_server.zone[("example.com", "MX")] = [(10, "mx.example.com")]
+    tree = email_check.SPF_RESOLVER.expand("example.com")
+    assert (tree.lookups, tree.void_lookups, tree.errors, tree.loop) == (4, 0, [], False)
+    #the second expansion is served from the memoized tree
+    assert email_check.SPF_RESOLVER.expand("example.com") is tree
+
+def test_lookup_limit_fails(dns_server, resolver):
+    includes = [f"i{i}.example.net" for i in range(11)]
+    dns_server.zone[("example.com", "TXT")] = ["v=spf1 " + " ".join(f"include:{name}" for name in includes) + " -all"]
+    for name in includes:
+        dns_server.zone[(name, "TXT")] = ["v=spf1 ip4:192.0.2.1 -all"]
+    check = email_check.spf_check("example.com", backend="dns")
+    assert check.result == "FAIL"
+    assert any(failure["Name"] == "SPF Included Lookups" and "(11)" in failure["Info"] for failure in check.failures)
+
+def test_include_loop_fails(dns_server, resolver):
+    dns_server.zone[("loop.com", "TXT")] = ["v=spf1 include:loop2.com -all"]
+    dns_server.zone[("loop2.com", "TXT")] = ["v=spf1 include:loop.com -all"]
+    tree = email_check.SPF_RESOLVER.expand("loop.com")
+    assert tree.loop
+    assert tree.errors == ["Include loop: loop.com -> loop2.com -> loop.com"]
+    assert email_check.spf_check("loop.com", backend="dns").result == "FAIL"
+
+def test_void_lookups_fail(dns_server, resolver):
+    dns_server.zone[("example.com", "TXT")] = ["v=spf1 include:gone1.example.net include:gone2.example.net include:gone3.example.net -all"]
+    check = email_check.spf_check("example.com", backend="dns")
+    assert check.result == "FAIL"
+    assert any(failure["Name"] == "SPF Void Lookups" for failure in check.failures)
+
+def test_include_timeout_is_not_a_failure(dns_server, resolver):
+    dns_server.zone[("example.com", "TXT")] = ["v=spf1 include:slow.example.net -all"]
+    dns_server.drop.add("slow.example.net")
+    check = email_check.spf_check("example.com", backend="dns")
+    assert check.result == "TIMEOUT"
+    assert check.failures == []
+
+def test_answers_and_trees_are_bounded(dns_server, resolver):
+    spf_resolver = email_check.spf_resolver(max_entries=2)
+    for domain in ("a.example.com", "b.example.com", "c.example.com"):
+        dns_server.zone[(domain, "TXT")] = ["v=spf1 -all"]
+        spf_resolver.expand(domain)
+    assert len(spf_resolver._answers) == 2
+    assert list(spf_resolver._nodes) == ["b.example.com", "c.example.com"]